@@ -9,6 +9,7 @@ from django.test import TestCase
 from django.test import client
 from mainsite.apps.mail_auth import views, models
 from mainsite.apps.mail_auth.models import UserAuthToken
+from mainsite.apps.participantdatabase.mailing import send_queued_mails
 
 
 class ActivationTest(TestCase):
@@ -34,6 +35,8 @@ class ActivationTest(TestCase):
     def test_mail_sending(self):
         factory = client.RequestFactory()
         models.send_activation_mail(UserAdmin, factory.get('/'), get_user_model().objects.all())
+        self.assertTrue(len(mail.outbox) == 0)
+        self.assertEqual(1, send_queued_mails())
         self.assertTrue(len(mail.outbox) == 1)
         mail_message = str(mail.outbox[0].message())
         self.assert_(self.user_auth_token.activate_token in mail_message)
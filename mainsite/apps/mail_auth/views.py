@@ -1,8 +1,13 @@
+from django.http import Http404
 from django.shortcuts import render, get_object_or_404
 
+from mainsite.apps.participantdatabase import tokens
+
 
 def activate_view(request, token):
     import models
+    if not tokens.is_valid(token, models.ACTIVATE_SALT):
+        raise Http404
     user_auth_token = get_object_or_404(models.UserAuthToken, activate_token=token)
     user_auth_token.user.is_active = True
     user_auth_token.user.save()
@@ -1,5 +1,136 @@
-from django.contrib import admin
-from models import Participant
+from django.conf import settings
+from django.conf.urls import url
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.db.models import Case, Value, When
+from django.http import StreamingHttpResponse
+from django.shortcuts import redirect, render
 
+from exporting import export_csv
+from forms import ParticipantImportUploadForm, ParticipantFilterForm
+from importing import import_participants, read_rows
+from models import Participant, Suppression, hash_email, invalidate_count_cube
 
-admin.site.register(Participant)
+
+class ParticipantAdmin(admin.ModelAdmin):
+    change_list_template = 'admin/participantdatabase/participant/change_list.html'
+    list_display = ('email', 'year_of_birth', 'gender', 'handedness', 'vision',
+                    'is_localy_available', 'is_activated', 'created')
+    list_filter = ('is_activated', 'is_localy_available', 'gender', 'handedness',
+                   'vision', 'created')
+    # A prefix search can use the unique index on email.
+    search_fields = ('^email',)
+    # Counting all participants for every page view is slow on a large pool.
+    show_full_result_count = False
+    actions = ['activate', 'deactivate', 'toggle_localy_available', 'purge_never_activated']
+
+    def update_selected(self, request, queryset, message, **values):
+        number = queryset.update(**values)
+        invalidate_count_cube(Participant)
+        self.message_user(request, message.format(number))
+
+    def activate(self, request, queryset):
+        # Activating lifts an unsubscription, as activating a signup does.
+        Suppression.objects.resubscribe(queryset.values_list('email', flat=True))
+        self.update_selected(request, queryset, '{0} participants were activated.', is_activated=True)
+    activate.short_description = 'Activate selected participants'
+
+    def deactivate(self, request, queryset):
+        self.update_selected(request, queryset, '{0} participants were deactivated.', is_activated=False)
+    deactivate.short_description = 'Deactivate selected participants'
+
+    def toggle_localy_available(self, request, queryset):
+        self.update_selected(request, queryset, 'The local availability of {0} participants was toggled.',
+                             is_localy_available=Case(When(is_localy_available=True, then=Value(False)),
+                                                      default=Value(True)))
+    toggle_localy_available.short_description = 'Toggle local availability of selected participants'
+
+    def purge_never_activated(self, request, queryset):
+        days = getattr(settings, 'PURGE_UNACTIVATED_DAYS', 30)
+        never_activated = Participant.objects.never_activated(days)
+        number = Participant.objects.delete_all(queryset & never_activated)
+        self.message_user(request, '{0} participants that were not activated within {1} days were deleted.'
+                                   .format(number, days))
+    purge_never_activated.short_description = 'Delete selected participants that never activated'
+
+    def get_urls(self):
+        urls = [
+            url(r'^import/$', self.admin_site.admin_view(self.import_view),
+                name='participantdatabase_participant_import'),
+            url(r'^export/$', self.admin_site.admin_view(self.export_view),
+                name='participantdatabase_participant_export'),
+        ]
+        return urls + super(ParticipantAdmin, self).get_urls()
+
+    def import_view(self, request):
+        """
+        Import participants from an uploaded file, see import_participants.
+        """
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        if request.method == 'POST':
+            form = ParticipantImportUploadForm(request.POST, request.FILES)
+            if form.is_valid():
+                upload = form.cleaned_data['file']
+                file_format = 'jsonl' if upload.name.endswith(('.json', '.jsonl')) else 'csv'
+                result = import_participants(read_rows(upload, file_format),
+                                             base_url=request.build_absolute_uri('/'),
+                                             activate=form.cleaned_data['activate'])
+                message = ('{0} participants were imported, {1} duplicates, {2} suppressed addresses '
+                           'and {3} invalid rows were skipped.')
+                messages.add_message(request, messages.SUCCESS,
+                                     message.format(result.created, len(result.duplicates),
+                                                    len(result.suppressed), len(result.errors)))
+                for row_number, errors in result.errors[:20]:
+                    messages.add_message(request, messages.WARNING,
+                                         'Row {0}: {1}'.format(row_number, errors.as_text()))
+                return redirect('admin:participantdatabase_participant_changelist')
+        else:
+            form = ParticipantImportUploadForm()
+
+        return render(request, 'admin/participantdatabase/participant/import.html', {
+            'form': form,
+            'opts': self.model._meta,
+            'title': 'Import participants',
+        })
+
+    def export_view(self, request):
+        """
+        Stream a CSV file of the whole pool (scope=all) or of the participants
+        eligible for the criteria of a ParticipantFilterForm (scope=eligible).
+        Without a scope, the page asking for the criteria is shown.
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        scope = request.GET.get('scope')
+        form = ParticipantFilterForm(request.GET if scope == 'eligible' else None)
+        if scope == 'all':
+            participants = Participant.objects.all()
+        elif scope == 'eligible' and form.is_valid():
+            participants = Participant.objects.get_eligible(**form.cleaned_data)
+        else:
+            return render(request, 'admin/participantdatabase/participant/export.html', {
+                'form': form,
+                'opts': self.model._meta,
+                'title': 'Export participants',
+            })
+
+        response = StreamingHttpResponse(export_csv(participants), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="participants.csv"'
+        return response
+
+
+class SuppressionAdmin(admin.ModelAdmin):
+    list_display = ('email_hash', 'reason', 'created')
+    list_filter = ('reason',)
+    search_fields = ('email_hash',)
+
+    def get_search_results(self, request, queryset, search_term):
+        # Only hashes are stored, an address is looked up by its hash.
+        if '@' in search_term:
+            return queryset.filter(email_hash=hash_email(search_term)), False
+        return super(SuppressionAdmin, self).get_search_results(request, queryset, search_term)
+
+
+admin.site.register(Participant, ParticipantAdmin)
+admin.site.register(Suppression, SuppressionAdmin)
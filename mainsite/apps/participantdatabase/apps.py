@@ -0,0 +1,26 @@
+from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+
+class ParticipantDatabaseConfig(AppConfig):
+    name = 'mainsite.apps.participantdatabase'
+
+    def ready(self):
+        """
+        Connect the receivers configuring new SQLite connections and
+        invalidating the cached permissions of users.
+        """
+        from django.contrib.auth.models import Group, Permission, User
+        import db
+        import permissions
+
+        connection_created.connect(db.configure_sqlite)
+
+        m2m_changed.connect(permissions.invalidate_user_permissions, sender=User.user_permissions.through)
+        m2m_changed.connect(permissions.invalidate_user_permissions, sender=User.groups.through)
+        m2m_changed.connect(permissions.invalidate_permissions, sender=Group.permissions.through)
+        post_save.connect(permissions.invalidate_permissions, sender=Permission)
+        post_delete.connect(permissions.invalidate_permissions, sender=Permission)
+        post_delete.connect(permissions.invalidate_permissions, sender=Group)
+        post_delete.connect(permissions.invalidate_deleted_user, sender=User)
@@ -0,0 +1,501 @@
+import asynchat
+import asyncore
+import base64
+import collections
+import smtplib
+import socket
+import ssl
+import sys
+import time
+
+from django.conf import settings
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.message import sanitize_address
+from django.core.mail.utils import DNS_NAME
+
+import instrumentation
+
+
+class SMTPSession(asynchat.async_chat):
+    """
+    One non-blocking SMTP connection of a DeliveryEngine. Commands are
+    written as soon as they are issued if the server supports PIPELINING,
+    otherwise one at a time; replies are handed to the callbacks in the
+    order the commands were sent.
+    """
+
+    def __init__(self, engine):
+        asynchat.async_chat.__init__(self, map=engine.socket_map)
+        self.engine = engine
+        self.set_terminator('\r\n')
+        # Data of the current line and lines of the current reply.
+        self.reply_lines = []
+        self.reply_text = []
+        self.callbacks = collections.deque()
+        self.waiting = collections.deque()
+        self.extensions = set()
+        self.tls = False
+        self.handshaking = False
+        self.handshake_wants_write = False
+        self.ready = False
+        self.closed = False
+        self.message = None
+        self.messages_sent = 0
+        self.last_activity = time.time()
+        self.callbacks.append(self.greeting_reply)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((engine.host, engine.port))
+        except socket.error:
+            self.close()
+            raise
+
+    # Socket level
+
+    def handle_connect(self):
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def readable(self):
+        return self.handshaking or asynchat.async_chat.readable(self)
+
+    def writable(self):
+        if self.handshaking:
+            return self.handshake_wants_write
+        return asynchat.async_chat.writable(self)
+
+    def handle_read(self):
+        if self.handshaking:
+            return self.handshake()
+        asynchat.async_chat.handle_read(self)
+        # Decrypted data may be buffered where select does not see it.
+        while self.tls and not self.handshaking and not self.closed and self.socket.pending():
+            asynchat.async_chat.handle_read(self)
+
+    def handle_write(self):
+        if self.handshaking:
+            return self.handshake()
+        asynchat.async_chat.handle_write(self)
+
+    def recv(self, buffer_size):
+        if not self.tls:
+            return asynchat.async_chat.recv(self, buffer_size)
+        try:
+            data = self.socket.recv(buffer_size)
+        except ssl.SSLError as e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return ''
+            raise
+        if not data:
+            self.handle_close()
+        return data
+
+    def send(self, data):
+        if not self.tls:
+            return asynchat.async_chat.send(self, data)
+        try:
+            return self.socket.send(data)
+        except ssl.SSLError as e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return 0
+            raise
+
+    def start_tls(self):
+        self.del_channel()
+        sock = ssl.wrap_socket(self.socket, keyfile=self.engine.keyfile,
+                               certfile=self.engine.certfile,
+                               do_handshake_on_connect=False)
+        self.set_socket(sock, self.engine.socket_map)
+        self.tls = True
+        self.handshaking = True
+        self.handshake()
+
+    def handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError as e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                self.handshake_wants_write = e.args[0] == ssl.SSL_ERROR_WANT_WRITE
+                return
+            raise
+        self.handshaking = False
+        self.command('EHLO ' + self.engine.local_hostname, self.ehlo_reply)
+
+    def handle_close(self):
+        self.fail(smtplib.SMTPServerDisconnected('Connection unexpectedly closed'))
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        if not isinstance(error, (smtplib.SMTPException, socket.error)):
+            error = smtplib.SMTPException(repr(error))
+        self.fail(error)
+
+    def fail(self, error):
+        """
+        Close the session, failing the message in flight or, if the session
+        never got ready, reporting the error to the engine.
+        """
+        if self.closed:
+            # The server closed a session that was quitting.
+            self.close()
+            return
+        self.closed = True
+        self.close()
+        self.engine.session_closed(self, error, ready=self.ready or self.message is not None)
+        if self.message is not None:
+            message, self.message = self.message, None
+            self.engine.complete(message, error)
+
+    # Protocol
+
+    def command(self, line, callback):
+        # Like smtplib, addresses are sent as ASCII; asynchat would send the
+        # internal representation of a unicode string.
+        line = str(line)
+        self.callbacks.append(callback)
+        if 'PIPELINING' in self.extensions or len(self.callbacks) == 1:
+            self.push(line + '\r\n')
+        else:
+            self.waiting.append(line)
+
+    def collect_incoming_data(self, data):
+        self.reply_lines.append(data)
+
+    def found_terminator(self):
+        self.last_activity = time.time()
+        line, self.reply_lines = ''.join(self.reply_lines), []
+        self.reply_text.append(line[4:])
+        if line[3:4] == '-':
+            return
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        text, self.reply_text = '\n'.join(self.reply_text), []
+        callback = self.callbacks.popleft()
+        if self.waiting:
+            self.push(self.waiting.popleft() + '\r\n')
+        callback(code, text)
+
+    def greeting_reply(self, code, text):
+        if code != 220:
+            return self.fail(smtplib.SMTPConnectError(code, text))
+        self.command('EHLO ' + self.engine.local_hostname, self.ehlo_reply)
+
+    def ehlo_reply(self, code, text):
+        if code != 250:
+            return self.command('HELO ' + self.engine.local_hostname, self.helo_reply)
+        self.extensions = set(line.split(' ')[0].upper() for line in text.split('\n')[1:])
+        self.logged_in()
+
+    def helo_reply(self, code, text):
+        if code != 250:
+            return self.fail(smtplib.SMTPHeloError(code, text))
+        self.logged_in()
+
+    def logged_in(self):
+        if self.engine.use_tls and not self.tls:
+            if 'STARTTLS' not in self.extensions:
+                return self.fail(smtplib.SMTPException('STARTTLS extension not supported by server.'))
+            return self.command('STARTTLS', self.starttls_reply)
+        if self.engine.username and self.engine.password:
+            credentials = '\0{0}\0{1}'.format(self.engine.username, self.engine.password)
+            return self.command('AUTH PLAIN ' + base64.b64encode(credentials), self.auth_reply)
+        self.set_ready()
+
+    def starttls_reply(self, code, text):
+        if code != 220:
+            return self.fail(smtplib.SMTPResponseException(code, text))
+        self.extensions = set()
+        self.start_tls()
+
+    def auth_reply(self, code, text):
+        if code != 235:
+            return self.fail(smtplib.SMTPAuthenticationError(code, text))
+        self.set_ready()
+
+    def set_ready(self):
+        self.ready = True
+        self.engine.session_ready(self)
+
+    def send_message(self, message):
+        """
+        Start the transaction of a message given as a tuple (from address,
+        recipients, message string, tag).
+        """
+        self.message = message
+        self.last_activity = time.time()
+        from_addr, recipients, msg, tag = message
+        self.mail_reply = None
+        self.refused = {}
+        self.command('MAIL FROM:' + smtplib.quoteaddr(from_addr), self.on_mail_reply)
+        for recipient in recipients:
+            self.command('RCPT TO:' + smtplib.quoteaddr(recipient),
+                         lambda code, text, recipient=recipient: self.on_rcpt_reply(recipient, code, text))
+        self.command('DATA', self.on_data_reply)
+
+    def on_mail_reply(self, code, text):
+        self.mail_reply = (code, text)
+
+    def on_rcpt_reply(self, recipient, code, text):
+        if code not in (250, 251):
+            self.refused[recipient] = (code, text)
+
+    def on_data_reply(self, code, text):
+        from_addr, recipients, msg, tag = self.message
+        if code == 354 and (self.mail_reply[0] != 250 or len(self.refused) == len(recipients)):
+            # The server accepted DATA even though the transaction failed,
+            # terminate the empty message so it gets rejected.
+            self.push('.\r\n')
+            self.callbacks.append(lambda code, text: None)
+        if self.mail_reply[0] != 250:
+            return self.abort(smtplib.SMTPSenderRefused(self.mail_reply[0], self.mail_reply[1], from_addr))
+        if len(self.refused) == len(recipients):
+            return self.abort(smtplib.SMTPRecipientsRefused(self.refused))
+        if code != 354:
+            return self.abort(smtplib.SMTPDataError(code, text))
+        data = smtplib.quotedata(msg)
+        if data[-2:] != '\r\n':
+            data += '\r\n'
+        self.callbacks.append(self.on_end_reply)
+        self.push(data + '.\r\n')
+
+    def on_end_reply(self, code, text):
+        if code != 250:
+            return self.abort(smtplib.SMTPDataError(code, text))
+        self.messages_sent += 1
+        self.finish(None)
+
+    def abort(self, error):
+        self.command('RSET', lambda code, text: self.finish(error))
+
+    def finish(self, error):
+        message, self.message = self.message, None
+        self.engine.complete(message, error)
+        if self.messages_sent >= self.engine.max_messages:
+            self.quit()
+        else:
+            self.engine.session_ready(self)
+
+    def quit(self):
+        self.ready = False
+        self.closed = True
+        self.engine.session_closed(self, None, ready=True)
+        self.command('QUIT', lambda code, text: None)
+        self.close_when_done()
+
+
+class DeliveryEngine(object):
+    """
+    Sends mails over up to ``sessions`` SMTP connections at once, all driven
+    by an asyncore loop in the calling thread instead of a thread per
+    connection. Connections are reused for ``max_messages`` mails and
+    replaced afterwards.
+
+    A session sends one mail at a time, so at most ``sessions`` mails are in
+    flight; the next mail is only taken from the iterable passed to send
+    when a session is free, which keeps the number of rendered mails waiting
+    for the server bounded.
+    """
+
+    def __init__(self, host, port, username='', password='', use_tls=False,
+                 keyfile=None, certfile=None, sessions=10, max_messages=100,
+                 timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.keyfile = keyfile
+        self.certfile = certfile
+        self.sessions = sessions
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.local_hostname = DNS_NAME.get_fqdn()
+        self.socket_map = {}
+        # Sessions are kept in lists: asyncore dispatchers take their hash
+        # from their socket, which changes with STARTTLS.
+        self.open_sessions = []
+        self.idle = []
+        self.results = collections.deque()
+        self.setup_errors = collections.deque()
+
+    def session_ready(self, session):
+        self.idle.append(session)
+
+    def session_closed(self, session, error, ready):
+        if session in self.open_sessions:
+            self.open_sessions.remove(session)
+        if session in self.idle:
+            self.idle.remove(session)
+        if error is not None and not ready:
+            self.setup_errors.append(error)
+
+    def complete(self, message, error):
+        self.results.append((message[3], error))
+
+    def poll(self):
+        asyncore.loop(timeout=0.05, use_poll=True, map=self.socket_map, count=1)
+        self.expire()
+
+    def expire(self):
+        """
+        Fail sessions that waited too long for a reply and quit those that
+        were idle for too long.
+        """
+        now = time.time()
+        for session in list(self.open_sessions):
+            if now - session.last_activity <= self.timeout:
+                continue
+            if session in self.idle:
+                # The server may have dropped the connection by now.
+                session.quit()
+            else:
+                session.fail(socket.timeout('SMTP session timed out'))
+
+    def open_session(self):
+        try:
+            self.open_sessions.append(SMTPSession(self))
+        except socket.error as e:
+            self.setup_errors.append(e)
+
+    def send(self, messages, throttle=None):
+        """
+        Send the messages of the iterable, given as tuples (from address,
+        recipients, message string, tag), and yield a tuple (tag, error) for
+        each of them, error being None if the message was sent. If given,
+        throttle is called before each message is sent.
+        """
+        messages = iter(messages)
+        self.expire()
+        in_flight = 0
+        exhausted = False
+        while True:
+            while self.idle and not exhausted:
+                try:
+                    message = next(messages)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if throttle is not None:
+                    throttle()
+                self.idle.pop().send_message(message)
+                in_flight += 1
+            if not exhausted:
+                if self.setup_errors and not self.idle and in_flight == 0:
+                    # No session could be set up, fail a message so that
+                    # sending a batch to a broken server ends.
+                    try:
+                        message = next(messages)
+                    except StopIteration:
+                        exhausted = True
+                    else:
+                        in_flight += 1
+                        self.complete(message, self.setup_errors.popleft())
+                    self.setup_errors.clear()
+                elif not self.idle:
+                    for _ in range(self.sessions - len(self.open_sessions)):
+                        self.open_session()
+            while self.results:
+                in_flight -= 1
+                yield self.results.popleft()
+            if exhausted and in_flight == 0:
+                return
+            with instrumentation.timer('smtp'):
+                self.poll()
+
+    def close(self):
+        """
+        Quit all sessions and wait until the server acknowledged it.
+        """
+        for session in list(self.idle):
+            session.quit()
+        for session in list(self.open_sessions):
+            session.fail(smtplib.SMTPServerDisconnected('Engine closed'))
+        deadline = time.time() + self.timeout
+        while self.socket_map and time.time() < deadline:
+            asyncore.loop(timeout=0.05, use_poll=True, map=self.socket_map, count=1)
+        for channel in list(self.socket_map.values()):
+            channel.close()
+        self.setup_errors.clear()
+
+
+class EmailBackend(BaseEmailBackend):
+    """
+    Mail backend sending with a DeliveryEngine. It uses the EMAIL_* settings
+    like Django's SMTP backend; ASYNC_EMAIL_SESSIONS sets the number of
+    concurrent connections and EMAIL_POOL_MAX_MESSAGES the number of mails
+    sent over one connection.
+    """
+
+    def __init__(self, host=None, port=None, username=None, password=None,
+                 use_tls=None, fail_silently=False, sessions=None, **kwargs):
+        super(EmailBackend, self).__init__(fail_silently=fail_silently)
+        self.host = host or settings.EMAIL_HOST
+        self.port = port or settings.EMAIL_PORT
+        self.username = settings.EMAIL_HOST_USER if username is None else username
+        self.password = settings.EMAIL_HOST_PASSWORD if password is None else password
+        self.use_tls = settings.EMAIL_USE_TLS if use_tls is None else use_tls
+        self.sessions = sessions or getattr(settings, 'ASYNC_EMAIL_SESSIONS', 10)
+        self.engine = None
+
+    def open(self):
+        if self.engine is not None:
+            return False
+        self.engine = DeliveryEngine(self.host, self.port, self.username, self.password,
+                                     self.use_tls,
+                                     keyfile=getattr(settings, 'EMAIL_KEYFILE', None),
+                                     certfile=getattr(settings, 'EMAIL_CERTFILE', None),
+                                     sessions=self.sessions,
+                                     max_messages=getattr(settings, 'EMAIL_POOL_MAX_MESSAGES', 100))
+        return True
+
+    def close(self):
+        if self.engine is None:
+            return
+        engine, self.engine = self.engine, None
+        engine.close()
+
+    def prepare(self, email_messages, skipped):
+        """
+        Yield the messages in the form DeliveryEngine.send takes, appending
+        messages without recipients to skipped instead.
+        """
+        for email_message in email_messages:
+            if not email_message.recipients():
+                skipped.append(email_message)
+                continue
+            from_email = sanitize_address(email_message.from_email, email_message.encoding)
+            recipients = [sanitize_address(addr, email_message.encoding)
+                          for addr in email_message.recipients()]
+            yield from_email, recipients, email_message.message().as_string(), email_message
+
+    def send_batched(self, email_messages, batch_size=None, throttle=None):
+        """
+        Send the messages and yield a tuple (message, error) for each of them
+        like participantdatabase.smtp.PooledEmailBackend.send_batched. All
+        messages are spread over the sessions of the engine, so batch_size
+        is ignored. The results follow the order in which the deliveries
+        complete, not that of the messages. Messages without recipients are
+        not sent and yielded with an SMTPRecipientsRefused error.
+        """
+        skipped = []
+        new_engine = self.open()
+        try:
+            for result in self.engine.send(self.prepare(email_messages, skipped), throttle):
+                yield result
+        finally:
+            if new_engine:
+                self.close()
+        for email_message in skipped:
+            yield email_message, smtplib.SMTPRecipientsRefused({})
+
+    def send_messages(self, email_messages):
+        # Like Django's backends, messages without recipients are ignored.
+        email_messages = [email_message for email_message in email_messages if email_message.recipients()]
+        if not email_messages:
+            return 0
+        results = list(self.send_batched(email_messages))
+        errors = [error for message, error in results if error is not None]
+        if errors and not self.fail_silently:
+            raise errors[0]
+        return len(results) - len(errors)
@@ -0,0 +1,237 @@
+import datetime
+import random
+import time
+
+import django
+from django.contrib.auth.models import Permission, User
+from django.core import mail
+from django.core.urlresolvers import reverse
+from django.db import close_old_connections, connection
+from django.test.client import Client
+from django.test.utils import override_settings
+
+import instrumentation
+import smtp
+from mailing import send_queued_campaigns
+from models import Participant, Campaign, CampaignRecipient, DATE_PRECISION, hash_email, years_before
+from smtp_sink import SMTPSink
+
+
+# Share of participants per value, roughly that of a pool recruited at a
+# university.
+HANDEDNESS_WEIGHTS = ((Participant.RIGHTHANDED, 88), (Participant.LEFTHANDED, 10),
+                      (Participant.AMBIDEXTROUS, 2))
+VISION_WEIGHTS = ((Participant.NO_CORRECTED_VISION, 55), (Participant.GLASSES, 30),
+                  (Participant.CONTACT_LENSES, 15))
+ACTIVATED_SHARE = 0.85
+LOCALY_AVAILABLE_SHARE = 0.7
+
+# Criteria get_eligible is timed with, named for the report.
+FILTER_MATRIX = (
+    ('all', {}),
+    ('students', {'min_age': 18, 'max_age': 30}),
+    ('female students', {'min_age': 18, 'max_age': 30, 'genders': [Participant.FEMALE]}),
+    ('local', {'localy_available': True}),
+    ('local left handed', {'localy_available': True, 'handedness': [Participant.LEFTHANDED]}),
+    ('older normal vision', {'min_age': 50, 'vision': [Participant.NO_CORRECTED_VISION]}),
+    ('students by date', {'min_age': 18, 'max_age': 30, 'age_precision': DATE_PRECISION}),
+    ('everything', {'min_age': 20, 'max_age': 60, 'localy_available': True,
+                    'genders': [Participant.MALE], 'handedness': [Participant.RIGHTHANDED],
+                    'vision': [Participant.GLASSES, Participant.CONTACT_LENSES]}),
+)
+
+
+def weighted_choice(rng, weights):
+    value = rng.uniform(0, sum(weight for choice, weight in weights))
+    for choice, weight in weights:
+        value -= weight
+        if value <= 0:
+            return choice
+    return weights[-1][0]
+
+
+def birth_date(rng, today):
+    # Most participants are students, the rest is spread over working age.
+    if rng.random() < 0.7:
+        age = int(rng.triangular(18, 30, 20))
+    else:
+        age = rng.randint(30, 80)
+    return years_before(today, age) - datetime.timedelta(days=rng.randint(0, 364))
+
+
+def generate_pool(size, seed=0, chunk_size=5000):
+    """
+    Replace all participants by size synthetic participants, drawn with the
+    given random seed so that pools of the same size are identical.
+    """
+    Participant.objects.delete_all(Participant.objects.all())
+    rng = random.Random(seed)
+    today = datetime.date.today()
+    for start in range(0, size, chunk_size):
+        participants = [Participant(email='participant{0}@example.org'.format(i),
+                                    date_of_birth=birth_date(rng, today),
+                                    gender=rng.choice([Participant.MALE, Participant.FEMALE]),
+                                    handedness=weighted_choice(rng, HANDEDNESS_WEIGHTS),
+                                    vision=weighted_choice(rng, VISION_WEIGHTS),
+                                    is_localy_available=rng.random() < LOCALY_AVAILABLE_SHARE,
+                                    is_activated=rng.random() < ACTIVATED_SHARE)
+                        for i in range(start, min(start + chunk_size, size))]
+        for participant in participants:
+            participant.year_of_birth = participant.date_of_birth.year
+            participant.email_hash = hash_email(participant.email)
+        Participant.objects.assign_tokens(participants)
+        Participant.objects.bulk_create(participants)
+
+
+def explain(queryset):
+    """
+    Return the query plan of the queryset as a string, for SQLite and MySQL.
+    """
+    sql, params = queryset.query.sql_with_params()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    return ' | '.join(' '.join(unicode(column) for column in row) for row in cursor.fetchall())
+
+
+def time_eligible(criteria, repeat):
+    """
+    Fetch the keys of the participants eligible for the criteria repeat
+    times and return a dictionary with the number of rows, the best and the
+    median time and the query plan.
+    """
+    queryset = Participant.objects.get_eligible(**criteria)
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        rows = len(list(queryset.values_list('pk', flat=True)))
+        timings.append(time.time() - start)
+    timings.sort()
+    return {'rows': rows,
+            'best_seconds': timings[0],
+            'median_seconds': timings[len(timings) // 2],
+            'plan': explain(queryset)}
+
+
+def time_send_message(client, **backend_settings):
+    """
+    Queue a campaign to all eligible participants with the send_message view
+    and deliver it using the given mail settings. Return a dictionary with
+    the timings of both steps.
+    """
+    post_data = {'contact_address': 'benchmark@example.org',
+                 'message_subject': 'Benchmark',
+                 'message_text': 'Benchmark\n\nText',
+                 'genders': [Participant.MALE, Participant.FEMALE],
+                 'handedness': [choice for choice, label in Participant.HANDEDNESS_CHOICES],
+                 'vision': [choice for choice, label in Participant.VISION_CHOICES]}
+    with override_settings(**backend_settings):
+        start = time.time()
+        client.post(reverse('sendmessage'), post_data)
+        queued = time.time()
+        number_sent = send_queued_campaigns()
+        delivered = time.time()
+    mail.outbox = []
+    CampaignRecipient.objects.all().delete()
+    Campaign.objects.all().delete()
+    return {'recipients': number_sent,
+            'view_seconds': queued - start,
+            'delivery_seconds': delivered - queued,
+            'mails_per_second': number_sent / (delivered - queued) if number_sent else None}
+
+
+def benchmark_client():
+    """
+    Return a client logged in as a user that may send messages.
+    """
+    user = User.objects.create_user('benchmark', 'benchmark@example.org', 'benchmark')
+    user.user_permissions.add(Permission.objects.get(codename='send_mails_to'))
+    client = Client()
+    client.login(username='benchmark', password='benchmark')
+    return client
+
+
+def run_benchmarks(sizes, repeat=5, send_max=10000, latency=0, seed=0, log=None):
+    """
+    Run the benchmarks for pools of the given sizes and return the results
+    as a dictionary that can be dumped as JSON.
+
+    For every pool get_eligible is timed for the criteria of FILTER_MATRIX.
+    For pools of at most send_max participants a campaign to all activated
+    participants is also queued and delivered, once with the locmem backend
+    and once over SMTP to a local sink answering after latency seconds.
+    log, if given, is called with a line of text about the progress.
+    """
+    results = {'django': django.get_version(),
+               'database': connection.vendor,
+               'seed': seed,
+               'pools': []}
+    client = benchmark_client()
+    sink = SMTPSink(latency=latency)
+    sink.start()
+    try:
+        for size in sizes:
+            if log:
+                log('Generating {0} participants'.format(size))
+            start = time.time()
+            generate_pool(size, seed)
+            pool = {'size': size, 'generate_seconds': time.time() - start, 'queries': [], 'send': []}
+            for name, criteria in FILTER_MATRIX:
+                timing = time_eligible(criteria, repeat)
+                timing.update(name=name, criteria=criteria)
+                pool['queries'].append(timing)
+            if size <= send_max:
+                if log:
+                    log('Sending to {0} participants'.format(size))
+                timing = time_send_message(client, EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+                pool['send'].append(dict(timing, backend='locmem'))
+                smtp.clear_pools()
+                timing = time_send_message(client,
+                                           EMAIL_BACKEND='mainsite.apps.participantdatabase.smtp.EmailBackend',
+                                           EMAIL_HOST=sink.host, EMAIL_PORT=sink.port,
+                                           EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='',
+                                           EMAIL_USE_TLS=False)
+                smtp.clear_pools()
+                pool['send'].append(dict(timing, backend='smtp'))
+            results['pools'].append(pool)
+    finally:
+        sink.stop()
+    return results
+
+
+def time_token_endpoints(requests, conn_max_age, **extra_settings):
+    """
+    Activate and then unsubscribe requests new participants through the
+    public token views with the given CONN_MAX_AGE and settings, closing
+    database connections before and after each request like the WSGI
+    handler does. Return a dictionary with the p50 and p95 latency of both
+    views in seconds.
+    """
+    participants = [Participant(email='endpoint{0}@example.org'.format(i),
+                                email_hash=hash_email('endpoint{0}@example.org'.format(i)))
+                    for i in range(requests)]
+    Participant.objects.assign_tokens(participants)
+    Participant.objects.bulk_create(participants)
+    client = Client()
+    old_conn_max_age = connection.settings_dict['CONN_MAX_AGE']
+    connection.settings_dict['CONN_MAX_AGE'] = conn_max_age
+    connection.close()
+    results = {'conn_max_age': conn_max_age, 'requests': requests}
+    try:
+        with override_settings(**extra_settings):
+            for url_name, token_field in (('activate', 'activate_token'),
+                                          ('unsubscribe', 'unsubscribe_token')):
+                timings = []
+                for participant in participants:
+                    url = reverse(url_name, args=[getattr(participant, token_field)])
+                    start = time.time()
+                    close_old_connections()
+                    client.get(url)
+                    close_old_connections()
+                    timings.append(time.time() - start)
+                results[url_name] = {'p50_seconds': instrumentation.percentile(timings, 0.5),
+                                     'p95_seconds': instrumentation.percentile(timings, 0.95)}
+    finally:
+        connection.settings_dict['CONN_MAX_AGE'] = old_conn_max_age
+        connection.close()
+    return results
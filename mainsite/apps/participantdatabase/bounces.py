@@ -0,0 +1,54 @@
+import mailbox
+
+from models import Suppression
+
+
+def is_delivery_status_notification(message):
+    return (message.get_content_type() == 'multipart/report' and
+            message.get_param('report-type') == 'delivery-status')
+
+
+def hard_bounces(message):
+    """
+    Return the recipients a delivery status notification (RFC 3464) reports
+    as permanently failed, or an empty list if the message is no DSN.
+    """
+    if not is_delivery_status_notification(message):
+        return []
+    recipients = []
+    for part in message.walk():
+        if part.get_content_type() != 'message/delivery-status':
+            continue
+        # A block of fields about the message, then one per recipient.
+        for fields in part.get_payload():
+            recipient = fields.get('Final-Recipient') or fields.get('Original-Recipient')
+            action = (fields.get('Action') or '').strip().lower()
+            status = (fields.get('Status') or '').strip()
+            if recipient and action == 'failed' and status.startswith('5'):
+                address_type, _, address = recipient.partition(';')
+                recipients.append(address.strip())
+    return recipients
+
+
+def process_maildir(path, remove=True):
+    """
+    Put the addresses the delivery status notifications in the maildir at
+    path report as permanently failed on the suppression list. Return the
+    number of notifications read and of addresses added to the list.
+
+    The notifications are removed from the maildir unless remove is False;
+    other messages are left alone.
+    """
+    maildir = mailbox.Maildir(path, factory=None, create=False)
+    reports = []
+    addresses = set()
+    for key, message in maildir.iteritems():
+        if not is_delivery_status_notification(message):
+            continue
+        reports.append(key)
+        addresses.update(hard_bounces(message))
+    added = Suppression.objects.suppress(addresses, Suppression.BOUNCED)
+    if remove:
+        for key in reports:
+            maildir.remove(key)
+    return len(reports), added
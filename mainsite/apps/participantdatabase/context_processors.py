@@ -1,5 +1,33 @@
 from django.conf import settings
+from django.contrib.auth.context_processors import PermLookupDict, PermWrapper
+
+import permissions
 
 
 def add_contact_email(request):
-    return {'contact_email': settings.CONTACT_EMAIL}
\ No newline at end of file
+    return {'contact_email': settings.CONTACT_EMAIL}
+
+
+class CachedPermLookupDict(PermLookupDict):
+
+    def __getitem__(self, perm_name):
+        return permissions.has_perm(self.user, '{0}.{1}'.format(self.app_label, perm_name))
+
+    def __bool__(self):
+        return permissions.has_module_perms(self.user, self.app_label)
+
+
+class CachedPermWrapper(PermWrapper):
+
+    def __getitem__(self, app_label):
+        return CachedPermLookupDict(self.user, app_label)
+
+
+def cached_perms(request):
+    """
+    Replace the perms of django.contrib.auth.context_processors.auth by one
+    that looks the permissions up in the cache, see permissions.
+    """
+    if not hasattr(request, 'user'):
+        return {}
+    return {'perms': CachedPermWrapper(request.user)}
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.db import connections
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    Apply the SQLITE_PRAGMAS to every new SQLite connection, connected to
+    connection_created by ParticipantDatabaseConfig.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    for name, value in getattr(settings, 'SQLITE_PRAGMAS', ()):
+        # Straight on the driver connection, pragmas are no queries of the
+        # request.
+        connection.connection.execute('PRAGMA {0} = {1}'.format(name, value))
+
+
+def check_connections():
+    """
+    Close the database connections that are older than their CONN_MAX_AGE
+    or no longer usable, for example because the server dropped them while
+    idle, so that the next query opens a new connection.
+
+    Django does this when a request starts and ends. Long running commands,
+    like the mail sender, call this between their units of work.
+    """
+    for connection in connections.all():
+        connection.close_if_unusable_or_obsolete()
+        if connection.connection is not None and not connection.is_usable():
+            connection.close()
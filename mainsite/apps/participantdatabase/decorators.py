@@ -1,17 +1,24 @@
+import hashlib
+import time
+
+from django.conf import settings
 from django.contrib import messages
-from django.shortcuts import redirect
+from django.core.cache import caches
+from django.shortcuts import redirect, render
+
+import permissions
 
 
 def permision_required_or_message(perm, redirect_url):
     """
     Decorator for views that checks whether a user has a particular permission
-    enabled, redirecting to the given url and displaying a message.
-    
+    enabled, redirecting to the given url and displaying a message. The
+    permissions of the user are looked up in the cache, see permissions.
     """
     def _wrapped_decorator(view):
-        def _wraped_view(request):
-            if request.user.has_perm(perm):
-                return view(request)
+        def _wraped_view(request, *args, **kwargs):
+            if permissions.has_perm(request.user, perm):
+                return view(request, *args, **kwargs)
             else:
                 message = 'You account has not been enabled.'
                 message+= ' Please await admin approval.'
@@ -19,4 +26,81 @@ def permision_required_or_message(perm, redirect_url):
                 return redirect(redirect_url)
         return _wraped_view
     return _wrapped_decorator
-                
\ No newline at end of file
+                
+
+
+def client_ip(request):
+    """
+    Return the address of the client that sent the request. Requests from
+    one of the TRUSTED_PROXIES carry the client address in the
+    X-Forwarded-For header, to which every proxy appends the address it got
+    the request from. The header is read from the right, past the trusted
+    proxies, so addresses a client puts in the header itself are ignored.
+    """
+    trusted_proxies = getattr(settings, 'TRUSTED_PROXIES', ())
+    address = request.META.get('REMOTE_ADDR', '')
+    if address not in trusted_proxies:
+        return address
+    forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')
+    for forwarded_address in reversed([value.strip() for value in forwarded_for if value.strip()]):
+        address = forwarded_address
+        if address not in trusted_proxies:
+            break
+    return address
+
+
+def email_domain(request):
+    """
+    Return the domain of the email address of the request, or None for the
+    SIGNUP_RATE_LIMIT_EXEMPT_DOMAINS and their subdomains.
+    """
+    domain = request.POST.get('email', '').rpartition('@')[2].strip().lower()
+    for exempt_domain in getattr(settings, 'SIGNUP_RATE_LIMIT_EXEMPT_DOMAINS', ()):
+        exempt_domain = exempt_domain.lower()
+        if domain == exempt_domain or domain.endswith('.' + exempt_domain):
+            return None
+    return domain
+
+
+def take_token(key, capacity, period):
+    """
+    Take a token from the bucket stored under key in the RATE_LIMIT_CACHE
+    and return whether there was one. A bucket holds up to capacity tokens
+    and regains capacity tokens every period seconds.
+
+    The buckets live in the cache, so whether processes share them depends
+    on the cache backend; use a file based or database cache to limit all
+    processes on the host together. Reading and writing a bucket is not
+    atomic, concurrent requests may take the same token.
+    """
+    cache = caches[getattr(settings, 'RATE_LIMIT_CACHE', 'default')]
+    now = time.time()
+    tokens, updated = cache.get(key, (capacity, now))
+    tokens = min(capacity, tokens + (now - updated) * capacity / float(period))
+    if tokens < 1:
+        return False
+    cache.set(key, (tokens - 1, now), period)
+    return True
+
+
+def rate_limited(key_function, limit_setting):
+    """
+    Decorator for views that limits the POST requests per key, as returned
+    by key_function for the request, to the limit given by the setting named
+    limit_setting: a tuple (number of requests, seconds), or None for no
+    limit. Requests for which key_function returns None are not limited.
+    Requests over the limit are answered with status 429 before the view
+    does any work.
+    """
+    def _wrapped_decorator(view):
+        def _wraped_view(request, *args, **kwargs):
+            limit = getattr(settings, limit_setting, None)
+            key = key_function(request) if limit is not None and request.method == 'POST' else None
+            if key is not None:
+                key = 'ratelimit.{0}.{1}'.format(limit_setting, hashlib.md5(key.encode('utf-8')).hexdigest())
+                if not take_token(key, *limit):
+                    message = 'Too many requests, please try again later.'
+                    return render(request, 'info_message.html', {'message': message}, status=429)
+            return view(request, *args, **kwargs)
+        return _wraped_view
+    return _wrapped_decorator
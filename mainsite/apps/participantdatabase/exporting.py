@@ -0,0 +1,38 @@
+import csv
+
+from models import Participant, iterate_values
+
+
+EXPORT_FIELDS = ('email', 'year_of_birth', 'date_of_birth', 'gender', 'handedness', 'vision',
+                 'is_localy_available', 'is_activated')
+
+
+class Echo(object):
+    """
+    File-like object handing back what is written to it, so that csv.writer
+    can produce single lines for a streaming response.
+    """
+
+    def write(self, value):
+        return value
+
+
+def export_rows(queryset, chunk_size=1000):
+    """
+    Yield the header and a row for every participant of the queryset, with
+    choices given by name. The result can be read by import_participants.
+    """
+    choices = [dict(Participant._meta.get_field(field).choices) for field in EXPORT_FIELDS]
+    yield EXPORT_FIELDS
+    for values in iterate_values(queryset, EXPORT_FIELDS, chunk_size):
+        yield [field_choices.get(value, value) for field_choices, value in zip(choices, values)]
+
+
+def export_csv(queryset, chunk_size=1000):
+    """
+    Yield the lines of a CSV file of the participants of the queryset. Empty
+    values, like unknown dates of birth, are written as empty strings.
+    """
+    writer = csv.writer(Echo())
+    for row in export_rows(queryset, chunk_size):
+        yield writer.writerow(['' if value is None else unicode(value).encode('utf-8') for value in row])
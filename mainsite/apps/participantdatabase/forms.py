@@ -1,8 +1,8 @@
 from django.forms import ModelForm, Form
-from models import Participant
+from models import Participant, AGE_PRECISION_CHOICES, YEAR_PRECISION, hash_email
 from django.forms.fields import IntegerField, BooleanField,\
-    MultipleChoiceField, EmailField, CharField
-from django.forms.widgets import CheckboxSelectMultiple, Textarea
+    MultipleChoiceField, EmailField, CharField, FileField, ChoiceField
+from django.forms.widgets import CheckboxSelectMultiple, Textarea, RadioSelect
 
 
 class ParticipantForm(ModelForm):
@@ -15,6 +15,30 @@ class ParticipantForm(ModelForm):
                                        label='Available for experiments in St Andrews'
                                        )
 
+    def validate_unique(self):
+        """
+        Also reject addresses that only differ in case from a participant's.
+        """
+        super(ParticipantForm, self).validate_unique()
+        email = self.cleaned_data.get('email')
+        if email and 'email' not in self._errors:
+            others = Participant.objects.filter(email_hash=hash_email(email)).exclude(pk=self.instance.pk)
+            if others.exists():
+                self.add_error('email', 'Participant with this Email already exists.')
+
+
+class ParticipantImportForm(ParticipantForm):
+    """
+    A variant of the ParticipantForm used to validate imported rows. Whether
+    the email address is taken is checked for many rows at once by the
+    importer, so the form does not query for it.
+    """
+
+    is_localy_available = BooleanField(required=False)
+
+    def validate_unique(self):
+        pass
+
 
 class PublicParticipantForm(ParticipantForm):
     """
@@ -30,9 +54,9 @@ class PublicParticipantForm(ParticipantForm):
                                             error_messages={'required': privacy_error})
 
 
-class ParticipantSearchForm(Form):
+class ParticipantFilterForm(Form):
     """
-    Form asking for all the data needed to collect relevant participants.
+    Form asking for the criteria participants have to match.
     """
 
     min_age = IntegerField(99, 0, required=False)
@@ -54,6 +78,30 @@ class ParticipantSearchForm(Form):
                                           Participant.GLASSES,
                                           Participant.CONTACT_LENSES])
     localy_available = BooleanField(required=False, label="Participant has to attend experiment personally in St Andrews")
+    age_precision = ChoiceField(choices=AGE_PRECISION_CHOICES,
+                                widget=RadioSelect,
+                                required=False,
+                                initial=YEAR_PRECISION,
+                                label='Compare ages by',
+                                help_text='Participants that only gave their year of birth '
+                                          'are compared by year.')
+
+
+class ParticipantSearchForm(ParticipantFilterForm):
+    """
+    Form asking for all the data needed to collect relevant participants.
+    """
+
     contact_address = EmailField()
     message_subject = CharField()
     message_text = CharField(widget=Textarea)
+
+
+class ParticipantImportUploadForm(Form):
+    """
+    Form for uploading a file of participants to import.
+    """
+
+    file = FileField(help_text='A CSV file with a header line, or a file with one JSON object per line.')
+    activate = BooleanField(required=False,
+                            label='Mark the participants as activated instead of sending activation mails')
@@ -0,0 +1,163 @@
+import csv
+import json
+
+from django.core.exceptions import NON_FIELD_ERRORS
+from django.db import transaction
+from django.forms.utils import ErrorDict, ErrorList
+
+from forms import ParticipantImportForm
+from mailing import queue_activation_mail
+from models import Participant, OutgoingMail, Suppression, hash_email, invalidate_count_cube
+
+
+CHOICE_FIELDS = {'gender': Participant.GENDER_CHOICES,
+                 'handedness': Participant.HANDEDNESS_CHOICES,
+                 'vision': Participant.VISION_CHOICES,
+                 }
+
+
+class ImportResult(object):
+    """
+    Outcome of an import: the number of participants created, and lists of
+    (row number, email) for duplicate and suppressed addresses and (row
+    number, errors) for invalid rows.
+    """
+
+    def __init__(self):
+        self.created = 0
+        self.duplicates = []
+        self.suppressed = []
+        self.errors = []
+
+
+class UnreadableRow(object):
+    """
+    Stands in for a row of the file that could not be read, with the errors
+    in the form of ParticipantImportForm.errors.
+    """
+
+    def __init__(self, message):
+        self.errors = ErrorDict({NON_FIELD_ERRORS: ErrorList([message])})
+
+
+def read_rows(lines, file_format='csv'):
+    """
+    Yield a dictionary for every row of the given lines, which are either a
+    UTF-8 encoded CSV file with a header line (file_format 'csv') or one
+    JSON object per line (file_format 'jsonl'). Rows that cannot be read
+    are yielded as UnreadableRow, so the other rows are still imported.
+    """
+    if file_format == 'csv':
+        rows = csv.DictReader(lines)
+        while True:
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                yield UnreadableRow('The row is not valid CSV: {0}'.format(e))
+                continue
+            try:
+                yield dict((key.strip(), (value or '').decode('utf-8').strip())
+                           for key, value in row.items() if key)
+            except UnicodeDecodeError:
+                yield UnreadableRow('The row is not UTF-8 encoded.')
+    else:
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                # Also raised for lines that are not UTF-8 encoded.
+                yield UnreadableRow('The line is not valid JSON: {0}'.format(e))
+                continue
+            if isinstance(row, dict):
+                yield row
+            else:
+                yield UnreadableRow('The line is not a JSON object.')
+
+
+def clean_row(row):
+    """
+    Return the row as data for a ParticipantImportForm. Choices may be given
+    by label (e.g. 'female') as well as by value, and participants are
+    available locally unless stated otherwise.
+    """
+    data = dict(row)
+    for field, choices in CHOICE_FIELDS.items():
+        labels = dict((label, value) for value, label in choices)
+        value = data.get(field)
+        if isinstance(value, basestring) and value.lower() in labels:
+            data[field] = labels[value.lower()]
+    data.setdefault('is_localy_available', True)
+    return data
+
+
+def import_participants(rows, base_url=None, activate=False, chunk_size=500):
+    """
+    Create participants from the given rows and return an ImportResult.
+
+    Rows are validated with the rules of the ParticipantForm and inserted
+    with one bulk insert per chunk of rows; addresses that already exist,
+    in the database or earlier in the rows, are skipped regardless of case,
+    as are addresses on the suppression list. Unless activate is True an
+    activation mail is queued for every new participant, which requires the
+    absolute url of the site as base_url.
+    """
+    if not activate and base_url is None:
+        raise ValueError('base_url is required to queue activation mails.')
+    result = ImportResult()
+    seen = set()
+    chunk = []
+    for row_number, row in enumerate(rows, 1):
+        chunk.append((row_number, row))
+        if len(chunk) >= chunk_size:
+            _import_chunk(chunk, result, seen, base_url, activate)
+            chunk = []
+    if chunk:
+        _import_chunk(chunk, result, seen, base_url, activate)
+    invalidate_count_cube(Participant)
+    return result
+
+
+def _import_chunk(chunk, result, seen, base_url, activate):
+    candidates = []
+    for row_number, row in chunk:
+        if isinstance(row, UnreadableRow):
+            result.errors.append((row_number, row.errors))
+            continue
+        form = ParticipantImportForm(clean_row(row))
+        if not form.is_valid():
+            result.errors.append((row_number, form.errors))
+            continue
+        participant = form.save(commit=False)
+        participant.email_hash = hash_email(participant.email)
+        if participant.email_hash in seen:
+            result.duplicates.append((row_number, participant.email))
+            continue
+        seen.add(participant.email_hash)
+        candidates.append((row_number, participant))
+
+    hashes = [candidate.email_hash for row_number, candidate in candidates]
+    existing = set(Participant.objects.filter(email_hash__in=hashes).values_list('email_hash', flat=True))
+    suppressed = set(Suppression.objects.filter(email_hash__in=hashes).values_list('email_hash', flat=True))
+    participants = []
+    for row_number, participant in candidates:
+        if participant.email_hash in existing:
+            result.duplicates.append((row_number, participant.email))
+            continue
+        if participant.email_hash in suppressed:
+            result.suppressed.append((row_number, participant.email))
+            continue
+        participant.is_activated = activate
+        participant.fill_date_of_birth()
+        participants.append(participant)
+    Participant.objects.assign_tokens(participants)
+
+    with transaction.atomic():
+        Participant.objects.bulk_create(participants)
+        if not activate:
+            OutgoingMail.objects.bulk_create([queue_activation_mail(new_participant, base_url, save=False)
+                                              for new_participant in participants])
+    result.created += len(participants)
@@ -0,0 +1,107 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+SAMPLES_CACHE_KEY = 'participantdatabase.performance.{0}'
+URL_NAMES_CACHE_KEY = 'participantdatabase.performance.url_names'
+
+# Timings recorded while handling a request, in seconds, kept per thread.
+_local = threading.local()
+
+
+def start():
+    """
+    Start collecting timings in the current thread.
+    """
+    _local.timings = {}
+    _local.depth = {}
+
+
+def stop():
+    """
+    Stop collecting timings in the current thread and return them, as a
+    dictionary mapping the kind of work to the seconds spent on it.
+    """
+    timings = getattr(_local, 'timings', None) or {}
+    _local.timings = None
+    return timings
+
+
+def add(kind, seconds):
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings[kind] = timings.get(kind, 0) + seconds
+
+
+@contextmanager
+def timer(kind):
+    """
+    Add the time spent in the with block to the timings of the given kind.
+    Nested blocks of the same kind are only counted once.
+    """
+    depth = getattr(_local, 'depth', None)
+    if getattr(_local, 'timings', None) is None or depth.get(kind):
+        yield
+        return
+    depth[kind] = 1
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        depth[kind] = 0
+        add(kind, time.time() - start_time)
+
+
+def record_sample(url_name, sample):
+    """
+    Store the measurements of a request (a dictionary of numbers) among the
+    latest PERFORMANCE_SAMPLES samples of its url name. The samples are kept
+    in the cache, so processes sharing a cache share them; samples of
+    concurrent requests may overwrite each other.
+    """
+    key = SAMPLES_CACHE_KEY.format(url_name)
+    samples = cache.get(key, [])
+    samples.append(sample)
+    cache.set(key, samples[-getattr(settings, 'PERFORMANCE_SAMPLES', 500):], None)
+    url_names = cache.get(URL_NAMES_CACHE_KEY, set())
+    if url_name not in url_names:
+        url_names.add(url_name)
+        cache.set(URL_NAMES_CACHE_KEY, url_names, None)
+
+
+def percentile(values, fraction):
+    """
+    Return the value below which the given fraction of the values lie,
+    using the nearest rank.
+
+    >>> percentile([4, 1, 3, 2], 0.5), percentile(range(1, 101), 0.95)
+    (2, 95)
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(math.ceil(fraction * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def summary():
+    """
+    Return a list with a dictionary for every url name, holding the number
+    of samples and the p50 and p95 of every measurement.
+    """
+    rows = []
+    for url_name in sorted(cache.get(URL_NAMES_CACHE_KEY, set())):
+        samples = cache.get(SAMPLES_CACHE_KEY.format(url_name), [])
+        if not samples:
+            continue
+        row = {'url_name': url_name, 'count': len(samples)}
+        for field in samples[0]:
+            values = [sample[field] for sample in samples]
+            row[field] = {'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95)}
+        rows.append(row)
+    return rows
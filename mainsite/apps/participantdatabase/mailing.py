@@ -0,0 +1,510 @@
+import Queue
+import datetime
+import json
+import smtplib
+import socket
+import threading
+import time
+import urlparse
+import uuid
+
+from django.conf import settings
+from django.core import mail
+from django.core.mail import get_connection
+from django.core.urlresolvers import reverse
+from django.db.models import F, Q
+from django.template.context import Context
+from django.template.loader import get_template
+from django.utils import timezone
+from django.utils.html import escape
+
+from models import Campaign, CampaignRecipient, Delivery, OutgoingMail, Suppression, hash_email
+import smtp
+
+
+def plain_text_to_html(text):
+    paragraphs = []
+    line_buffer = []
+    for line in text.splitlines():
+        if line:
+            line_buffer.append(escape(line))
+        else:
+            paragraphs.append(u'<br>'.join(line_buffer))
+            line_buffer = []
+    paragraphs.append(u'<br>'.join(line_buffer))
+    template = u'<p>{0}</p>'
+    return u'\n'.join([template.format(paragraph) for paragraph in paragraphs])
+
+
+def enqueue_campaign(subject, message, reply_to, recipients, base_url,
+                     created_by=None, chunk_size=500):
+    """
+    Create a Campaign and one pending CampaignRecipient for every recipient.
+    Nothing is sent; the campaign is picked up by the ``send_mail_queue``
+    management command.
+
+    Keyword arguments:
+    subject -- subject of the invitation, including the mail prefix
+    message -- plain text body of the invitation
+    reply_to -- address replies to the invitation should go to
+    recipients -- iterable of (email, unsubscribe_token) tuples, such as
+                  returned by ParticipantManager.stream_eligible
+    base_url -- absolute url of the site, used to build unsubscribe links
+    created_by -- user that requested the campaign
+    chunk_size -- number of recipients inserted per query
+    """
+    campaign = Campaign.objects.create(subject=subject, message=message,
+                                       reply_to=reply_to, base_url=base_url,
+                                       created_by=created_by)
+    timings = {}
+    chunk = []
+    for email, unsubscribe_token in timed(recipients, timings, 'query'):
+        chunk.append(CampaignRecipient(campaign=campaign, email=email, email_hash=hash_email(email),
+                                       unsubscribe_token=unsubscribe_token))
+        if len(chunk) >= chunk_size:
+            CampaignRecipient.objects.bulk_create(chunk)
+            chunk = []
+    if chunk:
+        CampaignRecipient.objects.bulk_create(chunk)
+    campaign.query_seconds = timings.get('query', 0)
+    campaign.save(update_fields=['query_seconds'])
+    return campaign
+
+
+def timed(iterable, timings, kind):
+    """
+    Yield the items of the iterable, adding the seconds spent waiting for
+    them to timings[kind].
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            item = next(iterator)
+        finally:
+            timings[kind] = timings.get(kind, 0) + time.time() - start
+        yield item
+
+
+def render_invitation(campaign, unsubscribe_url):
+    """
+    Return the text and html content of the invitation of the given campaign.
+    """
+    text_mail_template = get_template('emails/experiment_invitation.txt')
+    html_mail_template = get_template('emails/experiment_invitation.html')
+
+    text_context = Context({'message': campaign.message,
+                            'unsubscribe_url': unsubscribe_url,
+                            'contact_email': settings.CONTACT_EMAIL,
+                            'message_title': campaign.subject,
+    })
+    html_context = Context({'message': plain_text_to_html(campaign.message),
+                            'unsubscribe_url': unsubscribe_url,
+                            'contact_email': settings.CONTACT_EMAIL,
+                            'message_title': campaign.subject,
+    })
+    return text_mail_template.render(text_context), html_mail_template.render(html_context)
+
+
+class InvitationRenderer(object):
+    """
+    Renders the invitation of a campaign once and produces the content for
+    each recipient by substituting the recipient's unsubscribe token, which
+    is the only part of the mail that differs between recipients.
+
+    >>> campaign = Campaign(subject='Subject', message='Text', base_url='http://testserver/')
+    >>> renderer = InvitationRenderer(campaign)
+    >>> renderer.render('12ab') == render_invitation(campaign, 'http://testserver/unsubscribe/12ab/')
+    True
+    """
+
+    def __init__(self, campaign):
+        # A random placeholder cannot clash with the text of the message.
+        self.placeholder = uuid.uuid4().hex
+        url = reverse('unsubscribe', kwargs={'token': self.placeholder})
+        url = urlparse.urljoin(campaign.base_url, url)
+        self.text_content, self.html_content = render_invitation(campaign, url)
+
+    def render(self, unsubscribe_token):
+        """
+        Return the text and html content of the invitation for the recipient
+        with the given unsubscribe token.
+        """
+        # Both templates escape the url, so the token is escaped as well.
+        token = escape(unsubscribe_token)
+        return (self.text_content.replace(self.placeholder, token),
+                self.html_content.replace(self.placeholder, token))
+
+
+def build_invitation(campaign, to, content, connection=None):
+    """
+    Return the invitation mail of the campaign to the given address, content
+    being a tuple of the text and html content.
+    """
+    text_content, html_content = content
+    email = mail.EmailMultiAlternatives(campaign.subject, text_content,
+                                        settings.DEFAULT_FROM_EMAIL,
+                                        [to],
+                                        connection=connection,
+                                        headers={'Reply-To': campaign.reply_to})
+    email.attach_alternative(html_content, "text/html")
+    return email
+
+
+class RateLimiter(object):
+    """
+    Spaces calls to wait() so that, across all threads sharing the limiter,
+    at most ``rate`` calls return per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            scheduled = max(self._next, now)
+            self._next = scheduled + self.interval
+        if scheduled > now:
+            time.sleep(scheduled - now)
+
+
+def send_batched(connection, email_messages, batch_size, throttle=None):
+    """
+    Send the messages over the given connection and yield a tuple
+    (message, error) for each of them, error being None on success.
+
+    Uses the batched path of the participantdatabase.smtp backends and falls
+    back to sending the messages one by one for other backends, over a
+    connection opened once for all of them. If given, throttle is called
+    before each message is sent.
+    """
+    if hasattr(connection, 'send_batched'):
+        for result in connection.send_batched(email_messages, batch_size, throttle):
+            yield result
+        return
+    try:
+        opened = connection.open()
+    except (smtplib.SMTPException, socket.error) as e:
+        for email_message in email_messages:
+            yield email_message, e
+        return
+    try:
+        for email_message in email_messages:
+            if throttle is not None:
+                throttle()
+            try:
+                connection.send_messages([email_message])
+            except (smtplib.SMTPException, socket.error) as e:
+                yield email_message, e
+                if opened:
+                    # The connection may be broken, go on with a new one.
+                    connection.close()
+                    try:
+                        connection.open()
+                    except (smtplib.SMTPException, socket.error):
+                        pass
+            else:
+                yield email_message, None
+    finally:
+        # Backends return True from open() if they opened a new connection,
+        # one the caller opened stays open.
+        if opened:
+            connection.close()
+
+
+def record_results(model, results):
+    """
+    Store the outcome of a batch of deliveries, given as a list of
+    (delivery, error) tuples, and return the number of deliveries sent.
+    """
+    max_attempts = getattr(settings, 'CAMPAIGN_MAX_ATTEMPTS', 3)
+    sent_pks = []
+    for delivery, error in results:
+        if error is None:
+            sent_pks.append(delivery.pk)
+            continue
+        delivery.attempts += 1
+        delivery.last_error = unicode(error)
+        delivery.error_code = smtp.error_code(error)
+        delivery.status = model.FAILED if delivery.attempts >= max_attempts else model.PENDING
+        delivery.save(update_fields=['status', 'attempts', 'last_error', 'error_code'])
+    model.objects.filter(pk__in=sent_pks).update(status=model.SENT,
+                                                 attempts=F('attempts') + 1,
+                                                 sent_at=timezone.now())
+    return len(sent_pks)
+
+
+def claimable(queryset):
+    """
+    Return the deliveries of the queryset that are pending, or whose claim
+    has expired.
+    """
+    timeout = getattr(settings, 'CAMPAIGN_CLAIM_TIMEOUT', 600)
+    expired = timezone.now() - datetime.timedelta(seconds=timeout)
+    return queryset.filter(Q(status=Delivery.PENDING) |
+                           Q(status=Delivery.SENDING, claimed_at__lt=expired))
+
+
+def claim_batch(queryset, batch_size):
+    """
+    Claim up to batch_size claimable deliveries of the queryset and return
+    them ordered by primary key, or None once nothing is left to claim.
+
+    The deliveries are claimed with a single UPDATE that repeats the
+    conditions of claimable, so a delivery claimed by another sender in the
+    meantime is skipped rather than sent twice. The returned list is empty
+    if other senders claimed all candidates first.
+    """
+    pks = list(claimable(queryset).order_by('pk').values_list('pk', flat=True)[:batch_size])
+    if not pks:
+        return None
+    token = uuid.uuid4().hex
+    claimable(queryset.filter(pk__in=pks)).update(status=Delivery.SENDING,
+                                                  claimed_by=token,
+                                                  claimed_at=timezone.now())
+    return list(queryset.filter(claimed_by=token).order_by('pk'))
+
+
+def claimed_batches(queryset, batch_size):
+    """
+    Yield batches of deliveries of the queryset claimed by claim_batch until
+    no claimable deliveries are left. Every delivery is tried at most once,
+    deliveries that fail are retried on the next call.
+    """
+    last_pk = 0
+    while True:
+        batch = claim_batch(queryset.filter(pk__gt=last_pk), batch_size)
+        if batch is None:
+            return
+        if batch:
+            last_pk = batch[-1].pk
+            yield batch
+
+
+def without_suppressed(model, batches):
+    """
+    Yield the batches of claimed deliveries without the deliveries the
+    suppression list applies to, which are marked as failed. The list is
+    checked right before sending, so addresses suppressed after their mails
+    were queued are not mailed. Batches left empty are skipped.
+    """
+    for batch in batches:
+        suppressions = Suppression.objects.filter(email_hash__in=set(delivery.email_hash for delivery in batch))
+        suppressions = dict((suppression.email_hash, suppression) for suppression in suppressions)
+        suppressed = [delivery.pk for delivery in batch if delivery.email_hash in suppressions and
+                      suppressions[delivery.email_hash].applies_to(delivery)]
+        if suppressed:
+            model.objects.filter(pk__in=suppressed).update(status=model.FAILED, last_error=Suppression.ERROR)
+            batch = [delivery for delivery in batch if delivery.pk not in suppressed]
+        if batch:
+            yield batch
+
+
+def send_batch(campaign, renderer, batch, connection, throttle=None):
+    """
+    Send the invitation of the campaign to a batch of recipients and return
+    a list of (recipient, error) tuples, error being None on success, and a
+    dictionary with the seconds spent rendering ('render') and sending
+    ('smtp') the mails.
+    """
+    start = time.time()
+    emails = [build_invitation(campaign, recipient.email,
+                               renderer.render(recipient.unsubscribe_token),
+                               connection=connection)
+              for recipient in batch]
+    rendered = time.time()
+    # Backends may yield the results in another order, see async_smtp.
+    recipients = dict(zip(emails, batch))
+    results = [(recipients[email], error)
+               for email, error in send_batched(connection, emails, len(batch), throttle)]
+    timings = {'render': rendered - start, 'smtp': time.time() - rendered}
+    return results, timings
+
+
+def send_parallel(campaign, renderer, batches, workers, throttle=None):
+    """
+    Send the batches using the given number of threads, each with a
+    connection of its own, and yield the results and timings of each batch
+    as returned by send_batch.
+
+    Only the calling thread touches the database; the threads render and
+    send the mails.
+    """
+    tasks = Queue.Queue(maxsize=workers)
+    results = Queue.Queue()
+
+    def work():
+        connection = get_connection()
+        while True:
+            batch = tasks.get()
+            if batch is None:
+                return
+            try:
+                results.put(send_batch(campaign, renderer, batch, connection, throttle))
+            except Exception as e:
+                results.put(([(recipient, e) for recipient in batch], {}))
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    queued = 0
+    for batch in batches:
+        tasks.put(batch)
+        queued += 1
+        while not results.empty():
+            queued -= 1
+            yield results.get()
+    for thread in threads:
+        tasks.put(None)
+    while queued:
+        queued -= 1
+        yield results.get()
+    for thread in threads:
+        thread.join()
+
+
+def deliver_campaign(campaign, workers=1, rate=None, connection=None):
+    """
+    Send the invitation to all pending recipients of the campaign and return
+    the number of mails sent.
+
+    Recipients are processed in batches of ``CAMPAIGN_BATCH_SIZE``, which are
+    spread across the given number of worker threads. If rate is given, no
+    more than rate mails per second are sent in total. Failed deliveries are
+    retried as described for Delivery. Several processes may deliver the
+    same campaign, each claiming its own batches. Once no pending or sending
+    recipients are left the campaign is finished and, if any mail went out,
+    a copy of the invitation is sent to the contact address.
+
+    If a connection is given, all mails are sent over it from the calling
+    thread and workers is ignored; this is how backends that multiplex many
+    SMTP sessions themselves, like participantdatabase.async_smtp, are used.
+    """
+    batch_size = getattr(settings, 'CAMPAIGN_BATCH_SIZE', 100)
+    throttle = RateLimiter(rate).wait if rate else None
+
+    Campaign.objects.filter(pk=campaign.pk, status=Campaign.QUEUED).update(status=Campaign.SENDING)
+
+    start = time.time()
+    connections_before = smtp.pool_stats()
+    renderer = InvitationRenderer(campaign)
+    batches = without_suppressed(CampaignRecipient, claimed_batches(campaign.recipients.all(), batch_size))
+    if workers > 1 and connection is None:
+        batch_results = send_parallel(campaign, renderer, batches, workers, throttle)
+    else:
+        connection = connection or get_connection()
+        batch_results = (send_batch(campaign, renderer, batch, connection, throttle)
+                         for batch in batches)
+
+    number_sent = 0
+    number_of_batches = 0
+    timings = {'render': 0, 'smtp': 0}
+    for results, batch_timings in batch_results:
+        number_sent += record_results(CampaignRecipient, results)
+        number_of_batches += 1
+        for kind, seconds in batch_timings.items():
+            timings[kind] += seconds
+
+    if number_of_batches:
+        opened, reused = [after - before for after, before in zip(smtp.pool_stats(), connections_before)]
+        Campaign.objects.filter(pk=campaign.pk).update(render_seconds=F('render_seconds') + timings['render'],
+                                                       smtp_seconds=F('smtp_seconds') + timings['smtp'],
+                                                       send_seconds=F('send_seconds') + time.time() - start,
+                                                       connections_opened=F('connections_opened') + opened,
+                                                       connections_reused=F('connections_reused') + reused)
+
+    unfinished = campaign.recipients.filter(status__in=[CampaignRecipient.PENDING,
+                                                        CampaignRecipient.SENDING])
+    if not unfinished.exists():
+        # Only the sender that finishes the campaign sends the copy.
+        finished = (Campaign.objects.exclude(status=Campaign.FINISHED).filter(pk=campaign.pk)
+                    .update(status=Campaign.FINISHED, finished=timezone.now()))
+        if finished and campaign.recipients.filter(status=CampaignRecipient.SENT).exists():
+            content = render_invitation(campaign, campaign.base_url)
+            build_invitation(campaign, settings.CONTACT_EMAIL, content).send()
+    return number_sent
+
+
+def send_queued_campaigns(workers=1, rate=None, connection=None):
+    """
+    Deliver all campaigns that still have pending recipients and return the
+    number of mails sent. See deliver_campaign for the arguments.
+    """
+    number_sent = 0
+    campaigns = Campaign.objects.exclude(status=Campaign.FINISHED).order_by('created')
+    for campaign in campaigns:
+        number_sent += deliver_campaign(campaign, workers, rate, connection)
+    return number_sent
+
+
+def queue_mail(subject, template_name, context, to, save=True):
+    """
+    Queue a mail to the given address, rendered from the text and html
+    variant of the template when the ``send_mail_queue`` management command
+    sends it. The context has to be JSON serializable; the contact address
+    is added when rendering.
+
+    With save=False the unsaved OutgoingMail is returned, for callers that
+    queue many mails with a single bulk_create.
+    """
+    outgoing_mail = OutgoingMail(subject=subject, template_name=template_name,
+                                 context=json.dumps(context), email=to, email_hash=hash_email(to))
+    if save:
+        outgoing_mail.save()
+    return outgoing_mail
+
+
+def build_queued_mail(outgoing_mail, connection=None):
+    context = json.loads(outgoing_mail.context)
+    context['contact_email'] = settings.CONTACT_EMAIL
+    context.setdefault('message_title', outgoing_mail.subject)
+    context = Context(context)
+    text_content = get_template(outgoing_mail.template_name + '.txt').render(context)
+    html_content = get_template(outgoing_mail.template_name + '.html').render(context)
+    email = mail.EmailMultiAlternatives(outgoing_mail.subject, text_content,
+                                        settings.DEFAULT_FROM_EMAIL,
+                                        [outgoing_mail.email],
+                                        connection=connection)
+    email.attach_alternative(html_content, 'text/html')
+    return email
+
+
+def send_queued_mails(rate=None, connection=None):
+    """
+    Send all pending OutgoingMails and return the number of mails sent. Mails
+    the suppression list applies to are not sent, see Suppression.applies_to.
+
+    If rate is given, no more than rate mails per second are sent. If a
+    connection is given, the mails are sent over it instead of a connection
+    to the default backend, see deliver_campaign.
+    """
+    batch_size = getattr(settings, 'CAMPAIGN_BATCH_SIZE', 100)
+    throttle = RateLimiter(rate).wait if rate else None
+    connection = connection or get_connection()
+    number_sent = 0
+    for batch in without_suppressed(OutgoingMail, claimed_batches(OutgoingMail.objects.all(), batch_size)):
+        emails = [build_queued_mail(outgoing_mail, connection) for outgoing_mail in batch]
+        outgoing_mails = dict(zip(emails, batch))
+        results = [(outgoing_mails[email], error)
+                   for email, error in send_batched(connection, emails, batch_size, throttle)]
+        number_sent += record_results(OutgoingMail, results)
+    return number_sent
+
+
+def queue_activation_mail(participant, base_url, save=True):
+    """
+    Queue the mail asking a new participant to activate the membership.
+    Arguments as for queue_mail, base_url being the absolute url of the site.
+    """
+    activation_url = reverse('activate', kwargs={'token': participant.activate_token})
+    unsubscribe_url = reverse('unsubscribe', kwargs={'token': participant.unsubscribe_token})
+    subject = '{0} Activation mail'.format(settings.MAIL_PREFIX)
+    context = {'activation_url': urlparse.urljoin(base_url, activation_url),
+               'unsubscribe_url': urlparse.urljoin(base_url, unsubscribe_url),
+               }
+    return queue_mail(subject, 'emails/activation', context, participant.email, save)
@@ -0,0 +1,93 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from mainsite.apps.participantdatabase import async_smtp, smtp
+from mainsite.apps.participantdatabase.mailing import deliver_campaign
+from mainsite.apps.participantdatabase.models import Campaign, CampaignRecipient, hash_email
+from mainsite.apps.participantdatabase.smtp_sink import SMTPSink
+
+
+class Command(BaseCommand):
+    help = ('Measures campaign delivery throughput for different numbers of '
+            'worker threads, and of concurrent sessions of the async backend, '
+            'against a local SMTP sink. Runs on a temporary test database.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--messages',
+                    type='int',
+                    dest='messages',
+                    default=1000,
+                    help='Number of mails sent per run.'),
+        make_option('--workers',
+                    dest='workers',
+                    default='1,2,4,8',
+                    help='Comma separated list of worker counts to measure.'),
+        make_option('--sessions',
+                    dest='sessions',
+                    default='1,10,50',
+                    help='Comma separated list of session counts of the async backend '
+                         'to measure, empty to skip it.'),
+        make_option('--latency',
+                    type='float',
+                    dest='latency',
+                    default=0.01,
+                    help='Seconds the sink needs to accept a message.'),
+        make_option('--rate',
+                    type='float',
+                    dest='rate',
+                    default=None,
+                    help='Maximum number of mails sent per second.'),
+    )
+
+    def handle(self, *args, **options):
+        worker_counts = [int(workers) for workers in options['workers'].split(',')]
+        session_counts = [int(sessions) for sessions in options['sessions'].split(',') if sessions]
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        sink = SMTPSink(latency=options['latency'])
+        sink.start()
+        try:
+            with override_settings(EMAIL_BACKEND='mainsite.apps.participantdatabase.smtp.EmailBackend',
+                                   EMAIL_HOST=sink.host,
+                                   EMAIL_PORT=sink.port,
+                                   EMAIL_HOST_USER='',
+                                   EMAIL_HOST_PASSWORD='',
+                                   EMAIL_USE_TLS=False):
+                self.stdout.write('backend    workers    mails  seconds  mails/s')
+                for workers in worker_counts:
+                    smtp.clear_pools()
+                    self.run('threaded', workers, options)
+                smtp.clear_pools()
+                for sessions in session_counts:
+                    mail_connection = async_smtp.EmailBackend(sessions=sessions)
+                    mail_connection.open()
+                    try:
+                        self.run('async', sessions, options, mail_connection)
+                    finally:
+                        mail_connection.close()
+        finally:
+            sink.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def run(self, backend, concurrency, options, mail_connection=None):
+        campaign = self.create_campaign(options['messages'])
+        start = time.time()
+        number_sent = deliver_campaign(campaign, concurrency, options['rate'], mail_connection)
+        elapsed = time.time() - start
+        self.stdout.write('{0:8} {1:8d} {2:8d} {3:8.2f} {4:8.1f}'.format(
+            backend, concurrency, number_sent, elapsed, number_sent / elapsed))
+
+    def create_campaign(self, size):
+        campaign = Campaign.objects.create(subject='Benchmark', message='Benchmark\n\nText',
+                                           reply_to='benchmark@localhost',
+                                           base_url='http://localhost/')
+        CampaignRecipient.objects.bulk_create(
+            CampaignRecipient(campaign=campaign, email='participant{0}@localhost'.format(i),
+                              email_hash=hash_email('participant{0}@localhost'.format(i)),
+                              unsubscribe_token='{0:040x}'.format(i))
+            for i in range(size))
+        return campaign
@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+import tempfile
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from mainsite.apps.participantdatabase.benchmarks import time_token_endpoints
+
+
+class Command(BaseCommand):
+    help = ('Measures the latency of the public activate and unsubscribe '
+            'views for different CONN_MAX_AGE values and, on SQLite, with and '
+            'without the SQLITE_PRAGMAS, and writes the results as JSON. Runs '
+            'on a temporary test database.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--requests',
+                    type='int',
+                    dest='requests',
+                    default=500,
+                    help='Number of requests to each view per run.'),
+        make_option('--conn-max-age',
+                    dest='conn_max_age',
+                    default='0,600',
+                    help='Comma separated list of CONN_MAX_AGE values to measure.'),
+        make_option('--output',
+                    dest='output',
+                    default=None,
+                    help='File to write the JSON results to instead of the standard output.'),
+    )
+
+    def handle(self, *args, **options):
+        conn_max_ages = [int(conn_max_age) for conn_max_age in options['conn_max_age'].split(',')]
+        variants = [('configured', {})]
+        directory = None
+        if connection.vendor == 'sqlite':
+            variants.append(('no pragmas', {'SQLITE_PRAGMAS': ()}))
+            # An in memory database is never closed, use a file to measure
+            # the cost of connecting.
+            directory = tempfile.mkdtemp()
+            connection.settings_dict['TEST']['NAME'] = os.path.join(directory, 'benchmark.db')
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        results = {'database': connection.vendor, 'runs': []}
+        try:
+            with override_settings(ALLOWED_HOSTS=['*']):
+                for variant, variant_settings in variants:
+                    for conn_max_age in conn_max_ages:
+                        timing = time_token_endpoints(options['requests'], conn_max_age,
+                                                      **variant_settings)
+                        timing['variant'] = variant
+                        results['runs'].append(timing)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            if directory:
+                shutil.rmtree(directory)
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
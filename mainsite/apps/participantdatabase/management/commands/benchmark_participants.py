@@ -0,0 +1,63 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from mainsite.apps.participantdatabase.benchmarks import run_benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Times the eligibility query and the sending of campaigns on '
+            'synthetic participant pools and writes the results as JSON. '
+            'Runs on a temporary test database.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes',
+                    dest='sizes',
+                    default='10000,100000,1000000',
+                    help='Comma separated list of pool sizes.'),
+        make_option('--repeat',
+                    type='int',
+                    dest='repeat',
+                    default=5,
+                    help='Number of times each query is timed.'),
+        make_option('--send-max',
+                    type='int',
+                    dest='send_max',
+                    default=10000,
+                    help='Largest pool a campaign is sent to.'),
+        make_option('--latency',
+                    type='float',
+                    dest='latency',
+                    default=0,
+                    help='Seconds the SMTP sink needs to accept a message.'),
+        make_option('--seed',
+                    type='int',
+                    dest='seed',
+                    default=0,
+                    help='Seed of the random generator creating the pools.'),
+        make_option('--output',
+                    dest='output',
+                    default=None,
+                    help='File to write the JSON results to instead of the standard output.'),
+    )
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(ALLOWED_HOSTS=['*']):
+                results = run_benchmarks(sizes, options['repeat'], options['send_max'],
+                                         options['latency'], options['seed'], log=self.stderr.write)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
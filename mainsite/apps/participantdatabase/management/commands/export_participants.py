@@ -0,0 +1,74 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from mainsite.apps.participantdatabase.exporting import export_csv
+from mainsite.apps.participantdatabase.models import Participant
+
+
+class Command(BaseCommand):
+    help = ('Writes a CSV file of all participants, or of the participants '
+            'eligible for the given criteria if any criterion is given.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output',
+                    dest='output',
+                    default=None,
+                    help='File to write to instead of the standard output.'),
+        make_option('--min-age',
+                    type='int',
+                    dest='min_age',
+                    default=None),
+        make_option('--max-age',
+                    type='int',
+                    dest='max_age',
+                    default=None),
+        make_option('--gender',
+                    type='int',
+                    action='append',
+                    dest='genders',
+                    default=None,
+                    help='Allowed gender value, may be given more than once.'),
+        make_option('--handedness',
+                    type='int',
+                    action='append',
+                    dest='handedness',
+                    default=None,
+                    help='Allowed handedness value, may be given more than once.'),
+        make_option('--vision',
+                    type='int',
+                    action='append',
+                    dest='vision',
+                    default=None,
+                    help='Allowed vision value, may be given more than once.'),
+        make_option('--localy-available',
+                    action='store_true',
+                    dest='localy_available',
+                    default=None),
+        make_option('--age-precision',
+                    dest='age_precision',
+                    choices=['year', 'date'],
+                    default='year',
+                    help='Compare ages with the year (default) or the date of birth.'),
+        make_option('--chunk-size',
+                    type='int',
+                    dest='chunk_size',
+                    default=1000,
+                    help='Number of rows fetched per query.'),
+    )
+
+    def handle(self, *args, **options):
+        criteria = dict((key, options[key]) for key in ('min_age', 'max_age', 'genders', 'handedness',
+                                                        'vision', 'localy_available'))
+        if any(value is not None for value in criteria.values()):
+            participants = Participant.objects.get_eligible(age_precision=options['age_precision'], **criteria)
+        else:
+            participants = Participant.objects.all()
+
+        lines = export_csv(participants, options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'wb') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,64 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mainsite.apps.participantdatabase.importing import import_participants, read_rows
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ('Imports participants from a CSV file with a header line or a file '
+            'with one JSON object per line (.json or .jsonl). Columns are the '
+            'fields of the participant form. Activation mails are queued for '
+            'the send_mail_queue command.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format',
+                    dest='format',
+                    choices=['csv', 'jsonl'],
+                    default=None,
+                    help='Format of the file, guessed from its extension by default.'),
+        make_option('--base-url',
+                    dest='base_url',
+                    default=None,
+                    help='Absolute url of the site, used for the links in activation mails.'),
+        make_option('--activate',
+                    action='store_true',
+                    dest='activate',
+                    default=False,
+                    help='Mark the participants as activated instead of sending activation mails.'),
+        make_option('--chunk-size',
+                    type='int',
+                    dest='chunk_size',
+                    default=500,
+                    help='Number of rows inserted per query.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Expected the file to import.')
+        if not options['activate'] and not options['base_url']:
+            raise CommandError('--base-url is required unless --activate is given.')
+        filename = args[0]
+        file_format = options['format']
+        if file_format is None:
+            file_format = 'jsonl' if filename.endswith(('.json', '.jsonl')) else 'csv'
+
+        start = time.time()
+        with open(filename, 'rb') as lines:
+            result = import_participants(read_rows(lines, file_format),
+                                         base_url=options['base_url'],
+                                         activate=options['activate'],
+                                         chunk_size=options['chunk_size'])
+        for row_number, email in result.duplicates:
+            self.stdout.write('Row {0}: {1} already exists.'.format(row_number, email))
+        for row_number, email in result.suppressed:
+            self.stdout.write('Row {0}: {1} is on the suppression list.'.format(row_number, email))
+        for row_number, errors in result.errors:
+            for field, messages in errors.items():
+                self.stdout.write('Row {0}: {1}: {2}'.format(row_number, field, ' '.join(messages)))
+        self.stdout.write('{0} participants were imported in {1:.1f} seconds, {2} duplicates, '
+                          '{3} suppressed addresses and {4} invalid rows were skipped.'.format(
+                              result.created, time.time() - start, len(result.duplicates),
+                              len(result.suppressed), len(result.errors)))
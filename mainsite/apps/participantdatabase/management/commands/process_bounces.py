@@ -0,0 +1,30 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mainsite.apps.participantdatabase.bounces import process_maildir
+
+
+class Command(BaseCommand):
+    help = ('Puts the addresses that bounced permanently, as reported by the '
+            'delivery status notifications in a maildir, on the suppression list.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--maildir',
+                    dest='maildir',
+                    default=None,
+                    help='Maildir the bounces are delivered to. Defaults to BOUNCE_MAILDIR.'),
+        make_option('--keep',
+                    action='store_true',
+                    dest='keep',
+                    default=False,
+                    help='Leave the processed notifications in the maildir.'),
+    )
+
+    def handle(self, *args, **options):
+        path = options['maildir'] or getattr(settings, 'BOUNCE_MAILDIR', None)
+        if not path:
+            raise CommandError('Give the maildir with --maildir or set BOUNCE_MAILDIR.')
+        reports, added = process_maildir(path, remove=not options['keep'])
+        self.stdout.write('{0} delivery reports read, {1} addresses suppressed.'.format(reports, added))
@@ -0,0 +1,34 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mainsite.apps.participantdatabase.models import Participant
+
+
+class Command(BaseCommand):
+    help = ('Deletes the participants that did not activate their membership within '
+            'a number of days after signing up. Meant to be run regularly, e.g. by cron.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days',
+                    type='int',
+                    dest='days',
+                    default=None,
+                    help='Age in days of the participants to delete. '
+                         'Defaults to PURGE_UNACTIVATED_DAYS.'),
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=1000,
+                    help='Number of participants deleted per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days is None:
+            days = getattr(settings, 'PURGE_UNACTIVATED_DAYS', 30)
+        start = time.time()
+        number = Participant.objects.purge_never_activated(days, options['batch_size'])
+        self.stdout.write('{0} participants were deleted in {1:.2f} seconds.'.format(number, time.time() - start))
@@ -0,0 +1,72 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mainsite.apps.participantdatabase import async_smtp
+from mainsite.apps.participantdatabase.db import check_connections
+from mainsite.apps.participantdatabase.mailing import send_queued_campaigns, send_queued_mails
+
+
+class Command(BaseCommand):
+    help = 'Sends all queued mails and the mails of all queued campaigns.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop',
+                    action='store_true',
+                    dest='loop',
+                    default=False,
+                    help='Keep polling the queue instead of exiting once it is empty.'),
+        make_option('--interval',
+                    type='int',
+                    dest='interval',
+                    default=10,
+                    help='Seconds to wait between two polls when using --loop.'),
+        make_option('--workers',
+                    type='int',
+                    dest='workers',
+                    default=None,
+                    help='Number of threads sending mails concurrently. '
+                         'Defaults to CAMPAIGN_WORKERS.'),
+        make_option('--rate',
+                    type='float',
+                    dest='rate',
+                    default=None,
+                    help='Maximum number of mails sent per second. '
+                         'Defaults to CAMPAIGN_RATE_LIMIT.'),
+        make_option('--async',
+                    action='store_true',
+                    dest='async',
+                    default=False,
+                    help='Send campaigns over concurrent SMTP sessions driven by a single '
+                         'thread instead of using worker threads.'),
+        make_option('--sessions',
+                    type='int',
+                    dest='sessions',
+                    default=None,
+                    help='Number of concurrent SMTP sessions when using --async. '
+                         'Defaults to ASYNC_EMAIL_SESSIONS.'),
+    )
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or getattr(settings, 'CAMPAIGN_WORKERS', 1)
+        rate = options['rate'] or getattr(settings, 'CAMPAIGN_RATE_LIMIT', None)
+        connection = None
+        if options['async']:
+            connection = async_smtp.EmailBackend(sessions=options['sessions'])
+            connection.open()
+        try:
+            while True:
+                # The database may have dropped the connection while waiting.
+                check_connections()
+                number_sent = send_queued_mails(rate, connection)
+                number_sent += send_queued_campaigns(workers, rate, connection)
+                if number_sent:
+                    self.stdout.write('{0} mails were sent.'.format(number_sent))
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        finally:
+            if connection is not None:
+                connection.close()
@@ -0,0 +1,75 @@
+import json
+import logging
+import time
+
+from django.db import connections
+from django.template import base
+
+import instrumentation
+
+
+logger = logging.getLogger(__name__)
+
+# Url name the requests that did not resolve to a view, such as those
+# answered with a 404, are recorded under.
+UNRESOLVED_URL_NAME = '<unresolved>'
+
+
+def _timed_render(render):
+    def _render(self, context):
+        with instrumentation.timer('template'):
+            return render(self, context)
+    _render.timed = True
+    return _render
+
+
+class PerformanceMiddleware(object):
+    """
+    Measures every request: wall time, number and time of SQL queries, time
+    spent rendering templates and sending mails with the
+    participantdatabase.smtp backends. Each request is logged as a line of
+    JSON to the ``mainsite.apps.participantdatabase.middleware`` logger and
+    kept as a sample for the summary of the ``performance`` view.
+
+    Enable it by adding it to the top of MIDDLEWARE_CLASSES. SQL queries are
+    measured with Django's debug cursor, which adds some overhead.
+    """
+
+    def __init__(self):
+        if not getattr(base.Template.render, 'timed', False):
+            base.Template.render = _timed_render(base.Template.render.__func__)
+
+    def process_request(self, request):
+        instrumentation.start()
+        request._performance_start = time.time()
+        request._performance_debug_cursors = {}
+        for connection in connections.all():
+            request._performance_debug_cursors[connection.alias] = connection.force_debug_cursor
+            connection.force_debug_cursor = True
+            connection.queries_log.clear()
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_performance_start'):
+            return response
+        wall_time = time.time() - request._performance_start
+        timings = instrumentation.stop()
+        queries = []
+        for connection in connections.all():
+            queries.extend(connection.queries_log)
+            connection.force_debug_cursor = request._performance_debug_cursors.get(connection.alias, False)
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        # The view name is the url name, or the dotted path of the view if
+        # the url has no name. The path is not used, it is chosen by the
+        # client and each one would be recorded under a key of its own.
+        url_name = resolver_match.view_name if resolver_match else UNRESOLVED_URL_NAME
+        sample = {'wall_ms': wall_time * 1000,
+                  'sql_queries': len(queries),
+                  'sql_ms': sum(float(query['time']) for query in queries) * 1000,
+                  'template_ms': timings.get('template', 0) * 1000,
+                  'smtp_ms': timings.get('smtp', 0) * 1000,
+                  }
+        instrumentation.record_sample(url_name, sample)
+        log_line = dict(sample, url_name=url_name, method=request.method, status=response.status_code)
+        logger.info(json.dumps(log_line, sort_keys=True))
+        return response
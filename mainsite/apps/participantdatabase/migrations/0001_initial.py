@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import mainsite.apps.participantdatabase.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Participant',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('email', models.EmailField(unique=True, max_length=254)),
+                ('year_of_birth', models.IntegerField(default=19, validators=[mainsite.apps.participantdatabase.models.year_of_birth_validator])),
+                ('gender', models.IntegerField(default=0, choices=[(1, b'male'), (0, b'female')])),
+                ('handedness', models.IntegerField(default=11, choices=[(10, b'left handed'), (11, b'right handed'), (12, b'ambidextrous')])),
+                ('vision', models.IntegerField(default=20, choices=[(20, b'no corrected vision'), (21, b'glasses'), (22, b'contact lenses')])),
+                ('is_localy_available', models.BooleanField(default=True)),
+                ('is_activated', models.BooleanField(default=False)),
+                ('activate_token', models.CharField(unique=True, max_length=64)),
+                ('unsubscribe_token', models.CharField(unique=True, max_length=64)),
+            ],
+            options={
+                'permissions': (('add_privately', 'May add participant using the internal form'), ('send_mails_to', 'Is allowed to send mails to participants')),
+            },
+        ),
+    ]
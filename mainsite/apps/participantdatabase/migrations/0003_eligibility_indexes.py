@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('participantdatabase', '0002_campaign'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='campaignrecipient',
+            index_together=set([('campaign', 'status')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='participant',
+            index_together=set([('is_activated', 'is_localy_available'), ('is_activated', 'year_of_birth')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('participantdatabase', '0003_eligibility_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingMail',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('email', models.EmailField(max_length=254)),
+                ('status', models.IntegerField(default=0, choices=[(0, b'pending'), (1, b'sent'), (2, b'failed')])),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('sent_at', models.DateTimeField(null=True, blank=True)),
+                ('subject', models.CharField(max_length=255)),
+                ('template_name', models.CharField(max_length=100)),
+                ('context', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='outgoingmail',
+            index_together=set([('status', 'id')]),
+        ),
+    ]
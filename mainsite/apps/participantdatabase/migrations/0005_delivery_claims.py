@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('participantdatabase', '0004_outgoingmail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campaignrecipient',
+            name='claimed_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='campaignrecipient',
+            name='claimed_by',
+            field=models.CharField(db_index=True, max_length=32, blank=True),
+        ),
+        migrations.AddField(
+            model_name='outgoingmail',
+            name='claimed_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='outgoingmail',
+            name='claimed_by',
+            field=models.CharField(db_index=True, max_length=32, blank=True),
+        ),
+        migrations.AlterField(
+            model_name='campaignrecipient',
+            name='status',
+            field=models.IntegerField(default=0, choices=[(0, b'pending'), (3, b'sending'), (1, b'sent'), (2, b'failed')]),
+        ),
+        migrations.AlterField(
+            model_name='outgoingmail',
+            name='status',
+            field=models.IntegerField(default=0, choices=[(0, b'pending'), (3, b'sending'), (1, b'sent'), (2, b'failed')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('participantdatabase', '0006_participant_created'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='participant',
+            name='activate_token',
+            field=models.CharField(unique=True, max_length=40),
+        ),
+        migrations.AlterField(
+            model_name='participant',
+            name='unsubscribe_token',
+            field=models.CharField(unique=True, max_length=40),
+        ),
+    ]
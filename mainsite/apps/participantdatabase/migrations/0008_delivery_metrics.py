@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('participantdatabase', '0007_compact_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campaign',
+            name='connections_opened',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='connections_reused',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='query_seconds',
+            field=models.FloatField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='render_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='send_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='smtp_seconds',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='campaignrecipient',
+            name='error_code',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='outgoingmail',
+            name='error_code',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+    ]
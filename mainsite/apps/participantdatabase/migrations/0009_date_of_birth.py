@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('participantdatabase', '0008_delivery_metrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participant',
+            name='date_of_birth',
+            field=models.DateField(null=True, blank=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='participant',
+            index_together=set([('is_activated', 'is_localy_available'), ('is_activated', 'date_of_birth'), ('is_activated', 'year_of_birth')]),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.db import migrations, models
+from django.db.models import Case, Value, When
+import django.utils.timezone
+
+
+def hash_email(email):
+    # A copy of models.hash_email as of this migration.
+    return hashlib.sha256(email.strip().lower().encode('utf-8')).hexdigest()[:32]
+
+
+def update_email_hashes(model, queryset, chunk_size=300):
+    """
+    Set the email hash of the rows of the queryset with one UPDATE per chunk
+    of rows. Chunks stay below the 999 query parameters SQLite allows.
+    """
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'email')[:chunk_size])
+        if not rows:
+            return
+        hashes = [When(pk=pk, then=Value(hash_email(email))) for pk, email in rows]
+        model.objects.filter(pk__in=[pk for pk, email in rows]).update(
+            email_hash=Case(*hashes, output_field=models.CharField()))
+        last_pk = rows[-1][0]
+
+
+def backfill_email_hash(apps, schema_editor):
+    Participant = apps.get_model('participantdatabase', 'Participant')
+    update_email_hashes(Participant, Participant.objects.all())
+
+
+def clear_email_hash(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('participantdatabase', '0009_date_of_birth'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Suppression',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('email_hash', models.CharField(unique=True, max_length=32)),
+                ('reason', models.IntegerField(choices=[(0, 'unsubscribed'), (1, 'bounced')])),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='participant',
+            name='email_hash',
+            field=models.CharField(default='', max_length=32, editable=False, db_index=True),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_email_hash, clear_email_hash),
+    ]
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.db import migrations, models
+from django.db.models import Case, Value, When
+
+
+def hash_email(email):
+    # A copy of models.hash_email as of this migration.
+    return hashlib.sha256(email.strip().lower().encode('utf-8')).hexdigest()[:32]
+
+
+def update_email_hashes(model, queryset, chunk_size=300):
+    """
+    Set the email hash of the rows of the queryset with one UPDATE per chunk
+    of rows. Chunks stay below the 999 query parameters SQLite allows.
+    """
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'email')[:chunk_size])
+        if not rows:
+            return
+        hashes = [When(pk=pk, then=Value(hash_email(email))) for pk, email in rows]
+        model.objects.filter(pk__in=[pk for pk, email in rows]).update(
+            email_hash=Case(*hashes, output_field=models.CharField()))
+        last_pk = rows[-1][0]
+
+
+def backfill_email_hash(apps, schema_editor):
+    """
+    Set the hash of the deliveries that may still be sent, pending (0) or
+    sending (3); it is only used to skip suppressed addresses.
+    """
+    for model_name in ('CampaignRecipient', 'OutgoingMail'):
+        model = apps.get_model('participantdatabase', model_name)
+        update_email_hashes(model, model.objects.filter(status__in=[0, 3]))
+
+
+def clear_email_hash(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('participantdatabase', '0010_suppression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campaignrecipient',
+            name='email_hash',
+            field=models.CharField(db_index=True, max_length=32, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='outgoingmail',
+            name='email_hash',
+            field=models.CharField(db_index=True, max_length=32, editable=False, blank=True),
+        ),
+        migrations.RunPython(backfill_email_hash, clear_email_hash),
+    ]
@@ -1,9 +1,23 @@
-from django.db import models
-import hashlib
-import time
+from django.db import models, transaction
 from django.conf import settings
 import datetime
+import hashlib
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from tokens import ACTIVATE_SALT, UNSUBSCRIBE_SALT, generate_tokens
+
+
+COUNT_CUBE_CACHE_KEY = 'participantdatabase.count_cube'
+
+YEAR_PRECISION = 'year'
+DATE_PRECISION = 'date'
+AGE_PRECISION_CHOICES = ((YEAR_PRECISION, 'year of birth'),
+                         (DATE_PRECISION, 'date of birth'),
+                         )
 
 
 def year_of_birth_validator(value):
@@ -11,10 +25,62 @@ def year_of_birth_validator(value):
         raise ValidationError(u'%s is not a valid year of birth' % value)
 
 
+def years_before(date, years):
+    """
+    Return the date the given number of years before date, 28 February
+    standing in for a 29 February that does not exist in that year.
+
+    >>> years_before(datetime.date(2016, 2, 29), 1)
+    datetime.date(2015, 2, 28)
+    """
+    try:
+        return date.replace(year=date.year - years)
+    except ValueError:
+        return date.replace(year=date.year - years, day=28)
+
+
+def hash_email(email):
+    """
+    Return the hash identifying an email address on the suppression list:
+    the first 128 bits of the SHA-256 of the address in lower case, as hex.
+
+    >>> hash_email(' Alice@Mail.org') == hash_email('alice@mail.org')
+    True
+    """
+    return hashlib.sha256(email.strip().lower().encode('utf-8')).hexdigest()[:32]
+
+
+def chunks(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def iterate_values(queryset, fields, chunk_size=1000):
+    """
+    Yield a tuple of the values of the given fields for every row of the
+    queryset.
+
+    The rows are fetched in chunks of chunk_size rows ordered by primary
+    key, each chunk starting after the last key of the previous one, so
+    neither the database nor Python holds the whole result set.
+    """
+    rows = queryset.order_by('pk').values_list('pk', *fields)
+    last_pk = 0
+    while True:
+        chunk = list(rows.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            return
+        last_pk = chunk[-1][0]
+        for row in chunk:
+            yield row[1:]
+
+
 class ParticipantManager(models.Manager):
 
     def get_eligible(self, min_age=None, max_age=None, localy_available=None,
-                            genders=None, handedness=None, vision=None):
+                            genders=None, handedness=None, vision=None,
+                            age_precision=YEAR_PRECISION):
         """
         Return queryset containing all participants that match the given criteria.
         If a criteria is None (default for all) it will be ignored.
@@ -26,13 +92,33 @@ class ParticipantManager(models.Manager):
         genders -- list of allowed gender values
         handedness -- list of allowed handedness values
         vision -- list of allowed vision values
+        age_precision -- YEAR_PRECISION to compare the ages with the year of
+                         birth, DATE_PRECISION to select participants aged
+                         min_age to max_age today by their date of birth,
+                         if they gave one
+
+        Participants whose address is on the suppression list are never
+        eligible.
         """
-        participants = Participant.objects.filter(is_activated=True)
+        participants = Participant.objects.not_suppressed().filter(is_activated=True)
 
-        if min_age is not None:
-            participants = participants.filter(year_of_birth__lt=datetime.date.today().year - min_age)
-        if max_age is not None:
-            participants = participants.filter(year_of_birth__gt=datetime.date.today().year - max_age)
+        if min_age is not None or max_age is not None:
+            today = datetime.date.today()
+            ages = models.Q()
+            if min_age is not None:
+                ages &= models.Q(year_of_birth__lt=today.year - min_age)
+            if max_age is not None:
+                ages &= models.Q(year_of_birth__gt=today.year - max_age)
+            if age_precision == DATE_PRECISION:
+                dates = models.Q()
+                if min_age is not None:
+                    dates &= models.Q(date_of_birth__lte=years_before(today, min_age))
+                if max_age is not None:
+                    dates &= models.Q(date_of_birth__gt=years_before(today, max_age + 1))
+                # Participants that only gave their year of birth are
+                # selected by year, as with YEAR_PRECISION.
+                ages = dates | models.Q(ages, date_of_birth__isnull=True)
+            participants = participants.filter(ages)
         if genders is not None:
             participants = participants.filter(gender__in=genders)
         if handedness is not None:
@@ -44,6 +130,140 @@ class ParticipantManager(models.Manager):
 
         return participants
 
+    def not_suppressed(self):
+        """
+        Return queryset of the participants whose address is not on the
+        suppression list, excluded with a single anti-join on the hashes.
+        """
+        return self.exclude(email_hash__in=Suppression.objects.values('email_hash'))
+
+    def stream_eligible(self, min_age=None, max_age=None, localy_available=None,
+                        genders=None, handedness=None, vision=None,
+                        age_precision=YEAR_PRECISION, chunk_size=1000):
+        """
+        Yield (email, unsubscribe_token) tuples of all participants that
+        match the given criteria, see get_eligible and iterate_values.
+        """
+        participants = self.get_eligible(min_age, max_age, localy_available,
+                                         genders, handedness, vision, age_precision)
+        return iterate_values(participants, ('email', 'unsubscribe_token'), chunk_size)
+
+    def get_count_cube(self):
+        """
+        Return a list of (year_of_birth, gender, handedness, vision,
+        is_localy_available, count) tuples counting the activated participants
+        that are not suppressed for every combination of the attributes used
+        by get_eligible.
+
+        The cube is computed with a single GROUP BY query and cached until a
+        participant or suppression is saved or deleted.
+        """
+        cube = cache.get(COUNT_CUBE_CACHE_KEY)
+        if cube is None:
+            rows = self.not_suppressed().filter(is_activated=True).order_by()
+            rows = rows.values_list('year_of_birth', 'gender', 'handedness',
+                                    'vision', 'is_localy_available')
+            cube = list(rows.annotate(models.Count('pk')))
+            cache.set(COUNT_CUBE_CACHE_KEY, cube,
+                      getattr(settings, 'COUNT_CUBE_CACHE_TIMEOUT', 600))
+        return cube
+
+    def count_eligible(self, min_age=None, max_age=None, localy_available=None,
+                       genders=None, handedness=None, vision=None,
+                       age_precision=YEAR_PRECISION):
+        """
+        Return the number of participants get_eligible would return for the
+        given criteria, computed from the cached count cube instead of the
+        participant table. The cube only knows years of birth, ages with
+        DATE_PRECISION are counted with a query.
+        """
+        if age_precision == DATE_PRECISION and (min_age is not None or max_age is not None):
+            return self.get_eligible(min_age, max_age, localy_available, genders,
+                                     handedness, vision, age_precision).count()
+        # Form values arrive as strings, the cube holds integers.
+        if genders is not None:
+            genders = set(int(value) for value in genders)
+        if handedness is not None:
+            handedness = set(int(value) for value in handedness)
+        if vision is not None:
+            vision = set(int(value) for value in vision)
+
+        year = datetime.date.today().year
+        count = 0
+        for (year_of_birth, gender, handedness_value, vision_value,
+                is_localy_available, number) in self.get_count_cube():
+            if min_age is not None and not year_of_birth < year - min_age:
+                continue
+            if max_age is not None and not year_of_birth > year - max_age:
+                continue
+            if genders is not None and gender not in genders:
+                continue
+            if handedness is not None and handedness_value not in handedness:
+                continue
+            if vision is not None and vision_value not in vision:
+                continue
+            if localy_available and not is_localy_available:
+                continue
+            count += number
+        return count
+
+    def assign_tokens(self, participants):
+        """
+        Generate the missing activation and unsubscribe tokens of the given
+        participants, with one call to the random number generator.
+        """
+        activate = [x for x in participants if not x.activate_token]
+        unsubscribe = [x for x in participants if not x.unsubscribe_token]
+        for participant, token in zip(activate, generate_tokens(len(activate), ACTIVATE_SALT)):
+            participant.activate_token = token
+        for participant, token in zip(unsubscribe, generate_tokens(len(unsubscribe), UNSUBSCRIBE_SALT)):
+            participant.unsubscribe_token = token
+
+    def never_activated(self, days):
+        """
+        Return queryset of the participants that signed up more than the
+        given number of days ago and never activated their membership.
+        """
+        signed_up_before = timezone.now() - datetime.timedelta(days=days)
+        return self.filter(is_activated=False, created__lt=signed_up_before)
+
+    def delete_all(self, queryset):
+        """
+        Delete the participants of the queryset with a single DELETE statement
+        and return their number.
+
+        Unlike QuerySet.delete no participant is loaded and no delete signals
+        are sent; nothing refers to participants, so there is nothing to
+        cascade to. The only post_delete receiver of Participant is
+        invalidate_count_cube, which is called explicitly instead; a receiver
+        added later has to be called here as well.
+        """
+        number = queryset.count()
+        if number:
+            # QuerySet.delete only skips loading the rows if no delete signal
+            # has a receiver for the model, which invalidate_count_cube rules
+            # out. _raw_delete is the private method it uses for this fast
+            # path; it is stable across the Django 1.8 series this project
+            # pins.
+            queryset._raw_delete(queryset.db)
+            invalidate_count_cube(self.model)
+        return number
+
+    def purge_never_activated(self, days, batch_size=1000):
+        """
+        Delete the participants returned by never_activated and return their
+        number. They are deleted in batches of batch_size participants, each
+        in a transaction of its own, so the table is never locked for long.
+        """
+        number = 0
+        while True:
+            pks = list(self.never_activated(days).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return number
+            with transaction.atomic():
+                # Participants that activated in the meantime are kept.
+                number += self.delete_all(self.never_activated(days).filter(pk__in=pks))
+
 
 class Participant(models.Model):
     """
@@ -74,6 +294,13 @@ class Participant(models.Model):
             ("add_privately", "May add participant using the internal form"),
             ("send_mails_to", "Is allowed to send mails to participants"),
         )
+        # get_eligible always filters on is_activated, usually followed by
+        # an age range; the remaining criteria are checked on the rows found.
+        index_together = (
+            ('is_activated', 'year_of_birth'),
+            ('is_activated', 'is_localy_available'),
+            ('is_activated', 'date_of_birth'),
+        )
 
     FEMALE = 0
     MALE = 1
@@ -102,6 +329,8 @@ class Participant(models.Model):
 
     email = models.EmailField(unique=True, blank=False)
     year_of_birth = models.IntegerField(default=19, validators=[year_of_birth_validator])
+    # Only set if the participant gave it, see fill_date_of_birth.
+    date_of_birth = models.DateField(null=True, blank=True)
     gender = models.IntegerField(choices=GENDER_CHOICES, default=FEMALE)
     handedness = models.IntegerField(choices=HANDEDNESS_CHOICES,
                                       default=RIGHTHANDED)
@@ -110,28 +339,275 @@ class Participant(models.Model):
     is_localy_available = models.BooleanField(default=True)
 
     is_activated = models.BooleanField(default=False)
-    activate_token = models.CharField(max_length=64, unique=True)
-    unsubscribe_token = models.CharField(max_length=64, unique=True)
+    created = models.DateTimeField(default=timezone.now, editable=False, db_index=True)
+    # See hash_email, set by save().
+    email_hash = models.CharField(max_length=32, editable=False, db_index=True)
+    activate_token = models.CharField(max_length=40, unique=True)
+    unsubscribe_token = models.CharField(max_length=40, unique=True)
 
     def save(self, force_insert=False, force_update=False, using=None):
 
-        if not self.activate_token:
-            self.activate_token = self.create_token(time.time(), settings.SECRET_KEY[:len(settings.SECRET_KEY) // 2])
-        if not self.unsubscribe_token:
-            self.unsubscribe_token = self.create_token(time.time(), settings.SECRET_KEY[len(settings.SECRET_KEY) // 2:])
-
+        self.assign_tokens()
+        self.fill_date_of_birth()
+        self.email_hash = hash_email(self.email)
         models.Model.save(self, force_insert=force_insert, force_update=force_update, using=using)
 
-    def create_token(self, *salt_args):
+    def clean(self):
+        if self.date_of_birth is not None and self.date_of_birth.year != self.year_of_birth:
+            raise ValidationError({'date_of_birth': 'The date of birth does not match the year of birth.'})
+
+    def fill_date_of_birth(self):
+        """
+        Set the year of birth to the year of the date of birth if the year is
+        not set, and clear a date of birth that does not match the year of
+        birth. Participants that only gave their year of birth have no date
+        of birth. Called by save(), and directly for participants created in
+        bulk.
+        """
+        if self.date_of_birth is None:
+            return
+        if not 1900 < self.year_of_birth < 3000:
+            self.year_of_birth = self.date_of_birth.year
+        elif self.date_of_birth.year != self.year_of_birth:
+            self.date_of_birth = None
+
+    def assign_tokens(self):
         """
-        Return token string generated from feeding the participants email
-        address and the given arguments in a sha1 function.
+        Generate the activation and unsubscribe tokens if they are not set.
+        Called by save(); use ParticipantManager.assign_tokens for many
+        participants.
         """
-        sha = hashlib.sha1()
-        sha.update(self.email)
-        for arg in salt_args:
-            sha.update(str(arg))
-        return sha.hexdigest()
+        Participant.objects.assign_tokens([self])
 
     def __unicode__(self):
         return 'Participant({0})'.format(self.email)
+
+
+class SuppressionManager(models.Manager):
+
+    def suppress(self, emails, reason, chunk_size=500):
+        """
+        Put the given addresses on the suppression list, unless they are on
+        it already, and return the number of addresses added. Queued mails
+        to the addresses, pending or being sent, are marked as failed.
+        """
+        added = 0
+        for chunk in chunks(set(emails), chunk_size):
+            hashes = set(hash_email(email) for email in chunk)
+            for model in (CampaignRecipient, OutgoingMail):
+                model.objects.filter(email_hash__in=hashes, status__in=[Delivery.PENDING, Delivery.SENDING]).update(
+                    status=Delivery.FAILED, last_error=Suppression.ERROR)
+            hashes -= set(self.filter(email_hash__in=hashes).values_list('email_hash', flat=True))
+            self.bulk_create(Suppression(email_hash=email_hash, reason=reason) for email_hash in hashes)
+            added += len(hashes)
+        if added:
+            invalidate_count_cube(self.model)
+        return added
+
+    def resubscribe(self, emails, chunk_size=500):
+        """
+        Remove the given addresses from the suppression list if their owners
+        had unsubscribed; bounced addresses stay suppressed.
+        """
+        for chunk in chunks(set(emails), chunk_size):
+            hashes = [hash_email(email) for email in chunk]
+            self.filter(email_hash__in=hashes, reason=Suppression.UNSUBSCRIBED).delete()
+
+
+class Suppression(models.Model):
+    """
+    An address that is never mailed again, because its owner unsubscribed
+    or mails to it bounced. Only the hash of the address is stored (see
+    hash_email), so the list does not keep the addresses of people who
+    asked to be removed, and addresses that are imported or sign up again
+    stay suppressed. Only activating a new signup lifts an unsubscription.
+    """
+
+    UNSUBSCRIBED = 0
+    BOUNCED = 1
+
+    ERROR = 'The address is suppressed.'
+
+    REASON_CHOICES = ((UNSUBSCRIBED, 'unsubscribed'),
+                      (BOUNCED, 'bounced'),
+                      )
+
+    objects = SuppressionManager()
+
+    email_hash = models.CharField(max_length=32, unique=True)
+    reason = models.IntegerField(choices=REASON_CHOICES)
+    created = models.DateTimeField(default=timezone.now)
+
+    def applies_to(self, delivery):
+        """
+        Return whether the queued delivery to the address must not be sent:
+        no mail goes to a bounced address, and no mail queued before its
+        owner unsubscribed. Mails queued afterwards, like the activation
+        mail of a new signup, are sent. Deliveries without a created time,
+        like campaign mails, are never sent to suppressed addresses.
+        """
+        created = getattr(delivery, 'created', None)
+        return self.reason == Suppression.BOUNCED or created is None or created <= self.created
+
+    def __unicode__(self):
+        return 'Suppression({0})'.format(self.email_hash)
+
+
+@receiver(post_save, sender=Participant)
+@receiver(post_delete, sender=Participant)
+@receiver(post_save, sender=Suppression)
+@receiver(post_delete, sender=Suppression)
+def invalidate_count_cube(sender, **kwargs):
+    cache.delete(COUNT_CUBE_CACHE_KEY)
+
+
+class Campaign(models.Model):
+    """
+    A Campaign is an experiment invitation that has been queued for all
+    participants matching a search. The mails themselves are not sent while
+    handling the request, but by the ``send_mail_queue`` management command,
+    which works through the CampaignRecipient entries of the campaign.
+    """
+
+    QUEUED = 0
+    SENDING = 1
+    FINISHED = 2
+
+    STATUS_CHOICES = ((QUEUED, 'queued'),
+                      (SENDING, 'sending'),
+                      (FINISHED, 'finished'),
+                      )
+
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    reply_to = models.EmailField()
+    base_url = models.CharField(max_length=255)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True,
+                                   on_delete=models.SET_NULL)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    status = models.IntegerField(choices=STATUS_CHOICES, default=QUEUED)
+
+    # Delivery metrics. The seconds spent rendering and sending are summed over
+    # all worker threads, send_seconds is the wall time of the delivery runs.
+    query_seconds = models.FloatField(null=True, blank=True)
+    render_seconds = models.FloatField(default=0)
+    smtp_seconds = models.FloatField(default=0)
+    send_seconds = models.FloatField(default=0)
+    connections_opened = models.IntegerField(default=0)
+    connections_reused = models.IntegerField(default=0)
+
+    def progress(self):
+        """
+        Return a dictionary mapping the name of each CampaignRecipient status
+        to the number of recipients of this campaign in that status.
+        """
+        names = dict(CampaignRecipient.STATUS_CHOICES)
+        counts = dict((name, 0) for name in names.values())
+        rows = self.recipients.values('status').annotate(count=models.Count('pk'))
+        for row in rows:
+            counts[names[row['status']]] = row['count']
+        return counts
+
+    def messages_per_second(self):
+        """
+        Return the number of mails sent per second of delivery, or None if
+        no delivery has run yet.
+        """
+        if not self.send_seconds:
+            return None
+        return self.recipients.filter(status=CampaignRecipient.SENT).count() / self.send_seconds
+
+    def failures_by_code(self):
+        """
+        Return a list of (SMTP reply code, number of recipients) for the
+        failed recipients of this campaign, the code being None for failures
+        without one.
+        """
+        rows = (self.recipients.filter(status=CampaignRecipient.FAILED)
+                .values_list('error_code').annotate(count=models.Count('pk')).order_by('error_code'))
+        return list(rows)
+
+    def __unicode__(self):
+        return 'Campaign({0})'.format(self.subject)
+
+
+class Delivery(models.Model):
+    """
+    Base class for mails waiting in a queue of the ``send_mail_queue``
+    management command. A delivery that fails stays pending until it has
+    been tried ``CAMPAIGN_MAX_ATTEMPTS`` times.
+
+    A sender claims a batch of pending deliveries by setting them to sending
+    with its own claim token, so several senders can work through the same
+    queue. Deliveries that stay in sending for ``CAMPAIGN_CLAIM_TIMEOUT``
+    seconds, because their sender died, can be claimed again.
+    """
+
+    PENDING = 0
+    SENT = 1
+    FAILED = 2
+    SENDING = 3
+
+    STATUS_CHOICES = ((PENDING, 'pending'),
+                      (SENDING, 'sending'),
+                      (SENT, 'sent'),
+                      (FAILED, 'failed'),
+                      )
+
+    class Meta:
+        abstract = True
+
+    email = models.EmailField()
+    # See hash_email, set when the delivery is queued.
+    email_hash = models.CharField(max_length=32, blank=True, editable=False, db_index=True)
+    status = models.IntegerField(choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    claimed_by = models.CharField(max_length=32, blank=True, db_index=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    # SMTP reply code of the last failed attempt, if the server gave one.
+    error_code = models.IntegerField(null=True, blank=True)
+
+
+class CampaignRecipient(Delivery):
+    """
+    A single delivery of a Campaign. The address and unsubscribe token are
+    copied from the Participant when the campaign is queued, so sending does
+    not need to touch the participant table.
+    """
+
+    class Meta:
+        # Delivery works through the pending recipients of one campaign.
+        index_together = (
+            ('campaign', 'status'),
+        )
+
+    campaign = models.ForeignKey(Campaign, related_name='recipients')
+    unsubscribe_token = models.CharField(max_length=64)
+
+    def __unicode__(self):
+        return 'CampaignRecipient({0})'.format(self.email)
+
+
+class OutgoingMail(Delivery):
+    """
+    A single mail, such as an activation mail, queued to be sent in the
+    background. The mail is rendered when it is sent, from the text and html
+    variant of the template (``template_name`` + '.txt' and '.html') and the
+    JSON encoded context.
+    """
+
+    class Meta:
+        index_together = (
+            ('status', 'id'),
+        )
+
+    subject = models.CharField(max_length=255)
+    template_name = models.CharField(max_length=100)
+    context = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return 'OutgoingMail({0})'.format(self.email)
@@ -0,0 +1,82 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+PERMISSIONS_VERSION_CACHE_KEY = 'participantdatabase.permissions.version'
+PERMISSIONS_CACHE_KEY = 'participantdatabase.permissions.{0}.{1}'
+
+
+def get_version():
+    """
+    Return the current version of the cached permissions. Changes to groups
+    and permissions, which may affect any user, start a new version instead
+    of deleting the entries of all users.
+    """
+    version = cache.get(PERMISSIONS_VERSION_CACHE_KEY)
+    if version is None:
+        # Start from the time rather than 1, so that entries cached before
+        # the version was evicted are not picked up again.
+        cache.add(PERMISSIONS_VERSION_CACHE_KEY, int(time.time() * 1000), None)
+        version = cache.get(PERMISSIONS_VERSION_CACHE_KEY)
+    return version
+
+
+def new_version():
+    try:
+        cache.incr(PERMISSIONS_VERSION_CACHE_KEY)
+    except ValueError:
+        get_version()
+
+
+def get_permissions(user):
+    """
+    Return the set of permission names ("app_label.codename") of an active
+    user, as resolved by the authentication backends, from the cache.
+    """
+    key = PERMISSIONS_CACHE_KEY.format(get_version(), user.pk)
+    permissions = cache.get(key)
+    if permissions is None:
+        permissions = frozenset(user.get_all_permissions())
+        cache.set(key, permissions, getattr(settings, 'PERMISSIONS_CACHE_TIMEOUT', 600))
+    return permissions
+
+
+def has_perm(user, perm):
+    """
+    Return whether the user has the permission, like user.has_perm but
+    without querying the database if the permissions of the user are cached.
+    """
+    if not user.is_authenticated():
+        return user.has_perm(perm)
+    if not user.is_active:
+        return False
+    return user.is_superuser or perm in get_permissions(user)
+
+
+def has_module_perms(user, app_label):
+    if not user.is_authenticated():
+        return user.has_module_perms(app_label)
+    if not user.is_active:
+        return False
+    return user.is_superuser or any(perm.startswith(app_label + '.') for perm in get_permissions(user))
+
+
+def invalidate_user_permissions(sender, instance, action, reverse, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        # Users were added to or removed from a group or permission.
+        new_version()
+    else:
+        cache.delete(PERMISSIONS_CACHE_KEY.format(get_version(), instance.pk))
+
+
+def invalidate_permissions(sender, **kwargs):
+    if kwargs.get('action', 'post_').startswith('post_'):
+        new_version()
+
+
+def invalidate_deleted_user(sender, instance, **kwargs):
+    cache.delete(PERMISSIONS_CACHE_KEY.format(get_version(), instance.pk))
@@ -1,10 +1,212 @@
 from django.core.mail.backends import smtp
 from django.conf import settings
+import hashlib
+import itertools
 import smtplib
+import socket
+import threading
+from django.core.mail.message import sanitize_address
 from django.core.mail.utils import DNS_NAME
 
+import instrumentation
 
-class EmailBackend(smtp.EmailBackend):
+
+def sendmail(connection, from_addr, to_addrs, msg):
+    """
+    Send msg over the given smtplib connection, like connection.sendmail.
+
+    If the server supports PIPELINING (RFC 2920) the MAIL, RCPT and DATA
+    commands are sent together and their replies are read afterwards, which
+    saves a round trip per command. Returns a dictionary of refused
+    recipients, raising the same exceptions as smtplib.
+    """
+    connection.ehlo_or_helo_if_needed()
+    if not connection.has_extn('pipelining'):
+        return connection.sendmail(from_addr, to_addrs, msg)
+
+    # The commands are written at once, sending them one by one would let
+    # Nagle's algorithm delay each write until the previous one is acked.
+    commands = ['mail FROM:%s\r\n' % smtplib.quoteaddr(from_addr)]
+    commands.extend('rcpt TO:%s\r\n' % smtplib.quoteaddr(addr) for addr in to_addrs)
+    commands.append('data\r\n')
+    connection.send(''.join(commands))
+
+    mail_reply = connection.getreply()
+    refused = {}
+    for addr in to_addrs:
+        code, resp = connection.getreply()
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    data_code, data_resp = connection.getreply()
+
+    if data_code == 354 and (mail_reply[0] != 250 or len(refused) == len(to_addrs)):
+        # The server accepted DATA even though the transaction failed,
+        # terminate the empty message so it gets rejected.
+        connection.send('.\r\n')
+        data_code, data_resp = connection.getreply()
+    if mail_reply[0] != 250:
+        connection.rset()
+        raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+    if len(refused) == len(to_addrs):
+        connection.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    if data_code != 354:
+        connection.rset()
+        raise smtplib.SMTPDataError(data_code, data_resp)
+
+    q = smtplib.quotedata(msg)
+    if q[-2:] != '\r\n':
+        q += '\r\n'
+    connection.send(q + '.\r\n')
+    code, resp = connection.getreply()
+    if code != 250:
+        connection.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+class ConnectionPool(object):
+    """
+    Keeps authenticated SMTP connections alive between uses, so that
+    consecutive messages and requests do not pay for a new connection (and
+    TLS handshake) every time.
+
+    At most ``size`` idle connections are kept. A connection that has sent
+    ``max_messages`` messages is closed instead of being reused.
+    """
+
+    def __init__(self, size, max_messages):
+        self.size = size
+        self.max_messages = max_messages
+        # Number of connections created and of idle connections reused.
+        self.created = 0
+        self.reused = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def connect(self, connect):
+        """
+        Return a new connection created by calling ``connect``.
+        """
+        connection = connect()
+        connection.messages_sent = 0
+        with self._lock:
+            self.created += 1
+        return connection
+
+    def acquire(self, connect):
+        """
+        Return an idle connection that is still alive, or a new connection
+        created by calling ``connect``.
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection = self._idle.pop()
+            try:
+                connection.noop()
+            except (smtplib.SMTPException, IOError):
+                # The server dropped the idle connection.
+                self.discard(connection)
+                continue
+            with self._lock:
+                self.reused += 1
+            return connection
+        return self.connect(connect)
+
+    def release(self, connection):
+        """
+        Return the connection to the pool, or close it if the pool is full or
+        the connection has sent too many messages.
+        """
+        with self._lock:
+            if (len(self._idle) < self.size and
+                    connection.messages_sent < self.max_messages):
+                self._idle.append(connection)
+                return
+        self.discard(connection)
+
+    def discard(self, connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, IOError):
+            connection.close()
+
+    def clear(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self.discard(connection)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key):
+    """
+    Return the ConnectionPool shared by all backends using the given key.
+    """
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(getattr(settings, 'EMAIL_POOL_SIZE', 2),
+                                         getattr(settings, 'EMAIL_POOL_MAX_MESSAGES', 100))
+        return _pools[key]
+
+
+def pool_stats():
+    """
+    Return the number of connections created and reused by all pools.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+    return sum(pool.created for pool in pools), sum(pool.reused for pool in pools)
+
+
+def error_code(error):
+    """
+    Return the SMTP reply code of the given exception raised when sending a
+    mail, or None if it has none.
+    """
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code
+    if isinstance(error, smtplib.SMTPRecipientsRefused) and error.recipients:
+        return sorted(error.recipients.values())[0][0]
+    return None
+
+
+def clear_pools():
+    """
+    Close the idle connections of all pools.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.clear()
+
+
+class PooledEmailBackend(smtp.EmailBackend):
+    """
+    Base class for backends that take their connections from a shared
+    ConnectionPool. Subclasses implement ``connect`` to create a new,
+    authenticated connection.
+    """
+
+    def connect(self):
+        raise NotImplementedError
+
+    @property
+    def pool(self):
+        # Connections are authenticated, backends with other credentials for
+        # the same account must not share them. The key holds a hash rather
+        # than the password itself.
+        password = hashlib.sha256((self.password or '').encode('utf-8')).hexdigest()
+        return get_pool((self.__class__, self.host, self.port,
+                         self.username, password, self.use_tls))
 
     def open(self):
         """
@@ -15,18 +217,111 @@ class EmailBackend(smtp.EmailBackend):
             # Nothing to do if the connection is already open.
             return False
         try:
-            # If local_hostname is not specified, socket.getfqdn() gets used.
-            # For performance, we use the cached FQDN for local_hostname.
-            self.connection = smtplib.SMTP(self.host, self.port,
-                                           local_hostname=DNS_NAME.get_fqdn())
-            if self.use_tls:
-                self.connection.ehlo()
-                self.connection.starttls(settings.EMAIL_KEYFILE,
-                                         settings.EMAIL_CERTFILE)
-                self.connection.ehlo()
-            if self.username and self.password:
-                self.connection.login(self.username, self.password)
+            self.connection = self.pool.acquire(self.connect)
             return True
         except:
             if not self.fail_silently:
-                raise
\ No newline at end of file
+                raise
+
+    def close(self):
+        """
+        Hands the connection back to the pool instead of closing it.
+        """
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        self.pool.release(connection)
+
+    def reconnect(self):
+        connection, self.connection = self.connection, None
+        self.pool.discard(connection)
+        self.connection = self.pool.connect(self.connect)
+
+    def _deliver(self, email_message):
+        """
+        Sends the message, replacing the connection if the server
+        disconnected or it has reached its message limit. Errors are raised
+        regardless of fail_silently.
+        """
+        if not email_message.recipients():
+            return False
+        from_email = sanitize_address(email_message.from_email, email_message.encoding)
+        recipients = [sanitize_address(addr, email_message.encoding)
+                      for addr in email_message.recipients()]
+        message = email_message.message().as_string()
+        if self.connection is None:
+            # A previous reconnect failed silently.
+            self.connection = self.pool.acquire(self.connect)
+        elif self.connection.messages_sent >= self.pool.max_messages:
+            self.reconnect()
+        with instrumentation.timer('smtp'):
+            try:
+                sendmail(self.connection, from_email, recipients, message)
+            except smtplib.SMTPServerDisconnected:
+                self.reconnect()
+                sendmail(self.connection, from_email, recipients, message)
+        self.connection.messages_sent += 1
+        return True
+
+    def _send(self, email_message):
+        try:
+            return self._deliver(email_message)
+        except smtplib.SMTPException:
+            if not self.fail_silently:
+                raise
+            return False
+
+    def send_batched(self, email_messages, batch_size=None, throttle=None):
+        """
+        Send the messages of the given iterable and yield a tuple
+        (message, error) for each of them, where error is the exception that
+        prevented the delivery or None if the message was sent.
+
+        The messages are sent in batches of ``batch_size`` messages, each of
+        which uses a single connection. Other threads sharing this backend
+        can only interleave their messages between batches. If given,
+        throttle is called before each message is sent.
+        """
+        batch_size = batch_size or self.pool.max_messages
+        email_messages = iter(email_messages)
+        while True:
+            batch = list(itertools.islice(email_messages, batch_size))
+            if not batch:
+                return
+            with self._lock:
+                results = []
+                try:
+                    new_conn_created = self.open()
+                except (smtplib.SMTPException, socket.error) as e:
+                    results = [(message, e) for message in batch]
+                else:
+                    for message in batch:
+                        if throttle is not None:
+                            throttle()
+                        try:
+                            self._deliver(message)
+                        except (smtplib.SMTPException, socket.error) as e:
+                            results.append((message, e))
+                        else:
+                            results.append((message, None))
+                    if new_conn_created:
+                        self.close()
+            for result in results:
+                yield result
+
+
+class EmailBackend(PooledEmailBackend):
+
+    def connect(self):
+        # If local_hostname is not specified, socket.getfqdn() gets used.
+        # For performance, we use the cached FQDN for local_hostname.
+        connection = smtplib.SMTP(self.host, self.port,
+                                  local_hostname=DNS_NAME.get_fqdn())
+        if self.use_tls:
+            connection.ehlo()
+            connection.starttls(settings.EMAIL_KEYFILE,
+                                settings.EMAIL_CERTFILE)
+            connection.ehlo()
+        if self.username and self.password:
+            connection.login(self.username, self.password)
+        return connection
@@ -0,0 +1,128 @@
+import SocketServer
+import socket
+import ssl
+import threading
+import time
+
+
+class SinkHandler(SocketServer.StreamRequestHandler):
+    """
+    Speaks just enough SMTP (including EHLO, PIPELINING and, if the server
+    has a certificate, STARTTLS) to accept messages from smtplib and the
+    participantdatabase mail backends.
+    """
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        # Replies to pipelined commands are written one by one, do not let
+        # Nagle's algorithm hold them back.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def reply(self, line):
+        self.wfile.write(line + '\r\n')
+
+    def start_tls(self):
+        self.wfile.flush()
+        self.connection = ssl.wrap_socket(self.connection, server_side=True,
+                                          certfile=self.server.certfile,
+                                          keyfile=self.server.keyfile)
+        self.rfile = self.connection.makefile('rb', self.rbufsize)
+        self.wfile = self.connection.makefile('wb', self.wbufsize)
+
+    def handle(self):
+        self.reply('220 localhost SMTP sink')
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, arg = line.rstrip('\r\n').partition(' ')
+            command = command.upper()
+            if command == 'EHLO':
+                self.reply('250-localhost')
+                if self.server.certfile and not isinstance(self.connection, ssl.SSLSocket):
+                    self.reply('250-STARTTLS')
+                self.reply('250 PIPELINING')
+            elif command == 'STARTTLS' and self.server.certfile:
+                self.reply('220 Ready to start TLS')
+                self.start_tls()
+                recipients = []
+            elif command == 'HELO':
+                self.reply('250 localhost')
+            elif command == 'MAIL':
+                recipients = []
+                self.reply('250 Ok')
+            elif command == 'RCPT':
+                address = arg.partition(':')[2].strip().strip('<>')
+                if address.endswith(self.server.reject_suffix):
+                    self.reply('550 No such user here')
+                else:
+                    recipients.append(address)
+                    self.reply('250 Ok')
+            elif command == 'DATA':
+                if not recipients:
+                    self.reply('554 No valid recipients')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in ('.\r\n', '.\n', ''):
+                    pass
+                if self.server.latency:
+                    time.sleep(self.server.latency)
+                self.server.count_message()
+                recipients = []
+                self.reply('250 Ok')
+            elif command == 'RSET':
+                recipients = []
+                self.reply('250 Ok')
+            elif command == 'NOOP':
+                self.reply('250 Ok')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SMTPSink(SocketServer.ThreadingTCPServer):
+    """
+    Local SMTP server that accepts and counts all messages, except those to
+    addresses ending in ``reject_suffix``. Each connection is served by its
+    own thread and every message can be delayed by ``latency`` seconds to
+    mimic a remote relay. Given a certificate file (and a key file unless
+    the certificate file contains the key) STARTTLS is offered. It is meant
+    for tests and benchmarks:
+
+    >>> sink = SMTPSink()
+    >>> sink.start()
+    >>> sink.received
+    0
+    >>> sink.stop()
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+    reject_suffix = '.invalid'
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, certfile=None, keyfile=None):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port), SinkHandler)
+        self.host, self.port = self.server_address
+        self.latency = latency
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.received = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def count_message(self):
+        with self._lock:
+            self.received += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
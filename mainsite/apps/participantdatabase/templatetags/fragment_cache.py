@@ -0,0 +1,75 @@
+import hashlib
+import os
+
+from django import template
+from django.conf import settings
+from django.core.cache import cache
+from django.template.utils import get_app_template_dirs
+
+
+register = template.Library()
+
+FORM_CACHE_KEY = 'participantdatabase.form.{0}'
+
+_templates_mtime = None
+
+
+def templates_mtime():
+    """
+    Return the modification time of the newest file in the template
+    directories. It is only computed once per process: like the cached
+    template loader, changed templates are picked up after a restart.
+    """
+    global _templates_mtime
+    if _templates_mtime is None:
+        mtime = 0
+        for directory in tuple(settings.TEMPLATE_DIRS) + get_app_template_dirs('templates'):
+            for root, dirs, files in os.walk(directory):
+                for name in files:
+                    mtime = max(mtime, os.path.getmtime(os.path.join(root, name)))
+        _templates_mtime = mtime
+    return _templates_mtime
+
+
+def form_cache_key(form):
+    form_class = type(form)
+    key = repr(('{0}.{1}'.format(form_class.__module__, form_class.__name__), form.prefix,
+                sorted(form.initial.items()), templates_mtime()))
+    return FORM_CACHE_KEY.format(hashlib.md5(key).hexdigest())
+
+
+class CacheFormNode(template.Node):
+
+    def __init__(self, nodelist, form):
+        self.nodelist = nodelist
+        self.form = form
+
+    def render(self, context):
+        form = self.form.resolve(context)
+        if form.is_bound:
+            return self.nodelist.render(context)
+        key = form_cache_key(form)
+        content = cache.get(key)
+        if content is None:
+            content = self.nodelist.render(context)
+            cache.set(key, content, getattr(settings, 'FORM_CACHE_TIMEOUT', 3600))
+        return content
+
+
+@register.tag
+def cacheform(parser, token):
+    """
+    Cache the markup between {% cacheform form %} and {% endcacheform %}
+    while the form is unbound, which is the same for every request showing
+    the form class with the same initial data and prefix. Bound forms,
+    which show the submitted data and errors, are rendered every time.
+
+    The block must depend on nothing but the form. Keep request specific
+    parts like {% csrf_token %} outside of it.
+    """
+    bits = token.split_contents()
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError("'{0}' takes a form as its only argument".format(bits[0]))
+    nodelist = parser.parse(('endcacheform',))
+    parser.delete_first_token()
+    return CacheFormNode(nodelist, parser.compile_filter(bits[1]))
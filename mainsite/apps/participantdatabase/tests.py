@@ -1,23 +1,58 @@
 from __future__ import unicode_literals
 import doctest
 import datetime
+import json
+import mailbox
+import os
+import shutil
+import smtplib
+import socket
+import subprocess
+import tempfile
+import time
+from StringIO import StringIO
+from distutils.spawn import find_executable
+from unittest import skipUnless
 
 import mock
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
 from django.test import TestCase
-from django.test.client import Client
-from django.contrib.auth.models import User, UserManager, Permission
+from django.test.client import Client, RequestFactory
+from django.contrib.auth.models import Group, User, UserManager, Permission
 from django.core import mail
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.conf import settings
+from django.utils import timezone
 
 from models import Participant as p
 import models
+import async_smtp
+import benchmarks
+import bounces
+import db
+import decorators
+import exporting
+import forms
+import importing
+import instrumentation
+import mailing
+import permissions
+import smtp
+import smtp_sink
+import tokens
+from templatetags import fragment_cache
 
 
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(models))
+    tests.addTests(doctest.DocTestSuite(mailing))
+    tests.addTests(doctest.DocTestSuite(tokens))
+    tests.addTests(doctest.DocTestSuite(instrumentation))
     return tests
 
 
@@ -126,6 +161,77 @@ class ParticipantTestCase(TestCase):
                               p.objects.get_eligible(vision=[p.NO_CORRECTED_VISION, p.CONTACT_LENSES]),
                               )
 
+    def test_stream_eligible(self):
+        expected = [(participant.email, participant.unsubscribe_token)
+                    for participant in p.objects.get_eligible(localy_available=True).order_by('pk')]
+        self.assertEqual(expected, list(p.objects.stream_eligible(localy_available=True, chunk_size=2)))
+        self.assertEqual([(self.bob.email, self.bob.unsubscribe_token)],
+                         list(p.objects.stream_eligible(vision=[p.CONTACT_LENSES], chunk_size=1)))
+
+    @mock.patch('datetime.date', MockDate)
+    def test_count_eligible(self):
+        cache.clear()
+        criteria = [{},
+                    {'min_age': 18},
+                    {'min_age': 18, 'max_age': 20},
+                    {'genders': ['0'], 'vision': ['20', '22']},
+                    {'handedness': [p.RIGHTHANDED], 'localy_available': True},
+                    {'genders': []}]
+        for kwargs in criteria:
+            self.assertEqual(p.objects.get_eligible(**kwargs).count(),
+                             p.objects.count_eligible(**kwargs))
+
+    def test_date_precision(self):
+        today = datetime.date.today()
+        # Turns 18 today, turns 18 tomorrow, turns 31 tomorrow
+        dave = p.objects.create(email='dave@mail.com', year_of_birth=today.year - 18, is_activated=True,
+                                date_of_birth=models.years_before(today, 18))
+        erin = p.objects.create(email='erin@mail.com', is_activated=True,
+                                date_of_birth=models.years_before(today, 18) + datetime.timedelta(days=1))
+        frank = p.objects.create(email='frank@mail.com', is_activated=True,
+                                 date_of_birth=models.years_before(today, 31) + datetime.timedelta(days=1))
+        self.assertEqual(erin.date_of_birth.year, erin.year_of_birth)
+        young = p.objects.get_eligible(min_age=18, max_age=30, age_precision=models.DATE_PRECISION)
+        self.assertEqual([dave, frank], list(young.filter(pk__in=[dave.pk, erin.pk, frank.pk]).order_by('pk')))
+        self.assertEqual(young.count(), p.objects.count_eligible(min_age=18, max_age=30,
+                                                                 age_precision=models.DATE_PRECISION))
+
+        # Participants that only gave a year have no date of birth
+        self.assertIsNone(p.objects.get(pk=self.alice.pk).date_of_birth)
+        form = forms.ParticipantForm({'email': 'gina@mail.com', 'year_of_birth': '1980',
+                                      'date_of_birth': '1981-01-01', 'gender': p.FEMALE,
+                                      'handedness': p.RIGHTHANDED, 'vision': p.GLASSES,
+                                      'is_localy_available': 'on'})
+        self.assertEqual(['date_of_birth'], form.errors.keys())
+
+    def test_date_precision_year_only(self):
+        today = datetime.date.today()
+        # Might turn 18 on 31 December, might have turned 18 on 1 January
+        gina = p.objects.create(email='gina@mail.com', year_of_birth=today.year - 18, is_activated=True)
+        hank = p.objects.create(email='hank@mail.com', year_of_birth=today.year - 19, is_activated=True)
+        self.assertIsNone(gina.date_of_birth)
+        for age_precision in (models.YEAR_PRECISION, models.DATE_PRECISION):
+            adults = p.objects.get_eligible(min_age=18, age_precision=age_precision)
+            self.assertNotIn(gina, adults)
+            self.assertIn(hank, adults)
+            self.assertEqual(adults.count(), p.objects.count_eligible(min_age=18, age_precision=age_precision))
+
+        # A date that no longer matches a changed year of birth is dropped
+        gina.date_of_birth = datetime.date(today.year - 18, 12, 31)
+        gina.save()
+        gina.year_of_birth -= 1
+        gina.save()
+        self.assertIsNone(p.objects.get(pk=gina.pk).date_of_birth)
+
+    def test_count_cube_invalidation(self):
+        cache.clear()
+        self.assertEqual(4, p.objects.count_eligible())
+        self.daniel.is_activated = True
+        self.daniel.save()
+        self.assertEqual(5, p.objects.count_eligible())
+        self.alice.delete()
+        self.assertEqual(4, p.objects.count_eligible())
+
     def test_availability(self):
         self.assertItemsEqual({self.alice, self.bob, self.eve},
                               p.objects.get_eligible(localy_available=True),
@@ -135,6 +241,75 @@ class ParticipantTestCase(TestCase):
                               )
 
 
+@skipUnless(connection.vendor == 'sqlite', 'Query plans are only checked on SQLite.')
+class QueryPlanTestCase(TestCase):
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return ' '.join(unicode(row[-1]) for row in cursor.fetchall())
+
+    def test_age_range(self):
+        plan = self.explain(p.objects.get_eligible(min_age=18, max_age=30, genders=[p.FEMALE]))
+        self.assertRegexpMatches(plan, r'USING INDEX \S+ \(is_activated=\? AND year_of_birth>\? AND year_of_birth<\?\)')
+
+    def test_availability(self):
+        plan = self.explain(p.objects.get_eligible(localy_available=True))
+        self.assertRegexpMatches(plan, r'USING INDEX \S+ \(is_activated=\? AND is_localy_available=\?\)')
+
+    def test_without_criteria(self):
+        plan = self.explain(p.objects.get_eligible())
+        self.assertRegexpMatches(plan, r'USING (COVERING )?INDEX \S+ \(is_activated=\?\)')
+
+
+class BenchmarkTestCase(TestCase):
+
+    def test_generate_pool(self):
+        benchmarks.generate_pool(1000, seed=1, chunk_size=300)
+        self.assertEqual(1000, p.objects.count())
+        right_handed = p.objects.filter(handedness=p.RIGHTHANDED).count()
+        self.assert_(800 < right_handed < 950, right_handed)
+        emails = list(p.objects.order_by('pk').values_list('email', 'year_of_birth'))
+        benchmarks.generate_pool(1000, seed=1)
+        self.assertEqual(emails, list(p.objects.order_by('pk').values_list('email', 'year_of_birth')))
+
+    def test_run_benchmarks(self):
+        results = benchmarks.run_benchmarks([50], repeat=2)
+        pool = results['pools'][0]
+        self.assertEqual(len(benchmarks.FILTER_MATRIX), len(pool['queries']))
+        eligible = p.objects.get_eligible().count()
+        self.assertEqual(eligible, pool['queries'][0]['rows'])
+        self.assertEqual(['locmem', 'smtp'], [timing['backend'] for timing in pool['send']])
+        self.assertEqual([eligible, eligible], [timing['recipients'] for timing in pool['send']])
+        json.dumps(results)
+
+    def test_token_endpoints(self):
+        results = benchmarks.time_token_endpoints(5, 0)
+        self.assertEqual(0, p.objects.count())
+        self.assertGreater(results['activate']['p95_seconds'], 0)
+        self.assertGreater(results['unsubscribe']['p50_seconds'], 0)
+
+
+class DatabaseTestCase(TestCase):
+
+    @skipUnless(connection.vendor == 'sqlite', 'The pragmas are only set for SQLite')
+    def test_sqlite_pragmas(self):
+        connection.ensure_connection()
+        self.assertEqual(5000, connection.connection.execute('PRAGMA busy_timeout').fetchone()[0])
+
+    def test_check_connections(self):
+        connection.ensure_connection()
+        # Within the test transaction Django would always close the connection.
+        with mock.patch.object(connection, 'close_if_unusable_or_obsolete'), \
+                mock.patch.object(connection, 'close') as close:
+            db.check_connections()
+            self.assertFalse(close.called)
+            with mock.patch.object(connection, 'is_usable', return_value=False):
+                db.check_connections()
+            self.assertTrue(close.called)
+
+
 class MailSendingTestCase(ParticipantDBTestCase):
 
     fixtures = ['mail_test.json']
@@ -155,6 +330,10 @@ class MailSendingTestCase(ParticipantDBTestCase):
                      'is_localy_available': 'on'
         }
         response = self.authorised_client.post(reverse('addparticipant'), post_data)
+        # The activation mail is only queued by the view
+        self.assertEqual(0, len(mail.outbox))
+        self.assertEqual(1, models.OutgoingMail.objects.count())
+        call_command('send_mail_queue', stdout=StringIO())
         self.assertEqual(1, len(mail.outbox))
         mail_message = str(mail.outbox[0].message())
         participant = p.objects.get(email=email_address)
@@ -174,7 +353,13 @@ class MailSendingTestCase(ParticipantDBTestCase):
                      'contact_address': self.email,
 
         }
-        self.authorised_client.post(reverse('sendmessage'), post_data)
+        response = self.authorised_client.post(reverse('sendmessage'), post_data)
+        campaign = models.Campaign.objects.get()
+        self.assertRedirects(response, reverse('campaign', kwargs={'pk': campaign.pk}))
+
+        # Nothing is sent until the queue is processed
+        self.assertEqual(0, len(mail.outbox))
+        call_command('send_mail_queue', stdout=StringIO())
 
         #One participant, one admin mail
         self.assertEqual(1 + 1, len(mail.outbox))
@@ -185,6 +370,520 @@ class MailSendingTestCase(ParticipantDBTestCase):
         self.assert_(mail_text in mail_message)
         self.assert_(settings.CONTACT_EMAIL in mail_message, 'Contact email address not found in outgoing email.')
 
+        campaign = models.Campaign.objects.get()
+        self.assertEqual(models.Campaign.FINISHED, campaign.status)
+        self.assertEqual({'pending': 0, 'sending': 0, 'sent': 1, 'failed': 0}, campaign.progress())
+        response = self.authorised_client.get(reverse('campaign', kwargs={'pk': campaign.pk}))
+        self.failUnlessEqual(response.status_code, 200)
+
+    def test_audience_size(self):
+        cache.clear()
+        query = {'genders': [p.MALE, p.FEMALE],
+                 'handedness': [p.LEFTHANDED, p.RIGHTHANDED, p.AMBIDEXTROUS],
+                 'vision': [p.NO_CORRECTED_VISION, p.GLASSES, p.CONTACT_LENSES]}
+        response = self.authorised_client.get(reverse('audiencesize'), query)
+        self.failUnlessEqual(response.status_code, 200)
+        self.assertEqual({'count': p.objects.get_eligible().count()}, json.loads(response.content))
+
+        response = self.authorised_client.get(reverse('audiencesize'), {'min_age': 'ten'})
+        self.failUnlessEqual(response.status_code, 400)
+
+    def test_campaign_retries(self):
+        campaign = mailing.enqueue_campaign('Subject', 'Text', self.email,
+                                            p.objects.stream_eligible(),
+                                            'http://testserver/')
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=smtplib.SMTPServerDisconnected('gone')):
+            for attempt in range(settings.CAMPAIGN_MAX_ATTEMPTS - 1):
+                mailing.send_queued_campaigns()
+                self.assertEqual(0, campaign.progress()['failed'])
+            mailing.send_queued_campaigns()
+        progress = campaign.progress()
+        self.assertEqual(0, progress['pending'])
+        self.assertEqual(campaign.recipients.count(), progress['failed'])
+        self.assertEqual(models.Campaign.FINISHED, models.Campaign.objects.get(pk=campaign.pk).status)
+
+    def test_parallel_delivery(self):
+        recipients = p.objects.get_eligible()
+        campaign = mailing.enqueue_campaign('Subject', 'Text', self.email,
+                                            p.objects.stream_eligible(),
+                                            'http://testserver/')
+        with self.settings(CAMPAIGN_BATCH_SIZE=1):
+            number_sent = mailing.deliver_campaign(campaign, workers=3)
+        self.assertEqual(recipients.count(), number_sent)
+        self.assertEqual(recipients.count() + 1, len(mail.outbox))
+        self.assertItemsEqual([r.email for r in recipients] + [settings.CONTACT_EMAIL],
+                              [m.to[0] for m in mail.outbox])
+
+    def test_claims(self):
+        campaign = mailing.enqueue_campaign('Subject', 'Text', self.email,
+                                            p.objects.stream_eligible(),
+                                            'http://testserver/')
+        recipients = campaign.recipients.all()
+        first = mailing.claim_batch(recipients, 1)
+        second = mailing.claim_batch(recipients, recipients.count())
+        self.assertEqual(1, len(first))
+        self.assertEqual(recipients.count(), len(first) + len(second))
+        self.assertFalse(set(r.pk for r in first) & set(r.pk for r in second))
+        self.assertIsNone(mailing.claim_batch(recipients, 1))
+
+        # The sender of the first batch dies, its claim expires eventually
+        mailing.record_results(models.CampaignRecipient, [(r, None) for r in second])
+        self.assertEqual(0, mailing.deliver_campaign(campaign))
+        self.assertEqual(1, campaign.progress()['sending'])
+        self.assertNotEqual(models.Campaign.FINISHED, models.Campaign.objects.get(pk=campaign.pk).status)
+        with self.settings(CAMPAIGN_CLAIM_TIMEOUT=-1):
+            self.assertEqual(1, mailing.deliver_campaign(campaign))
+        self.assertEqual([first[0].email, settings.CONTACT_EMAIL], [m.to[0] for m in mail.outbox])
+        self.assertEqual(models.Campaign.FINISHED, models.Campaign.objects.get(pk=campaign.pk).status)
+
+    def test_rate_limit(self):
+        limiter = mailing.RateLimiter(100)
+        start = time.time()
+        for _ in range(11):
+            limiter.wait()
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+
+class ConnectionPoolTestCase(TestCase):
+
+    def setUp(self):
+        smtp._pools.clear()
+        patcher = mock.patch('smtplib.SMTP')
+        self.smtp_class = patcher.start()
+        self.smtp_class.return_value.has_extn.return_value = False
+        self.addCleanup(patcher.stop)
+        self.email = mail.EmailMessage('Subject', 'Text', settings.DEFAULT_FROM_EMAIL,
+                                       ['alice@mail.com'])
+
+    def create_backend(self, password=''):
+        return smtp.EmailBackend(host='localhost', port=25, username='', password=password,
+                                 use_tls=False)
+
+    def test_connection_reuse(self):
+        for _ in range(3):
+            self.create_backend().send_messages([self.email])
+        self.assertEqual(1, self.smtp_class.call_count)
+        self.assertEqual(3, self.smtp_class.return_value.sendmail.call_count)
+
+    def test_credentials(self):
+        self.create_backend(password='old').send_messages([self.email])
+        self.create_backend(password='new').send_messages([self.email])
+        self.assertEqual(2, self.smtp_class.call_count)
+
+    def test_message_limit(self):
+        with self.settings(EMAIL_POOL_MAX_MESSAGES=2):
+            backend = self.create_backend()
+            backend.send_messages([self.email] * 5)
+        self.assertEqual(3, self.smtp_class.call_count)
+
+    def test_reconnect(self):
+        self.smtp_class.return_value.sendmail.side_effect = [smtplib.SMTPServerDisconnected(), {}]
+        self.assertEqual(1, self.create_backend().send_messages([self.email]))
+        self.assertEqual(2, self.smtp_class.call_count)
+
+
+class BatchedSendingTestCase(TestCase):
+
+    def setUp(self):
+        smtp._pools.clear()
+        self.sink = smtp_sink.SMTPSink()
+        self.sink.start()
+        self.backend = smtp.EmailBackend(host=self.sink.host, port=self.sink.port,
+                                         username='', password='', use_tls=False)
+
+    def tearDown(self):
+        self.backend.pool.clear()
+        self.sink.stop()
+
+    def create_messages(self, addresses):
+        for address in addresses:
+            yield mail.EmailMessage('Subject', 'Text', settings.DEFAULT_FROM_EMAIL, [address])
+
+    def test_send_batched(self):
+        addresses = ['participant{0}@mail.com'.format(i) for i in range(250)]
+        results = list(self.backend.send_batched(self.create_messages(addresses), batch_size=100))
+        self.assertEqual(250, len(results))
+        self.assertEqual([None] * 250, [error for message, error in results])
+        self.assertEqual(250, self.sink.received)
+
+    def test_refused_recipient(self):
+        addresses = ['alice@mail.com', 'bob@mail.invalid', 'chris@mail.com']
+        results = list(self.backend.send_batched(self.create_messages(addresses)))
+        errors = [error for message, error in results]
+        self.assertEqual(None, errors[0])
+        self.assertIsInstance(errors[1], smtplib.SMTPRecipientsRefused)
+        self.assertEqual(None, errors[2])
+        self.assertEqual(2, self.sink.received)
+
+    def test_django_backend(self):
+        backend = mail.get_connection('django.core.mail.backends.smtp.EmailBackend',
+                                      host=self.sink.host, port=self.sink.port,
+                                      username='', password='', use_tls=False)
+        addresses = ['alice@mail.com', 'bob@mail.com', 'chris@mail.invalid', 'dave@mail.com']
+        with mock.patch('smtplib.SMTP', wraps=smtplib.SMTP) as smtp_class:
+            results = list(mailing.send_batched(backend, self.create_messages(addresses), 100))
+        errors = [error for message, error in results]
+        self.assertEqual([None, None], errors[:2])
+        self.assertIsInstance(errors[2], smtplib.SMTPRecipientsRefused)
+        self.assertEqual(None, errors[3])
+        self.assertEqual(3, self.sink.received)
+        # One connection, and a new one after the failure.
+        self.assertEqual(2, smtp_class.call_count)
+        self.assertIsNone(backend.connection)
+
+    def test_campaign_metrics(self):
+        p.objects.create(email='alice@mail.com', is_activated=True)
+        p.objects.create(email='bob@mail.invalid', is_activated=True)
+        p.objects.create(email='chris@mail.com', is_activated=True)
+        campaign = mailing.enqueue_campaign('Subject', 'Text', 'contact@mail.com',
+                                            p.objects.stream_eligible(), 'http://testserver/')
+        with self.settings(EMAIL_BACKEND='mainsite.apps.participantdatabase.smtp.EmailBackend',
+                           EMAIL_HOST=self.sink.host, EMAIL_PORT=self.sink.port,
+                           EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='', EMAIL_USE_TLS=False,
+                           CAMPAIGN_BATCH_SIZE=1, CAMPAIGN_MAX_ATTEMPTS=1):
+            self.assertEqual(2, mailing.deliver_campaign(campaign))
+        campaign = models.Campaign.objects.get(pk=campaign.pk)
+        self.assertIsNotNone(campaign.query_seconds)
+        self.assertGreater(campaign.render_seconds, 0)
+        self.assertGreater(campaign.smtp_seconds, 0)
+        self.assertGreater(campaign.messages_per_second(), 0)
+        self.assertEqual((1, 2), (campaign.connections_opened, campaign.connections_reused))
+        self.assertEqual([(550, 1)], campaign.failures_by_code())
+
+        User.objects.create_superuser('admin', 'admin@test.com', 'secret')
+        client = Client()
+        client.login(username='admin', password='secret')
+        response = client.get(reverse('campaign_metrics'))
+        self.assertContains(response, '550: 1')
+
+    def test_smtp_timing(self):
+        instrumentation.start()
+        list(self.backend.send_batched(self.create_messages(['alice@mail.com'])))
+        self.assertGreater(instrumentation.stop()['smtp'], 0)
+
+
+class AsyncSendingTestCase(TestCase):
+
+    def setUp(self):
+        self.sink = smtp_sink.SMTPSink()
+        self.sink.start()
+        self.addCleanup(self.sink.stop)
+
+    def create_backend(self, **kwargs):
+        kwargs.setdefault('port', self.sink.port)
+        backend = async_smtp.EmailBackend(host=self.sink.host, username='', password='',
+                                          sessions=5, **kwargs)
+        self.addCleanup(backend.close)
+        return backend
+
+    def create_messages(self, addresses):
+        for address in addresses:
+            yield mail.EmailMessage('Subject', 'Text', settings.DEFAULT_FROM_EMAIL, [address])
+
+    def test_send_batched(self):
+        addresses = ['participant{0}@mail.com'.format(i) for i in range(250)]
+        with self.settings(EMAIL_POOL_MAX_MESSAGES=20):
+            backend = self.create_backend(use_tls=False)
+            backend.open()
+        results = list(backend.send_batched(self.create_messages(addresses)))
+        self.assertEqual([None] * 250, [error for message, error in results])
+        self.assertEqual(set(addresses), set(message.to[0] for message, error in results))
+        self.assertEqual(250, self.sink.received)
+
+    def test_refused_recipient(self):
+        addresses = ['alice@mail.com', 'bob@mail.invalid', 'chris@mail.com']
+        backend = self.create_backend(use_tls=False)
+        errors = dict((message.to[0], error)
+                      for message, error in backend.send_batched(self.create_messages(addresses)))
+        self.assertEqual(None, errors['alice@mail.com'])
+        self.assertIsInstance(errors['bob@mail.invalid'], smtplib.SMTPRecipientsRefused)
+        self.assertEqual(None, errors['chris@mail.com'])
+        self.assertEqual(2, self.sink.received)
+
+    def test_no_recipients(self):
+        messages = list(self.create_messages(['alice@mail.com'])) + [mail.EmailMessage('Subject', 'Text')]
+        backend = self.create_backend(use_tls=False)
+        results = dict(backend.send_batched(messages))
+        self.assertEqual(None, results[messages[0]])
+        self.assertIsInstance(results[messages[1]], smtplib.SMTPRecipientsRefused)
+        self.assertEqual(1, backend.send_messages(messages))
+
+    def test_server_down(self):
+        unused = socket.socket()
+        unused.bind(('127.0.0.1', 0))
+        port = unused.getsockname()[1]
+        unused.close()
+        backend = self.create_backend(port=port, use_tls=False)
+        results = list(backend.send_batched(self.create_messages(['alice@mail.com', 'bob@mail.com'])))
+        self.assertEqual(2, len(results))
+        for message, error in results:
+            self.assertIsInstance(error, socket.error)
+        with self.assertRaises(socket.error):
+            backend.send_messages(list(self.create_messages(['alice@mail.com'])))
+
+    @skipUnless(find_executable('openssl'), 'openssl is needed to create a certificate')
+    def test_starttls(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        certfile = os.path.join(directory, 'sink.pem')
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                                   '-days', '1', '-subj', '/CN=localhost',
+                                   '-keyout', certfile, '-out', certfile],
+                                  stdout=devnull, stderr=devnull)
+        sink = smtp_sink.SMTPSink(certfile=certfile)
+        sink.start()
+        self.addCleanup(sink.stop)
+        backend = self.create_backend(port=sink.port, use_tls=True)
+        addresses = ['participant{0}@mail.com'.format(i) for i in range(20)]
+        self.assertEqual(20, backend.send_messages(list(self.create_messages(addresses))))
+        self.assertEqual(20, sink.received)
+
+        backend = self.create_backend(use_tls=True)
+        with self.assertRaises(smtplib.SMTPException):
+            backend.send_messages(list(self.create_messages(addresses[:1])))
+
+    def test_deliver_campaign(self):
+        for i in range(30):
+            p.objects.create(email='participant{0}@mail.com'.format(i), is_activated=True)
+        campaign = mailing.enqueue_campaign('Subject', 'Text', 'contact@mail.com',
+                                            p.objects.stream_eligible(), 'http://testserver/')
+        backend = self.create_backend(use_tls=False)
+        backend.open()
+        with self.settings(CAMPAIGN_BATCH_SIZE=7):
+            self.assertEqual(30, mailing.send_queued_campaigns(connection=backend))
+        self.assertEqual(30, self.sink.received)
+        self.assertEqual(models.Campaign.FINISHED, models.Campaign.objects.get(pk=campaign.pk).status)
+        # The copy to the contact address uses the default backend.
+        self.assertEqual(1, len(mail.outbox))
+
+    def test_results_out_of_order(self):
+        # The refused address completes first, the others once the sink's
+        # latency has passed; each result has to end up on its own row.
+        sink = smtp_sink.SMTPSink(latency=0.2)
+        sink.start()
+        self.addCleanup(sink.stop)
+        backend = async_smtp.EmailBackend(host=sink.host, port=sink.port, username='', password='',
+                                          use_tls=False, sessions=4)
+        self.addCleanup(backend.close)
+        addresses = ['a@mail.com', 'b@mail.com', 'c@mail.com', 'zz@mail.invalid']
+        for address in addresses:
+            p.objects.create(email=address, is_activated=True)
+        mailing.enqueue_campaign('Subject', 'Text', 'contact@mail.com',
+                                 p.objects.stream_eligible(), 'http://testserver/')
+        for participant in p.objects.all():
+            mailing.queue_activation_mail(participant, 'http://testserver/')
+        self.assertEqual(3, mailing.send_queued_campaigns(connection=backend))
+        self.assertEqual(3, mailing.send_queued_mails(connection=backend))
+        for model in (models.CampaignRecipient, models.OutgoingMail):
+            for delivery in model.objects.all():
+                refused = delivery.email == 'zz@mail.invalid'
+                self.assertEqual(not refused, delivery.status == models.Delivery.SENT)
+                self.assertEqual(refused, bool(delivery.last_error))
+
+    def test_command(self):
+        p.objects.create(email='alice@mail.com', is_activated=True)
+        mailing.enqueue_campaign('Subject', 'Text', 'contact@mail.com',
+                                 p.objects.stream_eligible(), 'http://testserver/')
+        output = StringIO()
+        with self.settings(EMAIL_HOST=self.sink.host, EMAIL_PORT=self.sink.port,
+                           EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='', EMAIL_USE_TLS=False):
+            call_command('send_mail_queue', stdout=output, **{'async': True, 'sessions': 2})
+        self.assertIn('1 mails were sent.', output.getvalue())
+        self.assertEqual(1, self.sink.received)
+
+
+class ImportTestCase(TestCase):
+
+    def setUp(self):
+        self.alice = p.objects.create(email='alice@mail.com')
+
+    def test_import(self):
+        lines = [b'email,year_of_birth,gender,handedness,vision',
+                 b'bob@mail.com,1980,male,right handed,glasses',
+                 b'alice@mail.com,1980,female,right handed,glasses',
+                 b'bob@mail.com,1981,1,11,21',
+                 b'chris@mail.com,18,1,11,21',
+                 b'dora@mail.com,1990,0,10,20']
+        result = importing.import_participants(importing.read_rows(lines),
+                                               base_url='http://testserver/', chunk_size=2)
+        self.assertEqual(2, result.created)
+        self.assertEqual([(2, 'alice@mail.com'), (3, 'bob@mail.com')], result.duplicates)
+        self.assertEqual([4], [row_number for row_number, errors in result.errors])
+
+        bob = p.objects.get(email='bob@mail.com')
+        self.assertEqual((1980, p.MALE, p.RIGHTHANDED, p.GLASSES, True, False),
+                         (bob.year_of_birth, bob.gender, bob.handedness, bob.vision,
+                          bob.is_localy_available, bob.is_activated))
+        dora = p.objects.get(email='dora@mail.com')
+        self.assertEqual(4, len({bob.activate_token, bob.unsubscribe_token,
+                                 dora.activate_token, dora.unsubscribe_token}))
+
+        # Activation mails are only queued
+        self.assertEqual(0, len(mail.outbox))
+        self.assertEqual(2, mailing.send_queued_mails())
+        self.assertItemsEqual(['bob@mail.com', 'dora@mail.com'], [m.to[0] for m in mail.outbox])
+        self.assert_(bob.activate_token in str(mail.outbox[0].message()))
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile(suffix='.jsonl') as f:
+            f.write(b'{"email": "bob@mail.com", "year_of_birth": 1980, "gender": 1, '
+                    b'"handedness": 11, "vision": 21, "is_localy_available": false}\n')
+            f.flush()
+            call_command('import_participants', f.name, activate=True, stdout=StringIO())
+        bob = p.objects.get(email='bob@mail.com')
+        self.assert_(bob.is_activated)
+        self.assertFalse(bob.is_localy_available)
+        self.assertEqual(0, models.OutgoingMail.objects.count())
+
+    def test_admin_upload(self):
+        User.objects.create_superuser('admin', 'admin@test.com', 'secret')
+        client = Client()
+        client.login(username='admin', password='secret')
+        url = reverse('admin:participantdatabase_participant_import')
+        self.failUnlessEqual(client.get(url).status_code, 200)
+
+        upload = SimpleUploadedFile('participants.csv', b'email,year_of_birth,gender,handedness,vision\n'
+                                                        b'bob@mail.com,1980,1,11,21\n')
+        response = client.post(url, {'file': upload})
+        self.assertRedirects(response, reverse('admin:participantdatabase_participant_changelist'))
+        self.assert_(p.objects.filter(email='bob@mail.com').exists())
+        self.assertEqual(1, models.OutgoingMail.objects.count())
+
+    def test_malformed_json(self):
+        lines = [b'{"email": "bob@mail.com", "year_of_birth": 1980, "gender": 1, "handedness": 11, "vision": 21}',
+                 b'{"email": "chris@mail.com", "year_of_birth"',
+                 b'["dora@mail.com", 1990]',
+                 b'{"email": "eve@mail.com", "year_of_birth": 1990, "gender": 0, "handedness": 10, "vision": 20}']
+        result = importing.import_participants(importing.read_rows(lines, 'jsonl'), activate=True,
+                                               chunk_size=2)
+        self.assertEqual(2, result.created)
+        self.assertEqual([2, 3], [row_number for row_number, errors in result.errors])
+        self.assertIn('not valid JSON', result.errors[0][1].as_text())
+
+    def test_latin1_csv(self):
+        User.objects.create_superuser('admin', 'admin@test.com', 'secret')
+        client = Client()
+        client.login(username='admin', password='secret')
+        upload = SimpleUploadedFile('participants.csv', b'email,year_of_birth,gender,handedness,vision\n'
+                                                        b'bob@mail.com,1980,1,11,21\n'
+                                                        b'chris@mail.com,1980,f\xe9minin,11,21\n'
+                                                        b'dora@mail.com,1990,0,10,20\n')
+        response = client.post(reverse('admin:participantdatabase_participant_import'),
+                               {'file': upload}, follow=True)
+        self.assertContains(response, '2 participants were imported')
+        self.assertContains(response, 'Row 2: ')
+        self.assertContains(response, 'The row is not UTF-8 encoded.')
+
+
+class ExportTestCase(TestCase):
+
+    def setUp(self):
+        p.objects.create(email='alice@mail.com', year_of_birth=1990, gender=p.FEMALE,
+                         handedness=p.RIGHTHANDED, vision=p.GLASSES, is_localy_available=False,
+                         is_activated=True)
+        p.objects.create(email='bob@mail.com', year_of_birth=1960, gender=p.MALE,
+                         handedness=p.LEFTHANDED, vision=p.NO_CORRECTED_VISION, is_localy_available=True)
+
+    def test_export_rows(self):
+        rows = list(exporting.export_rows(p.objects.all(), chunk_size=1))
+        self.assertEqual(exporting.EXPORT_FIELDS, rows[0])
+        self.assertEqual(['alice@mail.com', 1990, None, 'female', 'right handed',
+                          'glasses', False, True], rows[1])
+        self.assertEqual(3, len(rows))
+
+    def test_round_trip(self):
+        lines = list(exporting.export_csv(p.objects.all()))
+        p.objects.all().delete()
+        result = importing.import_participants(importing.read_rows(lines), activate=True)
+        self.assertEqual(2, result.created)
+        alice = p.objects.get(email='alice@mail.com')
+        self.assertEqual((1990, p.FEMALE, p.RIGHTHANDED, p.GLASSES, False),
+                         (alice.year_of_birth, alice.gender, alice.handedness, alice.vision,
+                          alice.is_localy_available))
+
+    def test_admin_export(self):
+        User.objects.create_superuser('admin', 'admin@test.com', 'secret')
+        client = Client()
+        client.login(username='admin', password='secret')
+        url = reverse('admin:participantdatabase_participant_export')
+        self.failUnlessEqual(client.get(url).status_code, 200)
+
+        response = client.get(url, {'scope': 'all'})
+        self.assert_(response.streaming)
+        self.assertEqual(3, len(b''.join(response.streaming_content).splitlines()))
+
+        response = client.get(url, {'scope': 'eligible', 'min_age': 18, 'max_age': 99,
+                                    'genders': [p.FEMALE, p.MALE],
+                                    'handedness': [p.RIGHTHANDED, p.LEFTHANDED],
+                                    'vision': [p.GLASSES, p.NO_CORRECTED_VISION]})
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(2, len(lines))
+        self.assert_(lines[1].startswith(b'alice@mail.com,'))
+
+    def test_command(self):
+        output = StringIO()
+        call_command('export_participants', stdout=output)
+        self.assertEqual(3, len(output.getvalue().splitlines()))
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            call_command('export_participants', output=f.name, localy_available=True, min_age=0,
+                         max_age=200, genders=[p.MALE], handedness=[p.LEFTHANDED], vision=[p.NO_CORRECTED_VISION])
+            self.assertEqual(1, len(f.read().splitlines()))
+
+
+class AdminActionTestCase(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@test.com', 'secret')
+        self.client = Client()
+        self.client.login(username='admin', password='secret')
+        self.url = reverse('admin:participantdatabase_participant_changelist')
+        self.alice = p.objects.create(email='alice@mail.com', is_activated=True)
+        self.bob = p.objects.create(email='bob@mail.com', is_localy_available=False)
+        self.chris = p.objects.create(email='chris@mail.com')
+        p.objects.filter(pk__in=[self.alice.pk, self.bob.pk]).update(
+            created=timezone.now() - datetime.timedelta(days=settings.PURGE_UNACTIVATED_DAYS + 1))
+
+    def run_action(self, action, *participants):
+        return self.client.post(self.url, {'action': action,
+                                           '_selected_action': [x.pk for x in participants]})
+
+    def test_changelist(self):
+        response = self.client.get(self.url, {'q': 'ali', 'is_activated__exact': 1})
+        self.failUnlessEqual(response.status_code, 200)
+        self.assertEqual([self.alice], list(response.context['cl'].result_list))
+
+    def test_update_actions(self):
+        self.run_action('activate', self.bob, self.chris)
+        self.assertEqual(3, p.objects.filter(is_activated=True).count())
+        self.run_action('deactivate', self.alice)
+        self.assertFalse(p.objects.get(pk=self.alice.pk).is_activated)
+        self.run_action('toggle_localy_available', self.alice, self.bob)
+        self.assertEqual([False, True, True], [x.is_localy_available for x in p.objects.order_by('pk')])
+
+    def test_activate_resubscribes(self):
+        models.Suppression.objects.suppress([self.bob.email], models.Suppression.UNSUBSCRIBED)
+        models.Suppression.objects.suppress([self.chris.email], models.Suppression.BOUNCED)
+        self.run_action('activate', self.bob, self.chris)
+        self.assertEqual([models.hash_email(self.chris.email)],
+                         list(models.Suppression.objects.values_list('email_hash', flat=True)))
+
+    def test_purge(self):
+        cache.set(models.COUNT_CUBE_CACHE_KEY, [])
+        self.run_action('purge_never_activated', self.alice, self.bob, self.chris)
+        self.assertEqual([self.alice, self.chris], list(p.objects.order_by('pk')))
+        self.assertIsNone(cache.get(models.COUNT_CUBE_CACHE_KEY))
+
+    def test_purge_command(self):
+        output = StringIO()
+        cache.set(models.COUNT_CUBE_CACHE_KEY, [])
+        with self.settings(PURGE_UNACTIVATED_DAYS=0):
+            call_command('purge_unactivated', batch_size=1, stdout=output)
+        self.assertEqual([self.alice], list(p.objects.all()))
+        self.assertIsNone(cache.get(models.COUNT_CUBE_CACHE_KEY))
+        self.assert_(output.getvalue().startswith('2 participants were deleted'))
+
 
 class AccessTestCase(ParticipantDBTestCase):
 
@@ -217,6 +916,336 @@ class AccessTestCase(ParticipantDBTestCase):
             self.assert_access_possible(self.authorised_client, url)
 
 
+class PermissionCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('tester', 'tester@test.com', 'secret')
+        self.group = Group.objects.create(name='experimenters')
+        self.permission = Permission.objects.get(codename='send_mails_to')
+        self.perm = 'participantdatabase.send_mails_to'
+
+    def has_perm(self):
+        # A fresh instance, the user caches its permissions itself.
+        return permissions.has_perm(User.objects.get(pk=self.user.pk), self.perm)
+
+    def test_cached(self):
+        self.user.user_permissions.add(self.permission)
+        self.assertTrue(self.has_perm())
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(permissions.has_perm(user, self.perm))
+            self.assertFalse(permissions.has_perm(user, 'participantdatabase.add_privately'))
+            self.assertTrue(permissions.has_module_perms(user, 'participantdatabase'))
+
+    def test_user_changes(self):
+        self.assertFalse(self.has_perm())
+        self.user.user_permissions.add(self.permission)
+        self.assertTrue(self.has_perm())
+        self.user.user_permissions.clear()
+        self.assertFalse(self.has_perm())
+        self.permission.user_set.add(self.user)
+        self.assertTrue(self.has_perm())
+        self.user.is_active = False
+        self.user.save()
+        self.assertFalse(self.has_perm())
+
+    def test_group_changes(self):
+        self.user.groups.add(self.group)
+        self.assertFalse(self.has_perm())
+        self.group.permissions.add(self.permission)
+        self.assertTrue(self.has_perm())
+        self.group.user_set.remove(self.user)
+        self.assertFalse(self.has_perm())
+        self.user.groups.add(self.group)
+        self.assertTrue(self.has_perm())
+        self.group.delete()
+        self.assertFalse(self.has_perm())
+
+    def test_template(self):
+        client = Client()
+        client.login(username='tester', password='secret')
+        self.assertNotContains(client.get(reverse('login')), reverse('sendmessage'))
+        self.user.user_permissions.add(self.permission)
+        self.assertContains(client.get(reverse('login')), reverse('sendmessage'))
+
+
+class FormCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_unbound_form_cached(self):
+        url = reverse('addparticipant_public')
+        response = Client(enforce_csrf_checks=True).get(url)
+        self.assertContains(response, 'name="email"')
+        key = fragment_cache.form_cache_key(forms.PublicParticipantForm())
+        self.assertIn('name="email"', cache.get(key))
+        cache.set(key, 'cached form markup')
+        response = Client(enforce_csrf_checks=True).get(url)
+        self.assertContains(response, 'cached form markup')
+        # The CSRF token is not part of the cached markup.
+        self.assertContains(response, 'csrfmiddlewaretoken')
+
+    def test_bound_form_not_cached(self):
+        url = reverse('addparticipant_public')
+        Client().get(url)
+        cache.set(fragment_cache.form_cache_key(forms.PublicParticipantForm()), 'cached form markup')
+        response = Client().post(url, {'email': 'invalid'})
+        self.assertNotContains(response, 'cached form markup')
+        self.assertContains(response, 'has-error')
+
+    def test_key(self):
+        key = fragment_cache.form_cache_key(forms.PublicParticipantForm())
+        self.assertEqual(key, fragment_cache.form_cache_key(forms.PublicParticipantForm()))
+        self.assertNotEqual(key, fragment_cache.form_cache_key(forms.ParticipantForm()))
+        self.assertNotEqual(key, fragment_cache.form_cache_key(forms.PublicParticipantForm(prefix='other')))
+        self.assertNotEqual(key, fragment_cache.form_cache_key(forms.PublicParticipantForm(initial={'email': 'a@b.c'})))
+
+
+DSN = b"""From: MAILER-DAEMON@mail.com
+To: pdb@cs.st-andrews.ac.uk
+Subject: Undelivered Mail Returned to Sender
+MIME-Version: 1.0
+Content-Type: multipart/report; report-type=delivery-status; boundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain
+
+The mail could not be delivered.
+
+--BOUNDARY
+Content-Type: message/delivery-status
+
+Reporting-MTA: dns; mail.com
+
+Final-Recipient: rfc822; alice@mail.com
+Action: failed
+Status: 5.1.1
+
+Final-Recipient: rfc822; bob@mail.com
+Action: delayed
+Status: 4.4.1
+
+--BOUNDARY--
+"""
+
+
+class SuppressionTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = p.objects.create(email='alice@mail.com', is_activated=True)
+        self.bob = p.objects.create(email='bob@mail.com', is_activated=True)
+
+    def eligible(self):
+        return sorted(p.objects.get_eligible().values_list('email', flat=True))
+
+    def test_unsubscribe(self):
+        self.assertEqual(2, p.objects.count_eligible())
+        Client().get(reverse('unsubscribe', args=[self.alice.unsubscribe_token]))
+        self.assertEqual(0, p.objects.filter(email='alice@mail.com').count())
+        self.assertEqual(models.Suppression.UNSUBSCRIBED,
+                         models.Suppression.objects.get(email_hash=models.hash_email('alice@mail.com')).reason)
+
+        # Added again, e.g. by an import, the address stays suppressed.
+        alice = p.objects.create(email='Alice@mail.com', is_activated=True)
+        self.assertEqual(['bob@mail.com'], self.eligible())
+        self.assertEqual(1, p.objects.count_eligible())
+        self.assertEqual(['bob@mail.com'], [email for email, token in p.objects.stream_eligible()])
+
+        # Activating a new signup is a new subscription.
+        Client().get(reverse('activate', args=[alice.activate_token]))
+        self.assertEqual(['Alice@mail.com', 'bob@mail.com'], self.eligible())
+        self.assertEqual(2, p.objects.count_eligible())
+
+    def test_bounced(self):
+        self.assertEqual(1, models.Suppression.objects.suppress(['ALICE@mail.com'], models.Suppression.BOUNCED))
+        self.assertEqual(0, models.Suppression.objects.suppress(['alice@mail.com'], models.Suppression.BOUNCED))
+        self.assertEqual(['bob@mail.com'], self.eligible())
+        Client().get(reverse('activate', args=[self.alice.activate_token]))
+        self.assertEqual(['bob@mail.com'], self.eligible())
+
+    def test_pending_recipients(self):
+        campaign = mailing.enqueue_campaign('Subject', 'Text', 'contact@mail.com',
+                                            p.objects.stream_eligible(), 'http://testserver/')
+        models.Suppression.objects.suppress(['alice@mail.com'], models.Suppression.BOUNCED)
+        with self.settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            self.assertEqual(1, mailing.deliver_campaign(campaign))
+        self.assertEqual(['bob@mail.com'], [message.to[0] for message in mail.outbox[:1]])
+
+    def test_claimed_recipients(self):
+        campaign = mailing.enqueue_campaign('Subject', 'Text', 'contact@mail.com',
+                                            p.objects.stream_eligible(), 'http://testserver/')
+        mailing.claim_batch(campaign.recipients.filter(email='alice@mail.com'), 1)
+        outgoing_mail = mailing.queue_activation_mail(self.bob, 'http://testserver/')
+        # Addresses match regardless of case, claimed recipients fail as well.
+        models.Suppression.objects.suppress(['ALICE@mail.com', 'Bob@Mail.com'], models.Suppression.BOUNCED)
+        self.assertEqual([models.Delivery.FAILED] * 2, [recipient.status for recipient in campaign.recipients.all()])
+        self.assertEqual(models.Delivery.FAILED, models.OutgoingMail.objects.get(pk=outgoing_mail.pk).status)
+
+    def test_queued_mails(self):
+        alice_mail = mailing.queue_activation_mail(self.alice, 'http://testserver/')
+        bob_mail = mailing.queue_activation_mail(self.bob, 'http://testserver/')
+        # Suppressed after the mails were queued, without going through suppress.
+        models.Suppression.objects.create(email_hash=self.alice.email_hash, reason=models.Suppression.BOUNCED)
+        models.Suppression.objects.create(email_hash=self.bob.email_hash, reason=models.Suppression.UNSUBSCRIBED)
+        self.assertEqual(0, mailing.send_queued_mails())
+        self.assertEqual(0, len(mail.outbox))
+        self.assertEqual(models.Suppression.ERROR, models.OutgoingMail.objects.get(pk=alice_mail.pk).last_error)
+        self.assertEqual(models.Delivery.FAILED, models.OutgoingMail.objects.get(pk=bob_mail.pk).status)
+
+        # Signing up again after unsubscribing queues an activation mail that is sent.
+        mailing.queue_activation_mail(self.bob, 'http://testserver/')
+        mailing.queue_activation_mail(self.alice, 'http://testserver/')
+        self.assertEqual(1, mailing.send_queued_mails())
+        self.assertEqual(['bob@mail.com'], mail.outbox[0].to)
+
+    def test_import(self):
+        models.Suppression.objects.suppress(['chris@mail.com'], models.Suppression.UNSUBSCRIBED)
+        models.Suppression.objects.suppress(['dora@mail.com'], models.Suppression.BOUNCED)
+        lines = [b'email,year_of_birth,gender,handedness,vision',
+                 b'Chris@mail.com,1980,1,11,21',
+                 b'dora@mail.com,1990,0,10,20',
+                 b'erin@mail.com,1990,0,10,20']
+        result = importing.import_participants(importing.read_rows(lines), base_url='http://testserver/')
+        self.assertEqual(1, result.created)
+        self.assertEqual([(1, 'Chris@mail.com'), (2, 'dora@mail.com')], result.suppressed)
+        self.assertEqual(['erin@mail.com'], list(models.OutgoingMail.objects.values_list('email', flat=True)))
+
+    def test_hard_bounces(self):
+        message = mailbox.MaildirMessage(DSN)
+        self.assertEqual(['alice@mail.com'], bounces.hard_bounces(message))
+        self.assertEqual([], bounces.hard_bounces(mailbox.MaildirMessage(b'Subject: Hello\n\nText')))
+
+    def test_process_bounces(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        maildir = mailbox.Maildir(os.path.join(directory, 'bounces'))
+        maildir.add(DSN)
+        maildir.add(b'Subject: Re: Invitation\n\nI would like to take part.')
+        output = StringIO()
+        call_command('process_bounces', maildir=maildir._path, stdout=output)
+        self.assertIn('1 delivery reports read, 1 addresses suppressed.', output.getvalue())
+        self.assertEqual(['bob@mail.com'], self.eligible())
+        self.assertEqual(['Re: Invitation'], [message['subject'] for message in maildir])
+
+    def test_case_duplicates(self):
+        form = forms.PublicParticipantForm({'email': 'ALICE@mail.com', 'year_of_birth': 1990,
+                                            'gender': p.FEMALE, 'handedness': p.RIGHTHANDED,
+                                            'vision': p.GLASSES, 'accept_privacy_statement': True})
+        self.assertFalse(form.is_valid())
+        self.assertIn('email', form.errors)
+
+
+class RateLimitTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+
+    def signup(self, email, ip='10.0.0.1', **extra):
+        post_data = {'email': email,
+                     'year_of_birth': '1986',
+                     'gender': str(p.MALE),
+                     'handedness': str(p.RIGHTHANDED),
+                     'vision': str(p.GLASSES),
+                     'is_localy_available': 'on',
+                     'accept_privacy_statement': 'on'}
+        return self.client.post(reverse('addparticipant_public'), post_data, REMOTE_ADDR=ip, **extra)
+
+    def test_flood(self):
+        with self.settings(SIGNUP_RATE_LIMIT_PER_IP=(5, 3600)):
+            self.failUnlessEqual(200, self.client.get(reverse('addparticipant_public')).status_code)
+            codes = [self.signup('bot{0}@mail.com'.format(i)).status_code for i in range(50)]
+            self.assertEqual([302] * 5 + [429] * 45, codes)
+            # Other clients are not affected
+            self.failUnlessEqual(302, self.signup('alice@mail.com', ip='10.0.0.2').status_code)
+        self.assertEqual(6, p.objects.count())
+        self.assertEqual(6, models.OutgoingMail.objects.count())
+
+    def test_domain_limit(self):
+        with self.settings(SIGNUP_RATE_LIMIT_PER_DOMAIN=(2, 3600)):
+            codes = [self.signup('user{0}@spam.com'.format(i), ip='10.0.0.{0}'.format(i)).status_code
+                     for i in range(4)]
+            self.assertEqual([302, 302, 429, 429], codes)
+            self.failUnlessEqual(302, self.signup('bob@mail.com').status_code)
+
+    def test_exempt_domain(self):
+        with self.settings(SIGNUP_RATE_LIMIT_PER_DOMAIN=(1, 3600),
+                           SIGNUP_RATE_LIMIT_EXEMPT_DOMAINS=('uni.edu',)):
+            codes = [self.signup(email, ip='10.0.0.{0}'.format(i)).status_code
+                     for i, email in enumerate(['alice@uni.edu', 'bob@uni.edu', 'chris@student.uni.edu',
+                                                'dora@spam.com', 'eve@spam.com'])]
+            self.assertEqual([302, 302, 302, 302, 429], codes)
+
+    def test_client_ip(self):
+        factory = RequestFactory()
+        with self.settings(TRUSTED_PROXIES=('10.0.0.1', '10.0.0.2')):
+            request = factory.post('/', REMOTE_ADDR='10.0.0.1',
+                                   HTTP_X_FORWARDED_FOR='1.2.3.4, 5.6.7.8, 10.0.0.2')
+            self.assertEqual('5.6.7.8', decorators.client_ip(request))
+            request = factory.post('/', REMOTE_ADDR='10.0.0.1')
+            self.assertEqual('10.0.0.1', decorators.client_ip(request))
+            # Only proxies are believed
+            request = factory.post('/', REMOTE_ADDR='5.6.7.8', HTTP_X_FORWARDED_FOR='1.2.3.4')
+            self.assertEqual('5.6.7.8', decorators.client_ip(request))
+
+    def test_proxy(self):
+        with self.settings(SIGNUP_RATE_LIMIT_PER_IP=(1, 3600), TRUSTED_PROXIES=('10.0.0.1',)):
+            self.failUnlessEqual(302, self.signup('alice@mail.com', HTTP_X_FORWARDED_FOR='1.2.3.4').status_code)
+            self.failUnlessEqual(302, self.signup('bob@mail.com', HTTP_X_FORWARDED_FOR='5.6.7.8').status_code)
+            self.failUnlessEqual(429, self.signup('chris@mail.com',
+                                                  HTTP_X_FORWARDED_FOR='9.9.9.9, 1.2.3.4').status_code)
+
+    def test_refill(self):
+        with self.settings(SIGNUP_RATE_LIMIT_PER_IP=(1, 0.05)):
+            self.failUnlessEqual(302, self.signup('alice@mail.com').status_code)
+            self.failUnlessEqual(429, self.signup('bob@mail.com').status_code)
+            time.sleep(0.06)
+            self.failUnlessEqual(302, self.signup('bob@mail.com').status_code)
+
+
+class PerformanceTestCase(ParticipantDBTestCase):
+
+    def setUp(self):
+        ParticipantDBTestCase.setUp(self)
+        cache.clear()
+
+    def test_middleware(self):
+        middleware_classes = ('mainsite.apps.participantdatabase.middleware.PerformanceMiddleware',)
+        middleware_classes += settings.MIDDLEWARE_CLASSES
+        alice = p.objects.create(email='alice@mail.com')
+        with self.settings(MIDDLEWARE_CLASSES=middleware_classes):
+            with mock.patch('mainsite.apps.participantdatabase.middleware.logger') as logger:
+                self.anonymous_client.get(reverse('addparticipant_public'))
+                self.anonymous_client.get('/wp-login.php')
+                self.anonymous_client.get('/no such page/')
+                self.anonymous_client.get(reverse('activate', kwargs={'token': alice.activate_token}))
+        log_line = json.loads(logger.info.call_args[0][0])
+        self.assertEqual('activate', log_line['url_name'])
+        self.assertEqual(200, log_line['status'])
+        self.assertGreater(log_line['sql_queries'], 0)
+        self.assertGreater(log_line['template_ms'], 0)
+
+        rows = instrumentation.summary()
+        # Paths that do not resolve share one url name
+        self.assertEqual(['<unresolved>', 'activate', 'addparticipant_public'], [row['url_name'] for row in rows])
+        self.assertEqual(0, rows[2]['smtp_ms']['p95'])
+
+    def test_summary_page(self):
+        url = reverse('performance')
+        instrumentation.record_sample('activate', {'wall_ms': 1.5, 'sql_queries': 2, 'sql_ms': 0.5,
+                                                   'template_ms': 0.5, 'smtp_ms': 0})
+        self.failIfEqual(200, self.authorised_client.get(url).status_code)
+        User.objects.create_superuser('admin', 'admin@test.com', 'secret')
+        client = Client()
+        client.login(username='admin', password='secret')
+        response = client.get(url)
+        self.failUnlessEqual(200, response.status_code)
+        self.assertContains(response, '<td>activate</td>')
+
+
 class TokenTestCase(TestCase):
 
     def setUp(self):
@@ -241,3 +1270,28 @@ class TokenTestCase(TestCase):
             self.assertFalse()
         except Http404:
             pass
+
+    def test_invalid_tokens(self):
+        for token in ['x' * 22, 'a' * 39, '\xe4' * 22]:
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse('unsubscribe', kwargs={'token': token}))
+            self.failUnlessEqual(response.status_code, 404)
+
+    def test_legacy_tokens(self):
+        p.objects.filter(pk=self.alice.pk).update(activate_token='0123456789abcdef0123456789abcdef01234567')
+        response = self.client.get(reverse('activate', kwargs={'token': '0123456789abcdef0123456789abcdef01234567'}))
+        self.failUnlessEqual(response.status_code, 200)
+        self.assert_(p.objects.get(pk=self.alice.pk).is_activated)
+
+    def test_signed_tokens(self):
+        with self.settings(SIGNED_TOKENS=True):
+            bob = p.objects.create(email='bob@mail.com')
+            self.assertEqual(32, len(bob.unsubscribe_token))
+            self.assertFalse(tokens.is_valid(bob.unsubscribe_token, tokens.ACTIVATE_SALT))
+            # Unsigned tokens are rejected without a query
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse('unsubscribe', kwargs={'token': self.alice.unsubscribe_token}))
+            self.failUnlessEqual(response.status_code, 404)
+            response = self.client.get(reverse('unsubscribe', kwargs={'token': bob.unsubscribe_token}))
+            self.failUnlessEqual(response.status_code, 200)
+            self.assertFalse(p.objects.filter(pk=bob.pk).exists())
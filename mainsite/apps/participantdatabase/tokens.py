@@ -0,0 +1,86 @@
+import base64
+import hashlib
+import hmac
+import os
+import re
+
+from django.conf import settings
+
+
+ACTIVATE_SALT = 'participantdatabase.activate'
+UNSUBSCRIBE_SALT = 'participantdatabase.unsubscribe'
+
+RANDOM_BYTES = 16
+SIGNATURE_BYTES = 8
+
+# Tokens were 40 digit sha1 hex digests before, links containing them may
+# still be in the inboxes of participants.
+LEGACY_TOKEN = re.compile(r'^[0-9a-f]{40}$')
+
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def decode(token):
+    """
+    Return the bytes encoded in the token, or None if it is no valid url safe
+    base64 string.
+    """
+    try:
+        token = str(token)
+        return base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    except (TypeError, UnicodeEncodeError):
+        return None
+
+
+def signature(data, salt):
+    key = hashlib.sha256(salt + settings.SECRET_KEY).digest()
+    return hmac.new(key, data, hashlib.sha256).digest()[:SIGNATURE_BYTES]
+
+
+def generate_tokens(number, salt):
+    """
+    Return a list of number new, unique tokens for the given purpose (salt).
+
+    A token is 16 random bytes encoded as 22 characters of url safe base64.
+    With SIGNED_TOKENS an HMAC of the random bytes is appended, giving 32
+    characters, so that is_valid can reject made up tokens without a query.
+
+    >>> len(set(generate_tokens(100, ACTIVATE_SALT)))
+    100
+    """
+    data = os.urandom(number * RANDOM_BYTES)
+    tokens = []
+    for start in range(0, len(data), RANDOM_BYTES):
+        random_bytes = data[start:start + RANDOM_BYTES]
+        if getattr(settings, 'SIGNED_TOKENS', False):
+            random_bytes += signature(random_bytes, salt)
+        tokens.append(encode(random_bytes))
+    return tokens
+
+
+def generate_token(salt):
+    return generate_tokens(1, salt)[0]
+
+
+def is_valid(token, salt):
+    """
+    Return whether the token may have been created by generate_tokens for the
+    given purpose, without touching the database. Legacy tokens are always
+    accepted; with SIGNED_TOKENS the signature of other tokens is checked.
+
+    >>> token = generate_token(UNSUBSCRIBE_SALT)
+    >>> is_valid(token, UNSUBSCRIBE_SALT), is_valid(token[:-1], UNSUBSCRIBE_SALT)
+    (True, False)
+    """
+    if LEGACY_TOKEN.match(token):
+        return True
+    data = decode(token)
+    if data is None or encode(data) != token:
+        return False
+    if not getattr(settings, 'SIGNED_TOKENS', False):
+        return len(data) == RANDOM_BYTES
+    if len(data) != RANDOM_BYTES + SIGNATURE_BYTES:
+        return False
+    return hmac.compare_digest(data[RANDOM_BYTES:], signature(data[:RANDOM_BYTES], salt))
@@ -11,5 +11,9 @@ urlpatterns = patterns('',
      url(r'^unsubscribe/(?P<token>.+)/$', views.unsubscribe_view, name='unsubscribe'),
      url(r'^activate/(?P<token>.+)/$', views.activate_view, name='activate'),
      url(r'^sendmessage/$', views.send_message_view, name='sendmessage'),
+     url(r'^sendmessage/audiencesize/$', views.audience_size_view, name='audiencesize'),
+     url(r'^campaign/(?P<pk>\d+)/$', views.campaign_view, name='campaign'),
+     url(r'^campaign/metrics/$', views.campaign_metrics_view, name='campaign_metrics'),
+     url(r'^performance/$', views.performance_view, name='performance'),
    
 )
\ No newline at end of file
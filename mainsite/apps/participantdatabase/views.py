@@ -1,43 +1,36 @@
 from django.shortcuts import render, get_object_or_404, redirect
-from django.template.context import Context
-from django.template.loader import get_template
-from django.core.urlresolvers import reverse
-from django.core.mail import get_connection
+from django.http import Http404, JsonResponse
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.conf import settings
-from django.utils.html import escape
-from django.core import mail
 
-from models import Participant
-from forms import ParticipantForm, PublicParticipantForm, ParticipantSearchForm
-from decorators import permision_required_or_message
-
-
-def __plain_text_to_html(text):
-    paragraphs = []
-    line_buffer = []
-    for line in text.splitlines():
-        if line:
-            line_buffer.append(escape(line))
-        else:
-            paragraphs.append(u'<br>'.join(line_buffer))
-            line_buffer = []
-    paragraphs.append(u'<br>'.join(line_buffer))
-    template = u'<p>{0}</p>'
-    return u'\n'.join([template.format(paragraph) for paragraph in paragraphs])
+from models import Participant, Campaign, Suppression
+from forms import ParticipantForm, PublicParticipantForm, ParticipantSearchForm,\
+    ParticipantFilterForm
+from decorators import permision_required_or_message, rate_limited, client_ip, email_domain
+from mailing import enqueue_campaign, queue_activation_mail
+import instrumentation
+import tokens
 
 
 def unsubscribe_view(request, token):
+    if not tokens.is_valid(token, tokens.UNSUBSCRIBE_SALT):
+        raise Http404
     participant = get_object_or_404(Participant, unsubscribe_token=token)
+    # Keep the address from being mailed again if it is added again.
+    Suppression.objects.suppress([participant.email], Suppression.UNSUBSCRIBED)
     participant.delete()
     return render(request, 'unsubscribe_message.html')
 
 
 def activate_view(request, token):
+    if not tokens.is_valid(token, tokens.ACTIVATE_SALT):
+        raise Http404
     participant = get_object_or_404(Participant, activate_token=token)
     participant.is_activated = True
     participant.save()
+    Suppression.objects.resubscribe([participant.email])
     return render(request, 'activate_message.html')
 
 
@@ -49,39 +42,9 @@ def __add_participant(request, public):
         if form.is_valid():
             new_participant = form.save()
 
-            activation_url = reverse('activate', kwargs={'token': new_participant.activate_token})
-            activation_url = request.build_absolute_uri(activation_url)
-
-            unsubscribe_url = reverse('unsubscribe', kwargs={'token': new_participant.unsubscribe_token})
-            unsubscribe_url = request.build_absolute_uri(unsubscribe_url)
-
-            subject = '{0} Activation mail'.format(settings.MAIL_PREFIX)
-
-            context = Context({'activation_url': activation_url,
-                               'unsubscribe_url': unsubscribe_url,
-                               'contact_email': settings.CONTACT_EMAIL,
-                               'message_title': subject,
-            })
-
-            text_mail_template = get_template('emails/activation.txt')
-            html_mail_template = get_template('emails/activation.html')
-
-            text_content = text_mail_template.render(context)
-            html_content = html_mail_template.render(context)
-
-            connection = get_connection()
-            connection.open()
-            try:
-                email = mail.EmailMultiAlternatives(subject, text_content,
-                                                    settings.DEFAULT_FROM_EMAIL,
-                                                    [new_participant.email],
-                                                    connection=connection,
-                )
-
-                email.attach_alternative(html_content, "text/html")
-                email.send()
-            finally:
-                connection.close()
+            # The mail is sent by the send_mail_queue command, so that signing
+            # up does not wait for the mail server.
+            queue_activation_mail(new_participant, request.build_absolute_uri('/'))
 
             message = 'Succefsully added {0}. You should now receive a confirmation email to activate your account.'.format(
                 new_participant.email)
@@ -104,6 +67,8 @@ def private_add_participant(request):
     return __add_participant(request, False)
 
 
+@rate_limited(client_ip, 'SIGNUP_RATE_LIMIT_PER_IP')
+@rate_limited(email_domain, 'SIGNUP_RATE_LIMIT_PER_DOMAIN')
 def public_add_participant(request):
     return __add_participant(request, True)
 
@@ -125,56 +90,20 @@ def send_message_view(request):
             handedness = form.cleaned_data['handedness']
             vision = form.cleaned_data['vision']
             localy_available = form.cleaned_data['localy_available']
-
-            recipients = Participant.objects.get_eligible(min_age, max_age,
-                                                          localy_available,
-                                                          genders, handedness,
-                                                          vision)
-
-            text_mail_template = get_template('emails/experiment_invitation.txt')
-            html_mail_template = get_template('emails/experiment_invitation.html')
-
-            connection = get_connection()
-            connection.open()
-            try:
-                for recipient in recipients:
-                    unsubscribe_url = reverse('unsubscribe', kwargs={'token': recipient.unsubscribe_token})
-                    unsubscribe_url = request.build_absolute_uri(unsubscribe_url)
-
-                    text_context = Context({'message': message,
-                                            'unsubscribe_url': unsubscribe_url,
-                                            'contact_email': settings.CONTACT_EMAIL,
-                                            'message_title': subject,
-                    })
-                    html_context = Context({'message': __plain_text_to_html(message),
-                                            'unsubscribe_url': unsubscribe_url,
-                                            'contact_email': settings.CONTACT_EMAIL,
-                                            'message_title': subject,
-                    })
-
-                    text_content = text_mail_template.render(text_context)
-                    html_content = html_mail_template.render(html_context)
-
-                    email = mail.EmailMultiAlternatives(subject, text_content,
-                                                        settings.DEFAULT_FROM_EMAIL,
-                                                        [recipient.email],
-                                                        headers={'Reply-To': sender})
-                    email.attach_alternative(html_content, "text/html")
-                    email.send()
-                if recipients:
-                    email = mail.EmailMultiAlternatives(subject, text_content,
-                                                        settings.DEFAULT_FROM_EMAIL,
-                                                        [settings.CONTACT_EMAIL],
-                                                        headers={'Reply-To': sender})
-                    email.attach_alternative(html_content, "text/html")
-                    email.send()
-
-            finally:
-                connection.close()
-            number_of_mails = len(recipients)
-            message = ' {0} mails were sent.'.format(number_of_mails)
+            age_precision = form.cleaned_data['age_precision']
+
+            recipients = Participant.objects.stream_eligible(min_age, max_age,
+                                                             localy_available,
+                                                             genders, handedness,
+                                                             vision, age_precision)
+
+            campaign = enqueue_campaign(subject, message, sender, recipients,
+                                        request.build_absolute_uri('/'),
+                                        created_by=request.user)
+            number_of_mails = campaign.recipients.count()
+            message = ' {0} mails were queued.'.format(number_of_mails)
             messages.add_message(request, messages.SUCCESS, message)
-            return redirect('sendmessage')
+            return redirect('campaign', pk=campaign.pk)
             #return render(request, 'info_message.html', {'message': message})
     else:
         form = ParticipantSearchForm()
@@ -182,3 +111,55 @@ def send_message_view(request):
     return render(request, 'send_message.html', {
         'form': form,
     })
+
+
+@login_required
+@permision_required_or_message('participantdatabase.send_mails_to', '/')
+def audience_size_view(request):
+    """
+    Return the number of participants matching the criteria of a
+    ParticipantFilterForm given in the query string as JSON.
+    """
+    form = ParticipantFilterForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    count = Participant.objects.count_eligible(**form.cleaned_data)
+    return JsonResponse({'count': count})
+
+
+@login_required
+@permision_required_or_message('participantdatabase.send_mails_to', '/')
+def campaign_view(request, pk):
+    campaign = get_object_or_404(Campaign, pk=pk)
+    return render(request, 'campaign_progress.html', {
+        'campaign': campaign,
+        'progress': campaign.progress(),
+    })
+
+
+@staff_member_required
+def performance_view(request):
+    """
+    Show the p50 and p95 of the measurements of the PerformanceMiddleware
+    for every url name.
+    """
+    fields = ['wall_ms', 'sql_queries', 'sql_ms', 'template_ms', 'smtp_ms']
+    rows = [(row['url_name'], row['count'], [row[field] for field in fields])
+            for row in instrumentation.summary()]
+    return render(request, 'performance.html', {
+        'rows': rows,
+        'fields': fields,
+    })
+
+
+@staff_member_required
+def campaign_metrics_view(request):
+    """
+    Show the delivery metrics of the latest campaigns.
+    """
+    campaigns = Campaign.objects.order_by('-created')[:50]
+    return render(request, 'campaign_metrics.html', {
+        'campaigns': [(campaign, campaign.progress(), campaign.messages_per_second(),
+                       campaign.failures_by_code())
+                      for campaign in campaigns],
+    })
@@ -0,0 +1,47 @@
+# Settings for production, selected with
+# DJANGO_SETTINGS_MODULE=mainsite.production_settings. The database is taken
+# from the environment, like the secret key in local_settings.
+import os
+
+from mainsite.settings import *  # noqa
+
+
+DEBUG = False
+TEMPLATE_DEBUG = False
+
+ALLOWED_HOSTS = os.environ.get('ALLOWED_HOSTS', 'localhost').split(',')
+
+# MySQL by default; set DATABASE_ENGINE to sqlite3 and DATABASE_NAME to the
+# path of the database file for a SQLite deployment, which uses the
+# SQLITE_PRAGMAS.
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.' + os.environ.get('DATABASE_ENGINE', 'mysql'),
+        'NAME': os.environ.get('DATABASE_NAME', 'pdb'),
+        'USER': os.environ.get('DATABASE_USER', 'pdb'),
+        'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+        'HOST': os.environ.get('DATABASE_HOST', ''),
+        'PORT': os.environ.get('DATABASE_PORT', ''),
+        # Seconds a worker keeps its connection open between requests,
+        # instead of connecting for every request. Keep it below the
+        # wait_timeout of the MySQL server.
+        'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 600)),
+    }
+}
+if DATABASES['default']['ENGINE'].endswith('mysql'):
+    DATABASES['default']['OPTIONS'] = {
+        'charset': 'utf8',
+        'init_command': "SET sql_mode='STRICT_TRANS_TABLES'",
+    }
+
+# A cache shared by all processes on the host, so that the count cube, the
+# permissions and the rate limits are the same for all of them.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('CACHE_LOCATION', '/var/tmp/pdb_cache'),
+    }
+}
+
+# Comma separated addresses of the front-end proxies, see TRUSTED_PROXIES.
+TRUSTED_PROXIES = tuple(os.environ.get('TRUSTED_PROXIES', '127.0.0.1,::1').split(','))
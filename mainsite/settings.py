@@ -15,6 +15,74 @@ MAIL_PREFIX = '[CS@UoA PDB]'
 DEFAULT_FROM_EMAIL = 'pdb@cs.st-andrews.ac.uk'
 CONTACT_EMAIL = DEFAULT_FROM_EMAIL
 
+# Number of times the delivery of a campaign mail is attempted before the
+# recipient is marked as failed.
+CAMPAIGN_MAX_ATTEMPTS = 3
+
+# Number of campaign mails handed to the mail backend at once. The
+# participantdatabase.smtp backends send each batch over one connection.
+CAMPAIGN_BATCH_SIZE = 100
+
+# Seconds after which mails claimed by a sender that did not report back, e.g.
+# because it crashed, are handed to another sender. Keep it well above the
+# time it takes to send one batch.
+CAMPAIGN_CLAIM_TIMEOUT = 600
+
+# Number of threads sending campaign mails concurrently and the maximum number
+# of campaign mails sent per second (None for no limit).
+CAMPAIGN_WORKERS = 1
+CAMPAIGN_RATE_LIMIT = None
+
+# Connection pooling of the participantdatabase.smtp backends: number of idle
+# connections kept open per server and number of messages sent over one
+# connection before it is replaced.
+EMAIL_POOL_SIZE = 2
+EMAIL_POOL_MAX_MESSAGES = 100
+
+# Number of concurrent SMTP sessions of the participantdatabase.async_smtp
+# backend, used by "send_mail_queue --async".
+ASYNC_EMAIL_SESSIONS = 10
+
+# Seconds the participant count cube behind the audience size preview is
+# cached. Saving or deleting a participant invalidates it; with more than one
+# process, configure a shared cache in CACHES so all of them see that.
+COUNT_CUBE_CACHE_TIMEOUT = 600
+
+# Seconds the permissions of a user are cached for the views and the perms
+# of templates. Changes to users, groups and permissions invalidate them; as
+# for the count cube, processes only see that if they share the cache.
+PERMISSIONS_CACHE_TIMEOUT = 600
+
+# Sign the activation and unsubscribe tokens, so that the views reject made
+# up tokens before querying the database. Unsigned tokens handed out before
+# this is switched on stop working; tokens of older versions keep working.
+SIGNED_TOKENS = False
+
+# Public signups allowed per client address and per email domain, as
+# (number of signups, seconds), or None for no limit. The limits are kept in
+# the RATE_LIMIT_CACHE alias of CACHES. A whole campus may sign up from the
+# address of its NAT gateway. Most signups come from the domain of the
+# university, so the per domain limit is off by default; when it is turned
+# on, the SIGNUP_RATE_LIMIT_EXEMPT_DOMAINS and their subdomains are exempt.
+SIGNUP_RATE_LIMIT_PER_IP = (100, 3600)
+SIGNUP_RATE_LIMIT_PER_DOMAIN = None
+SIGNUP_RATE_LIMIT_EXEMPT_DOMAINS = ()
+RATE_LIMIT_CACHE = 'default'
+
+# Addresses of the front-end proxies, such as the web server in front of the
+# application server. The client address of requests they forward is taken
+# from the X-Forwarded-For header instead of REMOTE_ADDR.
+TRUSTED_PROXIES = ('127.0.0.1', '::1')
+
+# Maildir the delivery status notifications of bounced mails are delivered
+# to, read by the process_bounces command. Let the return path of the mails
+# (DEFAULT_FROM_EMAIL) deliver there.
+BOUNCE_MAILDIR = None
+
+# Days after signing up after which participants that never activated their
+# membership may be purged.
+PURGE_UNACTIVATED_DAYS = 30
+
 MANAGERS = ADMINS
 
 DATABASES = {
@@ -28,6 +96,18 @@ DATABASES = {
     }
 }
 
+# Pragmas set on every new SQLite connection. The write ahead log lets
+# requests read while the mail sender writes, and with it a normal
+# synchronous level is still safe. Waiting for locks for up to 5 seconds
+# avoids "database is locked" errors under concurrent writes.
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+    ('cache_size', -16000),
+    ('temp_store', 'MEMORY'),
+)
+
 LOGIN_REDIRECT_URL = '/addparticipant/'
 LOGIN_URL = '/login/'
 
@@ -94,14 +174,23 @@ TEST_RUNNER = 'django.test.runner.DiscoverRunner'
 SECRET_KEY = 'e)=*w*e4+gojwk%)**w1!a@^n=rj5t85oee!vct$_vz)b7gngd'
 
 # List of callables that know how to import templates from various sources.
+# The cached loader compiles every template only once per process, so changed
+# templates are only picked up after a restart (also with runserver).
 TEMPLATE_LOADERS = (
-    'django.template.loaders.filesystem.Loader',
-    'django.template.loaders.app_directories.Loader',
-    #'django.template.loaders.eggs.Loader',
+    ('django.template.loaders.cached.Loader', (
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+        #'django.template.loaders.eggs.Loader',
+    )),
 )
 
+# Seconds the markup of unbound forms (like the public signup form) is
+# cached by the cacheform template tag.
+FORM_CACHE_TIMEOUT = 3600
+
 TEMPLATE_CONTEXT_PROCESSORS = global_settings.TEMPLATE_CONTEXT_PROCESSORS + (
     "mainsite.apps.participantdatabase.context_processors.add_contact_email",
+    "mainsite.apps.participantdatabase.context_processors.cached_perms",
 )
 
 MIDDLEWARE_CLASSES = (
@@ -114,6 +203,12 @@ MIDDLEWARE_CLASSES = (
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
+# Add 'mainsite.apps.participantdatabase.middleware.PerformanceMiddleware' as
+# the first entry of MIDDLEWARE_CLASSES to log the time spent on each request
+# and see a summary at /performance/. The summary covers the latest
+# PERFORMANCE_SAMPLES requests per url name.
+PERFORMANCE_SAMPLES = 500
+
 ROOT_URLCONF = 'mainsite.urls'
 
 # Python dotted path to the WSGI application used by Django's runserver.
@@ -163,6 +258,10 @@ LOGGING = {
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
         },
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
         'file': {
             'level': 'ERROR',
             'class': 'logging.FileHandler',
@@ -175,6 +274,11 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'mainsite.apps.participantdatabase.middleware': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
         'blanket': {
             'handlers': ['file'],
             'level': 'DEBUG',